@@ -0,0 +1,311 @@
+"""SMTP受信とWeb画面のエンドツーエンド・ベンチマーク
+
+使い方：
+    python benchmarks/bench_e2e.py [--messages 2000] [--concurrency 16] [--shape multipart]
+                                   [--attachments 2] [--attachment-size 65536]
+                                   [--mailbox-sizes 1000,10000,100000] [--output result.json]
+
+1. 受信：SMTPController + CustomHandlerをローカルで起動し、並行するSMTPクライアントから
+   指定した形（plain / html / multipart）のメールを送り続け、1秒あたりの受信数と
+   受信完了（250応答）までのレイテンシ（p50/p95/p99）を計測する。
+2. Web：メールボックスを指定件数まで埋め、`/`・`/api/emails`・`/refresh`・削除・
+   クリーンアップの所要時間を計測する。
+
+結果はJSONで出力し、実行ごとに比較できるようにする。
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import smtplib
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from email import policy
+from email.message import EmailMessage
+
+# start.init_serverがカレントディレクトリへDBやログを作らないよう一時ディレクトリを使う
+_workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+os.environ.setdefault("DB_FILE", os.path.join(_workdir, "emails.db"))
+os.environ.setdefault("LOG_DIR", os.path.join(_workdir, "logs"))
+os.environ.setdefault("ATTACHMENT_DIR", os.path.join(_workdir, "attachments"))
+os.environ.setdefault("RAW_DIR", os.path.join(_workdir, "raw"))
+_repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _repo_root)
+
+import logging  # noqa: E402
+
+# 標準出力にはJSONだけを出すよう、start.pyのコンソールログは標準エラーへ向ける
+with contextlib.redirect_stdout(sys.stderr):
+    import start  # noqa: E402
+    start.init_server()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def percentile(values, p):
+    """昇順に並べたvaluesのpパーセンタイル（最近傍法）"""
+    if not values:
+        return None
+    index = min(max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0), len(values) - 1)
+    return values[index]
+
+
+def summarize(seconds):
+    """秒単位の計測値をミリ秒の統計にまとめる"""
+    values = sorted(value * 1000 for value in seconds)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values),
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1],
+    }
+
+
+def make_message(shape, index, attachments, attachment_size, rng):
+    """指定した形のメール（bytes）を作る"""
+    msg = EmailMessage()
+    msg["Subject"] = "bench %s %d" % (shape, index)
+    msg["From"] = "bench@example.com"
+    msg["To"] = "qa+%d@example.com" % index
+    msg["X-Mailer"] = "bench_e2e"
+    text = "ベンチマーク用の本文です。詳細は https://example.com/items/%d を参照してください。\n" % index * 20
+    msg.set_content(text)
+    if shape in ("html", "multipart"):
+        msg.add_alternative("<html><body><p>%s</p></body></html>" % text.replace("\n", "<br>\n"), subtype="html")
+    if shape == "multipart":
+        for number in range(attachments):
+            msg.add_attachment(rng.randbytes(attachment_size), maintype="application", subtype="octet-stream",
+                               filename="attachment_%d_%d.bin" % (index, number))
+    # SMTPで送るため改行はCRLFにする
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_ingest(args):
+    """並行SMTPクライアントで送信し、受信スループットとレイテンシを計測する"""
+    port = args.port or free_port()
+    controller = start.SMTPController(start.CustomHandler(), hostname="127.0.0.1", port=port)
+    controller.start()
+    rng = random.Random(0)
+    # 生成コストを計測に含めないよう、あらかじめ作っておいたメールを使い回す
+    samples = [make_message(args.shape, index, args.attachments, args.attachment_size, rng)
+               for index in range(min(args.messages, 50))]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(args.messages))
+
+    def client():
+        local = []
+        with smtplib.SMTP("127.0.0.1", port) as smtp:
+            for index in counter:
+                body = samples[index % len(samples)]
+                started = time.perf_counter()
+                try:
+                    smtp.sendmail("bench@example.com", ["qa+%d@example.com" % index], body)
+                except smtplib.SMTPException as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    accepted_seconds = time.perf_counter() - started
+    # write-behindキューに残った分がDBへ書き終わるまでを含めた時間も計測する
+    start.email_writer.flush()
+    persisted_seconds = time.perf_counter() - started
+    controller.stop()
+
+    return {
+        "shape": args.shape,
+        "messages": args.messages,
+        "message_bytes": sum(len(sample) for sample in samples) // len(samples),
+        "concurrency": args.concurrency,
+        "attachments": args.attachments if args.shape == "multipart" else 0,
+        "attachment_size": args.attachment_size if args.shape == "multipart" else 0,
+        "accepted": len(latencies),
+        "errors": len(errors),
+        "accepted_seconds": accepted_seconds,
+        "persisted_seconds": persisted_seconds,
+        "messages_per_second": len(latencies) / accepted_seconds if accepted_seconds else None,
+        "persisted_per_second": len(latencies) / persisted_seconds if persisted_seconds else None,
+        "accept_latency": summarize(latencies),
+    }
+
+
+def fill_mailbox(size, old_fraction, batch=5000):
+    """メールボックスを空にしてからsize件の合成メールを直接DBへ入れる
+
+    old_fractionの割合のメールは保持期間より古い時刻にし、クリーンアップで削除されるようにする。
+    """
+    start.clear_emails_db()
+    now = datetime.datetime.now()
+    old_count = int(size * old_fraction)
+    ids = []
+    with start.db_pool.connection() as conn:
+        c = conn.cursor()
+        for index in range(size):
+            if index < old_count:
+                received = now - datetime.timedelta(days=start.RETENTION_DAYS + 1, seconds=index)
+            else:
+                received = now - datetime.timedelta(seconds=size - index)
+            body = "合成メール %d https://example.com/items/%d" % (index, index)
+            email_data = {
+                "id": str(uuid.uuid4()),
+                "time": received.strftime("%Y-%m-%d %H:%M:%S"),
+                "subject": "mailbox %d" % index,
+                "sender": "bench@example.com",
+                "to": ["qa+%d@example.com" % index],
+                "client_ip": "127.0.0.1",
+                "client_app": "bench_e2e",
+                "body": body,
+                "linked_body": start.convert_urls_to_links(body),
+                "html_body": "",
+                "attachments": [],
+            }
+            start._insert_email(c, email_data, start._schema_for_email(conn, email_data))
+            if index >= old_count:
+                ids.append(email_data["id"])
+            if index % batch == batch - 1:
+                conn.commit()
+        conn.commit()
+    start.mailbox_counter.load()
+    return ids
+
+
+def time_requests(client, paths, repeat):
+    seconds = []
+    for _ in range(repeat):
+        for path in paths:
+            started = time.perf_counter()
+            response = client.get(path)
+            seconds.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                raise RuntimeError("%s returned %d" % (path, response.status_code))
+    return seconds
+
+
+def bench_web(args):
+    """メールボックスのサイズごとにWeb画面・削除・クリーンアップの所要時間を計測する"""
+    client = start.app.test_client()
+    results = []
+    for size in [int(value) for value in args.mailbox_sizes.split(",") if value]:
+        fill_started = time.perf_counter()
+        ids = fill_mailbox(size, args.cleanup_fraction)
+        fill_seconds = time.perf_counter() - fill_started
+
+        page = "/api/emails?draw=1&start=0&length=10&order[0][column]=0&order[0][dir]=desc"
+        deep_page = page.replace("start=0", "start=%d" % max(len(ids) - 10, 0))
+        filtered_page = page + "&search[value]=qa%2B1"
+        result = {
+            "mailbox_size": size,
+            "fill_seconds": fill_seconds,
+            "index": summarize(time_requests(client, ["/"], args.repeat)),
+            "api_emails_first_page": summarize(time_requests(client, [page], args.repeat)),
+            "api_emails_last_page": summarize(time_requests(client, [deep_page], args.repeat)),
+            "api_emails_search": summarize(time_requests(client, [filtered_page], args.repeat)),
+            # /refreshはリダイレクトを返すだけなので、概要インデックスの再読み込み時間になる
+            "refresh": summarize(time_requests(client, ["/refresh"], args.repeat)),
+        }
+
+        rng = random.Random(size)
+        targets = rng.sample(ids, min(args.deletes, len(ids)))
+        result["delete"] = summarize(time_requests(client, ["/delete/%s" % email_id for email_id in targets], 1))
+
+        started = time.perf_counter()
+        removed = start.cleanup_emails_db()
+        result["cleanup"] = {"seconds": time.perf_counter() - started, "removed": removed}
+        results.append(result)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=_repo_root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "STORAGE_MODE": start.STORAGE_MODE,
+            "WRITE_BEHIND": start.WRITE_BEHIND,
+            "WRITE_BATCH_SIZE": start.WRITE_BATCH_SIZE,
+            "DB_DURABILITY": start.DB_DURABILITY,
+            "PARSE_MODE": start.PARSE_MODE,
+            "PARSE_WORKERS": start.PARSE_WORKERS,
+            "RAW_STORE": start.RAW_STORE,
+            "RAW_COMPRESSION": start.RAW_COMPRESSION,
+            "LAZY_PARSE": start.LAZY_PARSE,
+            "SMTP_MAX_CONNECTIONS": start.SMTP_MAX_CONNECTIONS,
+            "SMTP_RATE_LIMIT": start.SMTP_RATE_LIMIT,
+            "INGEST_HIGH_WATER": start.INGEST_HIGH_WATER,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP受信とWeb画面のエンドツーエンド・ベンチマーク")
+    parser.add_argument("--messages", type=int, default=2000, help="送信するメール数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送信するSMTPクライアント数")
+    parser.add_argument("--shape", choices=["plain", "html", "multipart"], default="plain", help="メールの形")
+    parser.add_argument("--attachments", type=int, default=2, help="multipartの添付ファイル数")
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="添付ファイル1つのサイズ（バイト）")
+    parser.add_argument("--port", type=int, default=0, help="SMTPの待ち受けポート（0は空きポート）")
+    parser.add_argument("--mailbox-sizes", default="1000,10000,100000", help="Web計測時のメール件数（カンマ区切り）")
+    parser.add_argument("--cleanup-fraction", type=float, default=0.1, help="クリーンアップ対象にする古いメールの割合")
+    parser.add_argument("--deletes", type=int, default=50, help="計測する削除の回数")
+    parser.add_argument("--repeat", type=int, default=20, help="各ページの計測回数")
+    parser.add_argument("--skip-ingest", action="store_true", help="SMTP受信の計測を省略する")
+    parser.add_argument("--skip-web", action="store_true", help="Web画面の計測を省略する")
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル（省略時は標準出力）")
+    args = parser.parse_args()
+
+    report = {"environment": environment()}
+    if not args.skip_ingest:
+        report["ingest"] = bench_ingest(args)
+    if not args.skip_web:
+        report["web"] = bench_web(args)
+    start.email_writer.close()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print("結果を %s に保存しました" % args.output)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
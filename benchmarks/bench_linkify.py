@@ -0,0 +1,140 @@
+"""本文のURLリンク変換（convert_urls_to_links）のマイクロベンチマーク
+
+使い方：
+    python benchmarks/bench_linkify.py [--sizes 10000,100000,1000000] [--repeat 5] [--json]
+
+URL・IPアドレス・コード片を含む本文を指定サイズで生成し、現在の1パス実装と
+旧来の「保護→変換→復元」実装それぞれのスループットを計測する。
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+# start.pyの読み込み時にカレントディレクトリへDBやログを作らないよう一時ディレクトリを使う
+_workdir = tempfile.mkdtemp(prefix="bench_linkify_")
+os.environ.setdefault("DB_FILE", os.path.join(_workdir, "emails.db"))
+os.environ.setdefault("LOG_DIR", os.path.join(_workdir, "logs"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+import start  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+SAMPLE_LINES = [
+    "ご利用ありがとうございます。詳細は https://example.com/orders/12345?ref=mail をご確認ください。",
+    "サーバー 192.168.10.25:8080/status が応答しません。",
+    "See www.example.co.jp/help for details.",
+    "at com.example.service.OrderService.process(OrderService.java:120)",
+    "import foo.bar.Baz; System.out.println(value)",
+    "パスワード再設定用URL：\nhttps://example.com/reset?token=abcdef0123456789",
+    "target=https://example.com/redirect",
+    "通常のテキスト行です。特にリンクは含まれません。",
+    "ftp://files.example.com/pub/archive.zip からダウンロードできます。",
+]
+
+
+def legacy_convert_urls_to_links(text):
+    """比較用：プレースホルダーで保護してから変換・復元する旧実装"""
+    if re.search(r'<[^>]+>', text):
+        return text
+    protected_patterns = [
+        r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+[a-zA-Z_][a-zA-Z0-9_]*\([^)]*\)',
+        r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+(?:module|class|interface|enum)\b',
+        r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+[A-Z][a-zA-Z0-9_]*(?!\.[0-9])',
+        r'(?:パスワード再設定|password\s+reset).*?URL[：:]\s*\n.*?(?=\n|$)',
+        r'target=.*?(?:\n|$)',
+    ]
+    protected_texts = {}
+    counter = 0
+
+    def protect_match(match):
+        nonlocal counter
+        placeholder = f"__PROTECTED_{counter}__"
+        protected_texts[placeholder] = match.group(0)
+        counter += 1
+        return placeholder
+
+    result = text
+    for pattern in protected_patterns:
+        result = re.sub(pattern, protect_match, result, flags=re.MULTILINE)
+    url_pattern = r'((?:https?|ftp)://[^\s<>"\']+|(?:\d{1,3}\.){3}\d{1,3}(?::\d+)?(?:/[^\s<>"\']*)?|(?:www\.)?[a-zA-Z0-9][a-zA-Z0-9-]*\.[a-zA-Z0-9-]+\.[a-zA-Z]{2,}(?::\d+)?(?:/[^\s<>"\']*)?)'
+
+    def replace_with_link(match):
+        url = match.group(1)
+        if not url.startswith(('http://', 'https://', 'ftp://')):
+            if url.startswith('www.'):
+                url = 'http://' + url
+            elif re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', url):
+                url = 'http://' + url
+        return f'<a href="{url}" target="_blank">{match.group(1)}</a>'
+
+    result = re.sub(url_pattern, replace_with_link, result, flags=re.IGNORECASE)
+    for placeholder, original in protected_texts.items():
+        result = result.replace(placeholder, original)
+    return result
+
+
+def make_body(size, seed=0):
+    """URLやコード片を含む、おおよそsize文字の本文を生成する"""
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        line = rng.choice(SAMPLE_LINES)
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def measure(func, body, repeat):
+    """repeat回実行した中で最も速い1回の秒数を返す"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(body)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert_urls_to_links のスループットを計測する")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="本文サイズ（文字数、カンマ区切り）")
+    parser.add_argument("--repeat", type=int, default=5, help="各サイズの計測回数")
+    parser.add_argument("--skip-legacy", action="store_true", help="旧実装の計測を省略する")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    args = parser.parse_args()
+
+    implementations = [("current", start.convert_urls_to_links)]
+    if not args.skip_legacy:
+        implementations.append(("legacy", legacy_convert_urls_to_links))
+
+    results = []
+    for size in [int(value) for value in args.sizes.split(",") if value]:
+        body = make_body(size)
+        for name, func in implementations:
+            seconds = measure(func, body, args.repeat)
+            results.append({
+                "implementation": name,
+                "chars": len(body),
+                "seconds": seconds,
+                "mb_per_second": len(body.encode("utf-8")) / seconds / 1e6 if seconds else None,
+            })
+
+    if args.json:
+        print(json.dumps({"linkify_version": start.LINKIFY_VERSION, "results": results}, indent=2))
+        return
+    print("%-10s %12s %12s %12s" % ("impl", "chars", "ms", "MB/s"))
+    for result in results:
+        print("%-10s %12d %12.2f %12.2f" % (
+            result["implementation"], result["chars"], result["seconds"] * 1000, result["mb_per_second"] or 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,52 @@
 import sys
+import re
 import platform
 import os
 import logging
 import asyncio
 import time
+import random
+import atexit
 import threading
 import datetime
 import uuid
 import json
+import hashlib
+import zlib
+import lzma
+import shutil
+import binascii
 import sqlite3
+import queue
+import collections
+import concurrent.futures
+import multiprocessing
+import signal
+import socket
+import contextlib
+import functools
+import gzip
+import argparse
+import mailbox
+import zipfile
+import markupsafe
 from aiosmtpd.controller import Controller
-from logging.handlers import TimedRotatingFileHandler
+from aiosmtpd.smtp import SMTP
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from dotenv import load_dotenv
-from flask import Flask, render_template_string, redirect, url_for, send_from_directory
+from flask import Flask, Response, render_template_string, redirect, url_for, send_from_directory, request, jsonify, g
+from werkzeug.http import is_resource_modified
+from werkzeug.serving import make_server
 
-from email.parser import Parser
+# 本番用のWSGIサーバー（requirements.txtに含まれる。インストールされていなければthreadedで起動する）
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+from email.parser import BytesFeedParser, BytesHeaderParser
+from email.message import EmailMessage
+from email.utils import format_datetime, getaddresses, parseaddr, parsedate_to_datetime
 from email import policy
 
 # ----------------------------------------------------------------
@@ -31,94 +63,493 @@ SMTP_SERVER = os.getenv("SMTP_SERVER", "0.0.0.0")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 25))
 SENDER_EMAIL = os.getenv("SENDER_EMAIL", "noreply@example.com")
 LOG_DIR = os.getenv("LOG_DIR", "logs")
+# ログ設定（キュー経由の非同期書き込み、本文の最大文字数（0は出力しない、-1は制限なし）と出力する割合、
+# 1通ごとのアクセスログ（JSON Lines））
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+LOG_BODY_MAX_CHARS = int(os.getenv("LOG_BODY_MAX_CHARS", 1000))
+LOG_BODY_SAMPLE_RATE = float(os.getenv("LOG_BODY_SAMPLE_RATE", 1.0))
+ACCESS_LOG = os.getenv("ACCESS_LOG", "1") == "1"
 DB_FILE = os.getenv("DB_FILE", "emails.db")
 RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 7))
-
-# ログディレクトリが存在しない場合は作成
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "attachments")
+# 容量の上限（DBの使用量・添付ファイルの合計サイズ・生データの合計サイズ（バイト）・メール件数、0は無制限）。
+# 超えた場合はQUOTA_CHECK_SECONDS秒ごとの確認で古いメールからEVICT_BATCH_SIZE件ずつ削除する
+QUOTA_MAX_DB_BYTES = int(os.getenv("QUOTA_MAX_DB_BYTES", 0))
+QUOTA_MAX_ATTACHMENT_BYTES = int(os.getenv("QUOTA_MAX_ATTACHMENT_BYTES", 0))
+QUOTA_MAX_RAW_BYTES = int(os.getenv("QUOTA_MAX_RAW_BYTES", 0))
+QUOTA_MAX_EMAILS = int(os.getenv("QUOTA_MAX_EMAILS", 0))
+QUOTA_CHECK_SECONDS = max(int(os.getenv("QUOTA_CHECK_SECONDS", 30)), 1)
+EVICT_BATCH_SIZE = max(int(os.getenv("EVICT_BATCH_SIZE", 100)), 1)
+# 削除で空いたページをファイルから返す設定（incremental / none）と、1回のincremental_vacuumで返すページ数
+DB_AUTO_VACUUM = os.getenv("DB_AUTO_VACUUM", "incremental").lower()
+VACUUM_STEP_PAGES = max(int(os.getenv("VACUUM_STEP_PAGES", 256)), 1)
+# ストレージモード（single：1つのDBファイル、partitioned：PARTITION_DAYS日ごとのDBファイルに分割）
+STORAGE_MODE = os.getenv("STORAGE_MODE", "single").lower()
+PARTITIONED = STORAGE_MODE == "partitioned"
+PARTITION_DAYS = max(int(os.getenv("PARTITION_DAYS", 1)), 1)
+PARTITION_DIR = os.getenv("PARTITION_DIR", os.path.splitext(DB_FILE)[0] + "_partitions")
+# この大きさ（エンコード後のバイト数）を超える添付ファイルは、解析中に分割してディスクへ書き出す
+ATTACHMENT_SPILL_THRESHOLD = int(os.getenv("ATTACHMENT_SPILL_THRESHOLD", 1024 * 1024))
+# 受信した生データ（.eml）の保存設定（圧縮方式 zlib / lzma / none、圧縮レベル、セグメントファイルの最大サイズ）
+RAW_STORE = os.getenv("RAW_STORE", "1") == "1"
+RAW_DIR = os.getenv("RAW_DIR", "raw")
+RAW_COMPRESSION = os.getenv("RAW_COMPRESSION", "zlib").lower()
+RAW_COMPRESSION_LEVEL = int(os.getenv("RAW_COMPRESSION_LEVEL", 6))
+RAW_SEGMENT_SIZE = int(os.getenv("RAW_SEGMENT_SIZE", 64 * 1024 * 1024))
+# 受信時はヘッダーだけを解析し、本文・HTML・添付ファイルは表示時に生データから取り出す
+LAZY_PARSE = os.getenv("LAZY_PARSE", "0") == "1"
+# 書き込み設定（write-behindキューのバッチサイズ・間隔、永続性モード）
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 100))
+WRITE_BATCH_INTERVAL_MS = int(os.getenv("WRITE_BATCH_INTERVAL_MS", 50))
+DB_DURABILITY = os.getenv("DB_DURABILITY", "normal").lower()
+# SQLite接続の設定（接続プール、ジャーナル、キャッシュ、mmap、ロック待ち時間、ステートメントキャッシュ）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "wal").lower()
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 16384))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))
+# メール解析の実行モード（inline：イベントループ上、thread／process：ワーカープール）と同時実行数
+PARSE_MODE = os.getenv("PARSE_MODE", "thread").lower()
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 0)) or (os.cpu_count() or 1)
+# SMTP受信プロセス数（2以上の場合、SO_REUSEPORTで同じポートを共有するワーカープロセスを起動する）
+SMTP_WORKERS = max(int(os.getenv("SMTP_WORKERS", 1)), 1)
+# SMTPの負荷制御（同時接続数、1通の最大サイズ、送信元IPごとの1分あたりの受信数、受信の滞留上限）
+SMTP_MAX_CONNECTIONS = int(os.getenv("SMTP_MAX_CONNECTIONS", 100))
+SMTP_MAX_MESSAGE_SIZE = int(os.getenv("SMTP_MAX_MESSAGE_SIZE", 32 * 1024 * 1024))
+SMTP_RATE_LIMIT = int(os.getenv("SMTP_RATE_LIMIT", 0))
+SMTP_RATE_BURST = int(os.getenv("SMTP_RATE_BURST", 0)) or max(SMTP_RATE_LIMIT, 1)
+INGEST_HIGH_WATER = int(os.getenv("INGEST_HIGH_WATER", 2000))
+# メール詳細（/api/emails/<id>）のキャッシュ件数と、一覧に含める本文の最大文字数（全文は詳細から読み込む）
+DETAIL_CACHE_SIZE = int(os.getenv("DETAIL_CACHE_SIZE", 100))
+LIST_BODY_PREVIEW = int(os.getenv("LIST_BODY_PREVIEW", 300))
+# Web画面へのイベント配信（再接続用に保持する件数、クライアントごとの未送信上限、keepalive間隔、本文の最大文字数）
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", 1000))
+EVENT_CLIENT_QUEUE_SIZE = int(os.getenv("EVENT_CLIENT_QUEUE_SIZE", 100))
+EVENT_KEEPALIVE_SECONDS = int(os.getenv("EVENT_KEEPALIVE_SECONDS", 15))
+EVENT_BODY_PREVIEW = int(os.getenv("EVENT_BODY_PREVIEW", 2000))
+# /api/waitの設定（待ち合わせに使う直近のメール数、同時に待機できる数、最大待機秒数）
+WAIT_RECENT_SIZE = int(os.getenv("WAIT_RECENT_SIZE", 100))
+WAIT_MAX_WAITERS = int(os.getenv("WAIT_MAX_WAITERS", 1000))
+WAIT_MAX_TIMEOUT = int(os.getenv("WAIT_MAX_TIMEOUT", 300))
+# 処理時間・件数などの計測（/metrics）を有効にするか
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Webサーバーの設定（待ち受けアドレス・ポート、サーバーの種類、waitressのワーカースレッド数と最大接続数）
+# waitress（既定）：waitressのスレッドプールで処理、threaded：Werkzeugの開発用サーバーで接続ごとにスレッドを起動
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", 5000))
+WEB_SERVER = os.getenv("WEB_SERVER", "waitress" if waitress is not None else "threaded").lower()
+WEB_THREADS = max(int(os.getenv("WEB_THREADS", 16)), 1)
+WEB_CONNECTION_LIMIT = int(os.getenv("WEB_CONNECTION_LIMIT", 1000))
+# Webレスポンスのgzip圧縮（この大きさ未満は圧縮しない、0で無効）と圧縮レベル
+HTTP_GZIP_MIN_SIZE = int(os.getenv("HTTP_GZIP_MIN_SIZE", 1024))
+HTTP_GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", 6))
+# 添付ファイル・生データ（.eml）のダウンロードをブラウザ・プロキシにキャッシュさせる秒数
+DOWNLOAD_CACHE_MAX_AGE = int(os.getenv("DOWNLOAD_CACHE_MAX_AGE", 365 * 24 * 3600))
 
 # ログシステムの設定、ログファイルは日次でローテーション、エンコーディングはutf-8で文字化けを防止
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-
-log_file = os.path.join(LOG_DIR, "smtp_server.log")
-file_handler = TimedRotatingFileHandler(
-    log_file, when="midnight", interval=1, backupCount=30, encoding='utf-8'
-)
-file_handler.suffix = "%Y-%m-%d"
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
-# コンソールログハンドラー
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+# アクセスログ（受信したメール1通ごとにJSONを1行、通常のログとは別ファイル）
+access_logger = logging.getLogger("access")
+access_logger.setLevel(logging.INFO)
+access_logger.propagate = False
+
+def attach_log_handlers(target, *handlers):
+    """ロガーにハンドラーを登録する
+
+    LOG_ASYNCの場合はキューに積むだけのQueueHandlerを登録し、ファイル・コンソールへの
+    書き込みは専用のリスナースレッドが行う（SMTPのイベントループがディスクI/Oで止まらない）。
+    リスナーは終了時に残りを書き出してから停止する。
+    """
+    if not LOG_ASYNC:
+        for handler in handlers:
+            target.addHandler(handler)
+        return
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    target.addHandler(QueueHandler(log_queue))
+
+def setup_logging(worker_log_queue=None):
+    """ログの出力先を設定する
+
+    ログファイルを開くのは親プロセスだけにする。SMTPワーカープロセスはworker_log_queueへ
+    ログレコードを送り、親プロセスのforward_worker_logsが同じファイルへ書き込む
+    （複数のプロセスが同じファイルを日次ローテーションすると互いのファイルを上書きするため）。
+    """
+    if worker_log_queue is not None:
+        logger.addHandler(QueueHandler(worker_log_queue))
+        if ACCESS_LOG:
+            access_logger.addHandler(QueueHandler(worker_log_queue))
+        return
+
+    # ログディレクトリが存在しない場合は作成
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = TimedRotatingFileHandler(
+        os.path.join(LOG_DIR, "smtp_server.log"), when="midnight", interval=1, backupCount=30, encoding='utf-8'
+    )
+    file_handler.suffix = "%Y-%m-%d"
+    file_handler.setFormatter(formatter)
+
+    # コンソールログハンドラー
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(formatter)
+    attach_log_handlers(logger, file_handler, console_handler)
+
+    if ACCESS_LOG:
+        access_handler = TimedRotatingFileHandler(
+            os.path.join(LOG_DIR, "access.log"), when="midnight", interval=1, backupCount=30, encoding='utf-8'
+        )
+        access_handler.suffix = "%Y-%m-%d"
+        access_handler.setFormatter(logging.Formatter('%(message)s'))
+        attach_log_handlers(access_logger, access_handler)
+
+class _WorkerLogHandler(logging.Handler):
+    """ワーカープロセスから届いたログレコードを、親プロセスの同じ名前のロガーで出力する"""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+def forward_worker_logs(worker_log_queue):
+    """ワーカープロセスのログを親プロセスのログファイルへ書き込むリスナーを起動する"""
+    listener = QueueListener(worker_log_queue, _WorkerLogHandler())
+    listener.start()
+    return listener
+
+# 設定値の警告はログの出力先を設定した後でlog_settingsが出力する
+_settings_warnings = []
+
+def _warn_setting(message, *args):
+    _settings_warnings.append((message, args))
+
+# 対応していない設定値は使える値に置き換える
+if DB_AUTO_VACUUM not in ("incremental", "none"):
+    _warn_setting("DB_AUTO_VACUUM=%sには対応していないため、incrementalを使用します", DB_AUTO_VACUUM)
+    DB_AUTO_VACUUM = "incremental"
+if LAZY_PARSE and not RAW_STORE:
+    _warn_setting("LAZY_PARSEには生データの保存（RAW_STORE=1）が必要なため、受信時にすべて解析します")
+    LAZY_PARSE = False
+if SMTP_WORKERS > 1 and not hasattr(socket, "SO_REUSEPORT"):
+    _warn_setting("このプラットフォームはSO_REUSEPORTに対応していないため、SMTP_WORKERS=%dを無視して単一プロセスで受信します", SMTP_WORKERS)
+    SMTP_WORKERS = 1
+if WEB_SERVER not in ("threaded", "waitress"):
+    _warn_setting("WEB_SERVER=%sには対応していないため、%sで起動します",
+                  WEB_SERVER, "waitress" if waitress is not None else "threaded")
+    WEB_SERVER = "waitress" if waitress is not None else "threaded"
+if WEB_SERVER == "waitress" and waitress is None:
+    _warn_setting("waitressがインストールされていないため、Werkzeugの開発用サーバー（threaded）で起動します"
+                  "（pip install -r requirements.txt）")
+    WEB_SERVER = "threaded"
+
+def log_settings():
+    """起動時の設定と、置き換えた設定値の警告を出力する"""
+    logger.info("SMTPサーバーを初期化中...")
+    for message, args in _settings_warnings:
+        logger.warning(message, *args)
+    logger.info("設定：SMTP_SERVER=%s, SMTP_PORT=%s, SENDER_EMAIL=%s", SMTP_SERVER, SMTP_PORT, SENDER_EMAIL)
+    logger.info("永続化設定：DB_FILE=%s, 保持日数=%d", DB_FILE, RETENTION_DAYS)
+    logger.info("容量制限：DB=%s, 添付ファイル=%s, 生データ=%s, 件数=%s, 削除単位=%d件, auto_vacuum=%s",
+                QUOTA_MAX_DB_BYTES or "無制限", QUOTA_MAX_ATTACHMENT_BYTES or "無制限", QUOTA_MAX_RAW_BYTES or "無制限",
+                QUOTA_MAX_EMAILS or "無制限",
+                EVICT_BATCH_SIZE, "%s（%dページずつ）" % (DB_AUTO_VACUUM, VACUUM_STEP_PAGES)
+                if DB_AUTO_VACUUM == "incremental" else DB_AUTO_VACUUM)
+    logger.info("ログ設定：非同期=%s, 本文=%s, アクセスログ=%s", LOG_ASYNC,
+                "出力しない" if LOG_BODY_MAX_CHARS == 0 else "%s（%d%%）" % (
+                    "%d文字まで" % LOG_BODY_MAX_CHARS if LOG_BODY_MAX_CHARS > 0 else "制限なし", LOG_BODY_SAMPLE_RATE * 100),
+                os.path.join(LOG_DIR, "access.log") if ACCESS_LOG else "無効")
+    if PARTITIONED:
+        logger.info("パーティション設定：PARTITION_DIR=%s, PARTITION_DAYS=%d", PARTITION_DIR, PARTITION_DAYS)
+        # SQLiteの既定ではATTACHできるDBは10個まで（SQLITE_MAX_ATTACHED）
+        if RETENTION_DAYS // PARTITION_DAYS + 2 > 10:
+            logger.warning("保持期間に対してパーティションが多すぎます。PARTITION_DAYSを増やしてください（最大10パーティション）")
+    logger.info("書き込み設定：WRITE_BEHIND=%s, バッチ=%d件/%dms, 永続性=%s",
+                WRITE_BEHIND, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL_MS, DB_DURABILITY)
+    logger.info("SMTP負荷制御：最大接続数=%d, 最大サイズ=%d, IPごとの受信数=%s, 滞留上限=%d",
+                SMTP_MAX_CONNECTIONS, SMTP_MAX_MESSAGE_SIZE,
+                "%d通/分（バースト%d）" % (SMTP_RATE_LIMIT, SMTP_RATE_BURST) if SMTP_RATE_LIMIT else "無制限", INGEST_HIGH_WATER)
+    logger.info("DB接続設定：プール=%d, journal_mode=%s, cache_size=%dKB, mmap_size=%d, busy_timeout=%dms",
+                DB_POOL_SIZE, DB_JOURNAL_MODE, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_BUSY_TIMEOUT_MS)
+    logger.info("解析設定：PARSE_MODE=%s, PARSE_WORKERS=%d", PARSE_MODE, PARSE_WORKERS)
+    logger.info("一覧設定：詳細キャッシュ=%d件, 一覧の本文=%d文字まで", DETAIL_CACHE_SIZE, LIST_BODY_PREVIEW)
+    logger.info("生データ保存：%s, 遅延解析：%s",
+                "%s（%s, レベル%d）" % (RAW_DIR, RAW_COMPRESSION, RAW_COMPRESSION_LEVEL) if RAW_STORE else "無効",
+                "有効" if LAZY_PARSE else "無効")
+    logger.info("メトリクス：%s", "有効（/metrics）" if METRICS_ENABLED else "無効")
+    logger.info("Webサーバー設定：%s:%d, サーバー=%s", WEB_HOST, WEB_PORT,
+                "waitress（スレッド数=%d, 最大接続数=%d）" % (WEB_THREADS, WEB_CONNECTION_LIMIT)
+                if WEB_SERVER == "waitress" else "threaded")
+    logger.info("Web応答設定：gzip=%s, ダウンロードのキャッシュ期間=%d秒",
+                "%dバイト以上（レベル%d）" % (HTTP_GZIP_MIN_SIZE, HTTP_GZIP_LEVEL) if HTTP_GZIP_MIN_SIZE > 0 else "無効",
+                DOWNLOAD_CACHE_MAX_AGE)
+
+# ----------------------------------------------------------------
+# メトリクス（Prometheusのテキスト形式で/metricsから公開）
+# ----------------------------------------------------------------
+# 処理時間ヒストグラムの既定のバケット（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for name, value in pairs)
+
+class Metric:
+    """メトリクスの共通部分（METRICS_ENABLEDが無効な場合、記録は何もしない）"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._remote = {}  # SMTPワーカーごとの最新の値（親プロセスで出力時に合算する）
+        self._lock = threading.Lock()
+
+    def _copy_values(self):
+        return dict(self._values)
+
+    def _combine(self, value, other):
+        return value + other
+
+    def snapshot(self):
+        """現在の値のコピー（SMTPワーカーから親プロセスへ送る）"""
+        with self._lock:
+            return self._copy_values()
+
+    def set_remote(self, source, values):
+        """SMTPワーカーsourceから届いた値を記録する（前回届いた値は置き換える）"""
+        with self._lock:
+            self._remote[source] = values
+
+    def _merged_items(self):
+        with self._lock:
+            merged = self._copy_values()
+            for values in self._remote.values():
+                for labels, value in values.items():
+                    merged[labels] = self._combine(merged[labels], value) if labels in merged else value
+        return sorted(merged.items())
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for labels, value in self._merged_items():
+            lines.append("%s%s %s" % (self.name, _format_labels(self.label_names, labels), _format_value(value)))
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """現在値を保持するメトリクス（funcを渡した場合は出力のたびにその戻り値を使う）"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        super().__init__(name, help_text, labels)
+        self.func = func
+
+    def set(self, value, labels=()):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def render(self):
+        if self.func is not None:
+            try:
+                self._values[()] = self.func()
+            except Exception as e:
+                logger.warning("メトリクス %s を取得できません: %s", self.name, str(e))
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # バケットごとの件数（最後は+Inf）、合計、件数
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = 0
+            while index < len(self.buckets) and value > self.buckets[index]:
+                index += 1
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, labels=()):
+        """withブロックの実行時間（秒）を記録する"""
+        if not METRICS_ENABLED:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def _copy_values(self):
+        return {labels: [list(state[0]), state[1], state[2]] for labels, state in self._values.items()}
+
+    def _combine(self, value, other):
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1], value[2] + other[2]]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for labels, (counts, total, count) in self._merged_items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.label_names, labels, [("le", le)]), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(self.label_names, labels), _format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.label_names, labels), count))
+        return lines
 
-logger.info("SMTPサーバーを初期化中...")
-logger.info("設定：SMTP_SERVER=%s, SMTP_PORT=%s, SENDER_EMAIL=%s", SMTP_SERVER, SMTP_PORT, SENDER_EMAIL)
-logger.info("永続化設定：DB_FILE=%s, 保持日数=%d", DB_FILE, RETENTION_DAYS)
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), func=None):
+        return self._register(Gauge(name, help_text, labels, func))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """記録した値のコピー（出力時に計算するゲージを除く）"""
+        return {metric.name: metric.snapshot() for metric in self._metrics if getattr(metric, "func", None) is None}
+
+    def set_remote(self, source, snapshot):
+        """SMTPワーカーのsnapshot()を記録し、以降の出力に合算する"""
+        for metric in self._metrics:
+            if metric.name in snapshot:
+                metric.set_remote(source, snapshot[metric.name])
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+metrics = MetricsRegistry()
+SMTP_ACTIVE_SESSIONS = metrics.gauge("smtp_active_sessions", "Number of open SMTP connections")
+SMTP_SESSIONS_TOTAL = metrics.counter("smtp_sessions_total", "SMTP connections accepted")
+SMTP_MESSAGES_TOTAL = metrics.counter("smtp_messages_total", "Messages handled by handle_DATA", ("result",))
+SMTP_DEFERRED_TOTAL = metrics.counter("smtp_deferred_total", "Connections or transactions refused with a 4xx reply", ("reason",))
+SMTP_INGEST_BACKLOG = metrics.gauge("smtp_ingest_backlog", "Messages being parsed or waiting to be written")
+SMTP_RECEIVED_BYTES = metrics.counter("smtp_received_bytes_total", "Raw message bytes received")
+SMTP_ATTACHMENT_BYTES = metrics.counter("smtp_attachment_bytes_total", "Decoded attachment bytes stored")
+SMTP_RAW_STORED_BYTES = metrics.counter("smtp_raw_stored_bytes_total", "Compressed raw message bytes appended to segments")
+SMTP_PARSE_SECONDS = metrics.histogram("smtp_parse_seconds", "MIME parse and attachment write time per message")
+SMTP_HANDLE_SECONDS = metrics.histogram("smtp_handle_data_seconds", "Total handle_DATA time per message")
+DB_INSERT_SECONDS = metrics.histogram("db_insert_seconds", "Time spent executing INSERTs per transaction")
+DB_COMMIT_SECONDS = metrics.histogram("db_commit_seconds", "Time spent in COMMIT per transaction")
+DB_BATCH_SIZE = metrics.histogram("db_write_batch_size", "Messages written per transaction",
+                                  buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+DB_WRITE_ERRORS = metrics.counter("db_write_errors_total", "Messages that could not be stored")
+CLEANUP_SECONDS = metrics.histogram("cleanup_seconds", "Retention cleanup duration",
+                                    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+CLEANUP_REMOVED = metrics.counter("cleanup_removed_total", "Messages removed by retention cleanup")
+QUOTA_EVICTED = metrics.counter("quota_evicted_total", "Messages evicted to stay within the storage quotas")
+STORAGE_USAGE = metrics.gauge("storage_usage", "Storage usage measured by the last quota check", ("resource",))
+DB_VACUUM_PAGES = metrics.counter("db_incremental_vacuum_pages_total", "Free pages returned to the filesystem")
+HTTP_REQUEST_SECONDS = metrics.histogram("http_request_seconds", "Web request handling time", ("endpoint",))
+HTTP_REQUESTS_TOTAL = metrics.counter("http_requests_total", "Web requests", ("endpoint", "status"))
+ATTACHMENT_FILES_REMOVED = metrics.counter("attachment_files_removed_total", "Attachment files unlinked by the reaper")
+DETAIL_CACHE_REQUESTS = metrics.counter("detail_cache_requests_total", "Message detail lookups", ("result",))
 
 # ----------------------------------------------------------------
 # URL转换功能
 # ----------------------------------------------------------------
+# 链接转换规则的版本号，修改规则时递增，使缓存的转换结果失效
+LINKIFY_VERSION = 2
+
+# 保护模式：匹配到的文本原样输出，不转换为链接
+_PROTECTED_PATTERNS = [
+    # 编程语言命名空间
+    r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+[a-zA-Z_][a-zA-Z0-9_]*\([^)]*\)',  # 函数调用
+    r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+(?:module|class|interface|enum)\b',  # 模块/类/接口定义
+    r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+[A-Z][a-zA-Z0-9_]*(?!\.[0-9])',    # 类引用
+
+    # 特殊URL模式（如密码重置链接）
+    r'(?:パスワード再設定|password\s+reset).*?URL[：:]\s*\n.*?(?=\n|$)',  # 密码重置URL整行
+    r'target=.*?(?:\n|$)',                                              # target参数行
+]
+
+# 简化的URL匹配模式
+_URL_PATTERN = r'(?:https?|ftp)://[^\s<>"\']+|(?:\d{1,3}\.){3}\d{1,3}(?::\d+)?(?:/[^\s<>"\']*)?|(?:www\.)?[a-zA-Z0-9][a-zA-Z0-9-]*\.[a-zA-Z0-9-]+\.[a-zA-Z]{2,}(?::\d+)?(?:/[^\s<>"\']*)?'
+
+# 将保护模式和URL模式合并为一个正则，一次扫描完成保护、转换和恢复。
+# 同一位置上保护模式优先于URL模式，只有URL模式忽略大小写。
+_LINKIFY_RE = re.compile(
+    "|".join("(?:%s)" % pattern for pattern in _PROTECTED_PATTERNS) + "|(?P<url>(?i:%s))" % _URL_PATTERN,
+    re.MULTILINE
+)
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+_IP_PREFIX_RE = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+
+def _linkify_match(match):
+    text = match.group(0)
+    if match.group('url') is None:
+        # 保护的文本原样保留
+        return text
+    url = text
+    if not url.startswith(('http://', 'https://', 'ftp://')):
+        if url.startswith('www.'):
+            url = 'http://' + url
+        elif _IP_PREFIX_RE.match(url):
+            url = 'http://' + url
+    return f'<a href="{url}" target="_blank">{text}</a>'
+
 def convert_urls_to_links(text):
     """将文本中的URL、IP地址和带端口的地址转换为可点击的链接"""
-    import re
-    
     # 首先检查是否已经包含HTML标签
-    if re.search(r'<[^>]+>', text):
+    if _HTML_TAG_RE.search(text):
         return text
-    
-    # 首先识别并保护编程语言的命名空间和特殊URL
-    protected_patterns = [
-        # 编程语言命名空间
-        r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+[a-zA-Z_][a-zA-Z0-9_]*\([^)]*\)',  # 函数调用
-        r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+(?:module|class|interface|enum)\b',  # 模块/类/接口定义
-        r'(?:[a-zA-Z_][a-zA-Z0-9_]*\.)+[A-Z][a-zA-Z0-9_]*(?!\.[0-9])',    # 类引用
-        
-        # 特殊URL模式（如密码重置链接）
-        r'(?:パスワード再設定|password\s+reset).*?URL[：:]\s*\n.*?(?=\n|$)',  # 密码重置URL整行
-        r'target=.*?(?:\n|$)',                                              # target参数行
-    ]
-    
-    # 保护文本，将匹配项临时替换为占位符
-    protected_texts = {}
-    counter = 0
-    
-    def protect_match(match):
-        nonlocal counter
-        placeholder = f"__PROTECTED_{counter}__"
-        protected_texts[placeholder] = match.group(0)
-        counter += 1
-        return placeholder
-    
-    # 保护所有匹配到的文本
-    result = text
-    for pattern in protected_patterns:
-        result = re.sub(pattern, protect_match, result, flags=re.MULTILINE)
-    
-    # 简化的URL匹配模式
-    url_pattern = r'((?:https?|ftp)://[^\s<>"\']+|(?:\d{1,3}\.){3}\d{1,3}(?::\d+)?(?:/[^\s<>"\']*)?|(?:www\.)?[a-zA-Z0-9][a-zA-Z0-9-]*\.[a-zA-Z0-9-]+\.[a-zA-Z]{2,}(?::\d+)?(?:/[^\s<>"\']*)?)'
-    
-    def replace_with_link(match):
-        url = match.group(1)
-        if not url.startswith(('http://', 'https://', 'ftp://')):
-            if url.startswith('www.'):
-                url = 'http://' + url
-            elif re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', url):
-                url = 'http://' + url
-        return f'<a href="{url}" target="_blank">{match.group(1)}</a>'
-    
-    # 转换URL为链接
-    result = re.sub(url_pattern, replace_with_link, result, flags=re.IGNORECASE)
-    
-    # 恢复被保护的文本
-    for placeholder, original in protected_texts.items():
-        result = result.replace(placeholder, original)
-    
-    return result
+    return _LINKIFY_RE.sub(_linkify_match, text)
 
 def clean_content(text):
     """清理文本内容，去除多余的空行和空格"""
@@ -155,12 +586,461 @@ def clean_content(text):
     
     return "\n".join(result)
 
+# ----------------------------------------------------------------
+# 添付ファイルストア（内容のハッシュで名前を付け、同一内容は1つだけ保存）
+# ----------------------------------------------------------------
+# 参照カウントが0になった直後のファイルは、書き込み待ちのメールが再利用する可能性があるため
+# この秒数以内に更新されたものは削除しない
+BLOB_GRACE_SECONDS = 300
+
+def blob_relative_path(digest, prefix=None):
+    """ハッシュ値から添付ファイルの保存パス（ATTACHMENT_DIRからの相対パス）を作る
+
+    パーティションモードではprefixにパーティション名を指定し、パーティションごとのディレクトリに分ける。
+    """
+    parts = [digest[:2], digest[2:4], digest]
+    return "/".join([prefix] + parts if prefix else parts)
+
+def store_attachment_blob(data, prefix=None):
+    """添付ファイルの内容をハッシュ名で保存し、(ハッシュ値, サイズ, 相対パス)を返す
+
+    同じ内容のファイルが既にあれば書き込みを省略する。
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    saved_name = blob_relative_path(digest, prefix)
+    file_path = os.path.join(ATTACHMENT_DIR, saved_name)
+    if os.path.exists(file_path):
+        # 再利用されたことを記録し、削除の猶予期間を延ばす
+        os.utime(file_path)
+    else:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = "%s.%s.tmp" % (file_path, uuid.uuid4().hex)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+    return digest, len(data), saved_name
+
+def store_attachment_chunks(chunks, prefix=None):
+    """分割された添付ファイルの内容を一時ファイルに書きながらハッシュを計算し、ストアへ移動する
+
+    内容全体をメモリ上に持たないため、大きな添付ファイルでもメモリ使用量が一定になる。
+    """
+    tmp_dir = os.path.join(ATTACHMENT_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+        saved_name = blob_relative_path(digest, prefix)
+        file_path = os.path.join(ATTACHMENT_DIR, saved_name)
+        if os.path.exists(file_path):
+            os.utime(file_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest, size, saved_name
+
+def _acquire_attachments(c, attachments, schema="main"):
+    """添付ファイルの参照カウントを増やす"""
+    for attachment in attachments:
+        if attachment.get("sha256"):
+            c.execute("""
+                INSERT INTO %s.attachment_blobs (hash, size, refcount) VALUES (?, ?, 1)
+                ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+            """ % schema, (attachment["sha256"], attachment.get("size", 0)))
+
+def _release_attachments(c, attachments, schema="main"):
+    """添付ファイルの参照カウントを減らし、参照がなくなったファイルのパスを返す
+
+    ファイルの削除はトランザクションのコミット後にremove_attachment_filesで行う。
+    """
+    unreferenced = []
+    for attachment in attachments:
+        if 'saved_name' not in attachment:
+            continue
+        digest = attachment.get("sha256")
+        if not digest:
+            # 旧形式（UUID_ファイル名）の添付ファイルはメールごとに固有
+            unreferenced.append(attachment['saved_name'])
+            continue
+        c.execute("UPDATE %s.attachment_blobs SET refcount = refcount - 1 WHERE hash=?" % schema, (digest,))
+        c.execute("SELECT refcount FROM %s.attachment_blobs WHERE hash=?" % schema, (digest,))
+        row = c.fetchone()
+        if row is None or row[0] <= 0:
+            c.execute("DELETE FROM %s.attachment_blobs WHERE hash=?" % schema, (digest,))
+            unreferenced.append(attachment['saved_name'])
+    return unreferenced
+
+def remove_attachment_files(saved_names):
+    """参照されなくなった添付ファイルの削除を依頼する（削除はattachment_reaperのスレッドで行う）"""
+    if saved_names:
+        attachment_reaper.submit(saved_names)
+
+# ハッシュ名のストアのディレクトリ（ハッシュ先頭2文字）とファイル名
+_BLOB_DIR_RE = re.compile(r'^[0-9a-f]{2}$')
+_BLOB_NAME_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class AttachmentReaper:
+    """参照がなくなった添付ファイルを専用スレッドで削除する
+
+    削除・クリーンアップはファイルの削除を待たずに戻る。request_sweepが呼ばれると、どのメールからも
+    参照されていないファイル（全削除の後に残ったものや、遅延解析で書き出されたが保存されなかったもの）を
+    ディレクトリから探して削除する。猶予期間内のため残したファイルがあれば、猶予期間後にもう一度探す。
+    終了時に削除しきれなかったファイルは、次回起動時の探索で削除される。
+    """
+    _SWEEP = object()
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._retry = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="attachment-reaper", daemon=True)
+                self._thread.start()
+
+    def submit(self, saved_names):
+        """削除するファイル（ATTACHMENT_DIRからの相対パス）をキューに追加する（すぐに戻る）"""
+        if self._thread is None:
+            self.start()
+        self._queue.put(list(saved_names))
+
+    def request_sweep(self):
+        """参照されていないファイルの探索を依頼する"""
+        if self._thread is None:
+            self.start()
+        self._queue.put(self._SWEEP)
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self):
+        """キューに積まれた削除・探索がすべて終わるまで待つ"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def sweep(self):
+        """どのメールからも参照されていない添付ファイルを削除し、削除した数を返す
+
+        参照カウント表のハッシュをスキーマ（パーティション）ごとに読み、対応するディレクトリの
+        ハッシュ名のファイルだけを調べる（tmpや旧形式のファイルには触れない）。
+        """
+        with db_pool.connection() as conn:
+            referenced = {}
+            for schema in db_schemas(conn):
+                referenced[schema_partition(schema)] = {
+                    row[0] for row in conn.execute("SELECT hash FROM %s.attachment_blobs" % schema)}
+        removed = 0
+        deferred = 0
+        now = time.time()
+        for prefix, hashes in referenced.items():
+            root = os.path.join(ATTACHMENT_DIR, prefix) if prefix else ATTACHMENT_DIR
+            if not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                if not _BLOB_DIR_RE.match(name):
+                    continue
+                for dirpath, _, filenames in os.walk(os.path.join(root, name)):
+                    for filename in filenames:
+                        if not _BLOB_NAME_RE.match(filename) or filename in hashes:
+                            continue
+                        file_path = os.path.join(dirpath, filename)
+                        try:
+                            if now - os.path.getmtime(file_path) < BLOB_GRACE_SECONDS:
+                                # 書き込み待ちのメールが参照する可能性があるため残す
+                                deferred += 1
+                                continue
+                            os.remove(file_path)
+                            removed += 1
+                        except FileNotFoundError:
+                            pass
+                        except OSError as e:
+                            logger.error("删除附件文件时出错: %s", str(e))
+        ATTACHMENT_FILES_REMOVED.inc(removed)
+        if removed:
+            logger.info("参照されていない添付ファイルを%d個削除しました", removed)
+        if deferred:
+            self._schedule_retry()
+        return removed
+
+    def _remove(self, saved_names):
+        now = time.time()
+        removed = 0
+        deferred = 0
+        for saved_name in saved_names:
+            file_path = os.path.join(ATTACHMENT_DIR, saved_name)
+            try:
+                if "/" in saved_name and now - os.path.getmtime(file_path) < BLOB_GRACE_SECONDS:
+                    # 直前に同じ内容が受信されている可能性があるため残す
+                    deferred += 1
+                    continue
+                os.remove(file_path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("删除附件文件时出错: %s", str(e))
+        ATTACHMENT_FILES_REMOVED.inc(removed)
+        if removed:
+            logger.info("添付ファイルを%d個削除しました", removed)
+        if deferred:
+            self._schedule_retry()
+
+    def _schedule_retry(self):
+        """猶予期間が過ぎた後に探索を1回だけ予約する"""
+        with self._lock:
+            if self._retry is None or not self._retry.is_alive():
+                self._retry = threading.Timer(BLOB_GRACE_SECONDS, self.request_sweep)
+                self._retry.daemon = True
+                self._retry.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._SWEEP:
+                    self.sweep()
+                else:
+                    self._remove(item)
+            except Exception as e:
+                logger.error("添付ファイルの削除中にエラーが発生しました: %s", str(e))
+            finally:
+                self._queue.task_done()
+
+def _load_attachments_json(value):
+    if not value:
+        return []
+    try:
+        return json.loads(value)
+    except Exception as e:
+        return []
+
+def migrate_attachment_store(c):
+    """旧形式（UUID_ファイル名）で保存された添付ファイルをハッシュ名のストアに移行する"""
+    c.execute("""
+        SELECT id, attachments FROM emails
+        WHERE json_valid(attachments) AND EXISTS (
+            SELECT 1 FROM json_each(emails.attachments)
+            WHERE json_extract(value, '$.saved_name') IS NOT NULL
+              AND json_extract(value, '$.sha256') IS NULL)
+    """)
+    rows = c.fetchall()
+    migrated = 0
+    for email_id, attachments_json in rows:
+        attachments = _load_attachments_json(attachments_json)
+        for attachment in attachments:
+            if 'saved_name' not in attachment or attachment.get("sha256"):
+                continue
+            legacy_path = os.path.join(ATTACHMENT_DIR, attachment['saved_name'])
+            if not os.path.exists(legacy_path):
+                continue
+            with open(legacy_path, "rb") as f:
+                digest, size, saved_name = store_attachment_blob(f.read())
+            os.remove(legacy_path)
+            attachment.update({"saved_name": saved_name, "sha256": digest, "size": size})
+            _acquire_attachments(c, [attachment])
+            migrated += 1
+        c.execute("UPDATE emails SET attachments=? WHERE id=?", (json.dumps(attachments), email_id))
+    if migrated:
+        logger.info("添付ファイル%d件をハッシュ名のストアに移行しました", migrated)
+
+# ----------------------------------------------------------------
+# 生データストア（受信したメールをそのまま圧縮し、追記専用のセグメントファイルに保存）
+# ----------------------------------------------------------------
+def compress_raw(content):
+    """生データを圧縮し、先頭に圧縮方式を表す1バイトを付ける（設定を変えても過去分を読めるように）"""
+    if RAW_COMPRESSION == "lzma":
+        return b"x" + lzma.compress(content, preset=min(max(RAW_COMPRESSION_LEVEL, 0), 9))
+    if RAW_COMPRESSION == "none":
+        return b"n" + content
+    return b"z" + zlib.compress(content, min(max(RAW_COMPRESSION_LEVEL, 0), 9))
+
+def decompress_raw(blob):
+    kind, data = blob[:1], blob[1:]
+    if kind == b"z":
+        return zlib.decompress(data)
+    if kind == b"x":
+        return lzma.decompress(data)
+    if kind == b"n":
+        return bytes(data)
+    raise ValueError("未知の生データ形式です: %r" % kind)
+
+class RawMessageStore:
+    """圧縮した生データをセグメントファイルへ追記し、(セグメント, オフセット, 長さ)で読み出す
+
+    セグメントは「[パーティション名/]YYYYMMDD-pid-連番.seg」で、日付が変わるか
+    RAW_SEGMENT_SIZEを超えると次のファイルへ切り替える。ファイル名にpidを含めるため、
+    複数のSMTPワーカーが同時に追記しても衝突しない。メールを削除してもセグメントは
+    書き換えず、compact_raw_segmentsが参照されなくなったファイルを削除し、
+    大半が削除済みのファイルは残りを書き込み中のセグメントへ写して詰め直す。
+    """
+
+    def __init__(self, root=RAW_DIR, segment_size=RAW_SEGMENT_SIZE):
+        self.root = root
+        self.segment_size = max(segment_size, 1)
+        self._open = {}  # パーティション名 -> (セグメント名, ファイル)
+        self._lock = threading.Lock()
+
+    def append(self, blob, prefix=None):
+        with self._lock:
+            segment, f = self._segment_for(prefix, len(blob))
+            offset = f.tell()
+            f.write(blob)
+            # 他のスレッド・プロセスがすぐに読めるよう、書き込むたびにOSへ渡す
+            f.flush()
+        return {"raw_segment": segment, "raw_offset": offset, "raw_length": len(blob)}
+
+    def read(self, segment, offset, length):
+        with open(self._path(segment), "rb") as f:
+            f.seek(offset)
+            blob = f.read(length)
+        return decompress_raw(blob)
+
+    def rotate_sparse(self, live, ratio):
+        """書き込み中のセグメントのうち、参照中のデータ（live）がratioを下回るものを閉じる
+
+        以降の追記は新しいファイルへ向かい、閉じたファイルは詰め直しの対象になる。
+        """
+        with self._lock:
+            for prefix, (segment, f) in list(self._open.items()):
+                if live.get(segment, 0) < f.tell() * ratio:
+                    f.close()
+                    del self._open[prefix]
+
+    def sealed_segments(self, grace_seconds):
+        """もう追記されないセグメントの(名前, サイズ)のリストを返す
+
+        このプロセスが書き込み中のもの、grace_seconds以内に書き込まれたもの（解析中のメールの
+        行がまだDBにない可能性がある）、実行中の他のプロセスの当日のセグメントは除く。
+        """
+        today = datetime.date.today().strftime("%Y%m%d")
+        now = time.time()
+        with self._lock:
+            active = {segment for segment, _ in self._open.values()}
+        sealed = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(".seg"):
+                    continue
+                segment = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                if segment in active or now - stat.st_mtime < grace_seconds:
+                    continue
+                # 「日付-pid-連番」の当日分は、書いたプロセスがまだ追記する可能性がある
+                parts = filename[:-len(".seg")].split("-")
+                if len(parts) == 3 and parts[0] >= today and parts[1].isdigit() and \
+                        int(parts[1]) != os.getpid() and _process_running(int(parts[1])):
+                    continue
+                sealed.append((segment, stat.st_size))
+        return sealed
+
+    def relocate(self, segment, entries, prefix=None):
+        """segmentの(オフセット, 長さ)ごとのデータを書き込み中のセグメントへ写し、新しい位置のリストを返す"""
+        locations = []
+        with open(self._path(segment), "rb") as f:
+            for offset, length in entries:
+                f.seek(offset)
+                locations.append(self.append(f.read(length), prefix))
+        return locations
+
+    def remove(self, segment):
+        try:
+            os.remove(self._path(segment))
+            return True
+        except OSError as e:
+            logger.error("生データのセグメントを削除できません: %s, %s", segment, str(e))
+            return False
+
+    def close(self):
+        with self._lock:
+            for _, f in self._open.values():
+                f.close()
+            self._open.clear()
+
+    def _path(self, segment):
+        return os.path.join(self.root, *segment.split("/"))
+
+    def _segment_for(self, prefix, size):
+        today = datetime.date.today().strftime("%Y%m%d")
+        current = self._open.get(prefix)
+        if current is not None:
+            segment, f = current
+            if os.path.basename(segment).startswith(today) and f.tell() + size <= self.segment_size:
+                return current
+            f.close()
+        # 再起動前や他のプロセスのファイルには追記しないよう、未使用の名前を探す
+        sequence = 0
+        while True:
+            name = "%s-%d-%d.seg" % (today, os.getpid(), sequence)
+            segment = "%s/%s" % (prefix, name) if prefix else name
+            if not os.path.exists(self._path(segment)):
+                break
+            sequence += 1
+        os.makedirs(os.path.dirname(self._path(segment)), exist_ok=True)
+        current = self._open[prefix] = (segment, open(self._path(segment), "ab"))
+        return current
+
+def _process_running(pid):
+    """pidのプロセスが実行中か（確認できない環境では実行中とみなす）"""
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+raw_store = RawMessageStore()
+
 # ----------------------------------------------------------------
 # データベース関連の操作
 # ----------------------------------------------------------------
+# 永続性モードとPRAGMA synchronousの対応
+DURABILITY_SYNCHRONOUS = {
+    "off": "OFF",        # OSに書き込みを任せる（最速、電源断で直近のデータを失う可能性あり）
+    "normal": "NORMAL",  # WALではコミット毎のfsyncを省略（プロセス異常終了では失われない）
+    "full": "FULL",      # コミット毎にfsync
+}
+
 def init_db():
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
+    init_schema(c)
+    migrate_attachment_store(c)
+    conn.commit()
+    conn.close()
+    # 既存のパーティションもスキーマを最新にする
+    for name in list_partitions():
+        conn = sqlite3.connect(partition_path(name))
+        init_schema(conn.cursor())
+        conn.commit()
+        conn.close()
+
+def init_schema(c):
+    """emailsテーブルと関連する索引・参照カウント・全文検索インデックスを作成する
+
+    単一DBファイルと各パーティションのDBファイルで共通のスキーマを使う。
+    """
+    apply_auto_vacuum(c.connection)
+    # 書き込み中も読み込みをブロックしないよう、既定ではWALモードで運用する
+    c.execute("PRAGMA journal_mode=%s" % DB_JOURNAL_MODE)
     c.execute("""
         CREATE TABLE IF NOT EXISTS emails (
             id TEXT PRIMARY KEY,
@@ -172,19 +1052,475 @@ def init_db():
             client_app TEXT,
             body TEXT,
             html_body TEXT,
-            attachments TEXT
+            attachments TEXT,
+            linked_body TEXT,
+            linkify_version INTEGER,
+            raw_segment TEXT,
+            raw_offset INTEGER,
+            raw_length INTEGER,
+            parsed INTEGER NOT NULL DEFAULT 1
         )
     """)
-    conn.commit()
-    conn.close()
+    # 既存DBにリンク変換キャッシュ用・生データ参照用のカラムを追加
+    c.execute("PRAGMA table_info(emails)")
+    existing_columns = {row[1] for row in c.fetchall()}
+    for column, column_type in (("linked_body", "TEXT"), ("linkify_version", "INTEGER"),
+                                ("raw_segment", "TEXT"), ("raw_offset", "INTEGER"), ("raw_length", "INTEGER"),
+                                ("parsed", "INTEGER NOT NULL DEFAULT 1")):
+        if column not in existing_columns:
+            c.execute("ALTER TABLE emails ADD COLUMN %s %s" % (column, column_type))
+    # 一覧のキーセットページングに使う索引
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_time ON emails (time, id)")
+    # 生データのセグメントごとの使用量の集計と、詰め直し時の参照の付け替えに使う索引
+    c.execute("CREATE INDEX IF NOT EXISTS idx_emails_raw_segment ON emails (raw_segment, raw_length)")
+    # 添付ファイル（ハッシュ名）の参照カウント
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS attachment_blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # 受信者アドレスごとの検索に使う正規化テーブル（小文字化したアドレスとドメイン）
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='email_recipients'")
+    backfill = c.fetchone() is None
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS email_recipients (
+            email_id TEXT NOT NULL,
+            address TEXT NOT NULL,
+            domain TEXT NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_email_recipients_address ON email_recipients (address, email_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_email_recipients_domain ON email_recipients (domain, email_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_email_recipients_email ON email_recipients (email_id)")
+    # 削除・クリーンアップのどの経路でもemailsと一致するよう、行の削除はトリガーで反映する
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS email_recipients_delete AFTER DELETE ON emails BEGIN
+            DELETE FROM email_recipients WHERE email_id = old.id;
+        END
+    """)
+    if backfill:
+        backfill_email_recipients(c)
+    init_fts_index(c)
 
-def add_email_to_db(email_data):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+def apply_auto_vacuum(conn, rebuild=False):
+    """DB_AUTO_VACUUM=incrementalの場合、DBファイルをauto_vacuum=INCREMENTALにする（トランザクション外で呼ぶこと）
+
+    テーブルがまだない新しいファイルはPRAGMAだけで切り替わる。既存のファイルはVACUUMで
+    作り直す必要があり、件数に応じて時間がかかるため、起動時には警告だけを出し、
+    `python start.py vacuum`（rebuild=True）で1回だけ作り直す。VACUUMでemailsのrowidが
+    変わるため、全文検索インデックスも作り直す。作り直した場合はTrueを返す。
+    """
+    if DB_AUTO_VACUUM != "incremental" or conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        return False
+    if not rebuild:
+        logger.warning("%s はauto_vacuum=INCREMENTALではないため、削除で空いたページをファイルから返しません。"
+                       "サーバーを停止して`python start.py vacuum`を1回実行してください",
+                       conn.execute("PRAGMA database_list").fetchone()[2])
+        return False
+    started = time.perf_counter()
+    conn.execute("VACUUM")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='emails_fts'").fetchone():
+        rebuild_fts_index(conn.cursor())
+        conn.commit()
+    logger.info("auto_vacuum=INCREMENTALに変更するためDBを再構築しました（%.1f秒）", time.perf_counter() - started)
+    return True
+
+def backfill_email_recipients(c):
+    """既存のメールのrecipients（JSON）からemail_recipientsを作る（テーブル作成時に1回だけ実行）"""
+    c.execute("""
+        INSERT INTO email_recipients (email_id, address, domain)
+        SELECT DISTINCT id, address,
+               CASE WHEN instr(address, '@') > 0 THEN substr(address, instr(address, '@') + 1) ELSE '' END
+        FROM (
+            SELECT e.id AS id, lower(trim(r.value, ' <>')) AS address
+            FROM emails e, json_each(CASE WHEN json_valid(e.recipients) THEN e.recipients ELSE '[]' END) r
+        )
+        WHERE address != ''
+    """)
+    if c.rowcount > 0:
+        logger.info("既存のメールから受信者アドレスを%d件登録しました", c.rowcount)
+
+def normalize_address(address):
+    """受信者アドレスを検索用に正規化する（前後の空白・山括弧を除いて小文字にする）"""
+    return address.strip(" <>").lower()
+
+# ----------------------------------------------------------------
+# パーティション管理（期間ごとのDBファイルをATTACHし、保持期間を過ぎたら丸ごと削除）
+# ----------------------------------------------------------------
+_PARTITION_FILE_RE = re.compile(r'^emails_(\d{8})\.db$')
+_partition_lock = threading.Lock()
+# パーティションの作成・削除のたびに増える世代番号（長寿命の接続がATTACH状態を同期するために使う）
+partition_generation = 0
+# SQLiteの既定で1つの接続にATTACHできるDBの数（これを超える古いパーティションはATTACHしない）
+SQLITE_MAX_ATTACHED = 10
+# 削除中（開いている接続からDETACHしてからファイルを消す）のパーティション名
+_dropping_partitions = set()
+# 他のプロセス（SMTPワーカー）による作成・削除を検出するためのパーティションディレクトリの更新時刻
+_partition_dir_mtime = None
+
+def partition_for_time(time_text):
+    """受信時刻からパーティション名（期間の開始日 YYYYMMDD）を求める。単一DBモードではNone"""
+    if not PARTITIONED:
+        return None
+    day = datetime.date.fromisoformat(time_text[:10])
+    start = day - datetime.timedelta(days=day.toordinal() % PARTITION_DAYS)
+    return start.strftime("%Y%m%d")
+
+def partition_path(name):
+    return os.path.join(PARTITION_DIR, "emails_%s.db" % name)
+
+def partition_schema(name):
+    return "p" + name
+
+def schema_partition(schema):
+    """スキーマ名からパーティション名を返す（mainはNone）"""
+    return None if schema == "main" else schema[1:]
+
+def list_partitions():
+    """存在するパーティション名を新しい順に返す"""
+    if not PARTITIONED or not os.path.isdir(PARTITION_DIR):
+        return []
+    names = []
+    for filename in os.listdir(PARTITION_DIR):
+        match = _PARTITION_FILE_RE.match(filename)
+        if match and match.group(1) not in _dropping_partitions:
+            names.append(match.group(1))
+    return sorted(names, reverse=True)
+
+def create_partition(name):
+    """パーティションのDBファイルを作成する（既にあれば何もしない）"""
+    global partition_generation
+    path = partition_path(name)
+    with _partition_lock:
+        if os.path.exists(path):
+            return
+        os.makedirs(PARTITION_DIR, exist_ok=True)
+        # 他のプロセス（SMTPワーカー）が作成途中の空ファイルをATTACHしないよう、
+        # 一時ファイルでスキーマを作ってからリンクする（既に作られていればそちらを使う）
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        conn = sqlite3.connect(temp_path)
+        init_schema(conn.cursor())
+        conn.commit()
+        conn.close()
+        try:
+            os.link(temp_path, path)
+            created = True
+        except FileExistsError:
+            created = False
+        os.remove(temp_path)
+        partition_generation += 1
+    if created:
+        logger.info("パーティションを作成しました: %s", path)
+
+def drop_partition(name):
+    """パーティションのDBファイルと添付ファイルディレクトリを丸ごと削除する
+
+    先にパーティション一覧から外し、プールとライターの接続からDETACHしてからファイルを消す
+    （Windowsでは開いたままのファイルを削除できず、POSIXでも削除済みのファイルを開いたままになるため）。
+    消せなかったファイルは次回のクリーンアップ（retry_partition_drops）で削除し直す。
+    """
+    global partition_generation
+    with _partition_lock:
+        _dropping_partitions.add(name)
+        partition_generation += 1
+    db_pool.detach_dropped()
+    email_writer.sync()
+    _remove_partition_files(name)
+
+def _remove_partition_files(name):
+    path = partition_path(name)
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("パーティションのファイルを削除できないため、次回のクリーンアップで再試行します: %s, %s",
+                           path + suffix, str(e))
+            return False
+    with _partition_lock:
+        _dropping_partitions.discard(name)
+    shutil.rmtree(os.path.join(ATTACHMENT_DIR, name), ignore_errors=True)
+    shutil.rmtree(os.path.join(RAW_DIR, name), ignore_errors=True)
+    logger.info("パーティションを削除しました: %s", path)
+    return True
+
+def retry_partition_drops():
+    """前回削除できなかったパーティションのファイルを削除し直す"""
+    for name in sorted(_dropping_partitions):
+        _remove_partition_files(name)
+
+def refresh_partition_generation():
+    """他のプロセスがパーティションを作成・削除していれば世代番号を進める"""
+    global partition_generation, _partition_dir_mtime
+    if not PARTITIONED:
+        return
+    try:
+        mtime = os.stat(PARTITION_DIR).st_mtime_ns
+    except OSError:
+        return
+    with _partition_lock:
+        if mtime != _partition_dir_mtime:
+            partition_generation += 1
+            _partition_dir_mtime = mtime
+
+def sync_partitions(conn):
+    """接続にATTACHされたパーティションを現在のファイル構成に合わせる（トランザクション外で呼ぶこと）"""
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")} - {"main", "temp"}
+    with _partition_lock:
+        # ATTACHできる数を超える場合は新しいものを優先する（古いものは保持期間のクリーンアップで削除される）
+        wanted = {partition_schema(name): name for name in list_partitions()[:SQLITE_MAX_ATTACHED]}
+        for schema in attached - set(wanted):
+            conn.execute("DETACH DATABASE %s" % schema)
+        for schema, name in wanted.items():
+            if schema not in attached:
+                try:
+                    conn.execute("ATTACH DATABASE ? AS %s" % schema, (partition_path(name),))
+                except sqlite3.OperationalError as e:
+                    logger.error("パーティションをATTACHできません: %s, %s", name, str(e))
+                    continue
+                apply_db_pragmas(conn, schema)
+
+def ensure_partition(conn, name):
+    """パーティションを必要に応じて作成・ATTACHし、スキーマ名を返す（ATTACHできなければNone）"""
+    schema = partition_schema(name)
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    if schema not in attached:
+        create_partition(name)
+        sync_partitions(conn)
+        attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    return schema if schema in attached else None
+
+def partition_has_room(name, known):
+    """nameのパーティションにメールを追加できるか（既存か、ATTACHできる数に空きがあるか）を返す
+
+    knownは既存と追加予定のパーティション名の集合で、追加できる場合はnameを加える。
+    """
+    if name is None or name in known:
+        return True
+    if len(known) >= SQLITE_MAX_ATTACHED:
+        return False
+    known.add(name)
+    return True
+
+def apply_db_pragmas(conn, schema="main"):
+    """接続（スキーマ）ごとの性能関連PRAGMAを設定する"""
+    conn.execute("PRAGMA %s.synchronous=%s" % (schema, DURABILITY_SYNCHRONOUS.get(DB_DURABILITY, "NORMAL")))
+    conn.execute("PRAGMA %s.cache_size=%d" % (schema, -DB_CACHE_SIZE_KB))
+    conn.execute("PRAGMA %s.mmap_size=%d" % (schema, DB_MMAP_SIZE))
+
+def open_db_connection():
+    """チューニング済みのSQLite接続を開く（パーティションモードでは既存のパーティションをATTACHする）"""
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+                           check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    conn.execute("PRAGMA busy_timeout=%d" % DB_BUSY_TIMEOUT_MS)
+    conn.execute("PRAGMA temp_store=MEMORY")
+    apply_db_pragmas(conn)
+    if PARTITIONED:
+        sync_partitions(conn)
+    return conn
+
+def is_db_busy_error(e):
+    """ロック待ちがタイムアウトしたことによるエラーか"""
+    return isinstance(e, sqlite3.OperationalError) and "locked" in str(e).lower()
+
+class ConnectionPool:
+    """SQLite接続を使い回すプール
+
+    DBヘルパーは毎回ファイルを開き直す代わりに with db_pool.connection() で接続を借りる。
+    接続は開いたまま保持されるため、スキーマの読み込みやプリペアドステートメントの
+    キャッシュが呼び出しをまたいで再利用される。例外で抜けた場合もロールバックしてから
+    プールへ返すため、ロック待ちなどのエラーが続いても接続が枯渇しない。
+    """
+
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = max(size, 0)
+        self._idle = []  # (接続, ATTACH状態を同期したパーティション世代)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            item = self._idle.pop() if self._idle else None
+        refresh_partition_generation()
+        if item is None:
+            conn, generation = open_db_connection(), partition_generation
+        else:
+            conn, generation = item
+            if PARTITIONED and generation != partition_generation:
+                generation = partition_generation
+                sync_partitions(conn)
+        self._generations[id(conn)] = generation
+        return conn
+
+    def release(self, conn):
+        generation = self._generations.pop(id(conn), None)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if PARTITIONED and generation != partition_generation:
+                # 使用中に削除されたパーティションは、プールへ戻す前にDETACHしてファイルを閉じる
+                generation = partition_generation
+                sync_partitions(conn)
+        except sqlite3.Error as e:
+            # ロールバックできない接続は再利用せずに閉じる
+            logger.warning("DB接続をロールバックできなかったため閉じます: %s", str(e))
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, generation))
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """with文の間だけ接続を借りる（例外で抜けた場合も未完了のトランザクションを戻して返す）"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def detach_dropped(self, timeout=5):
+        """すべての接続のATTACH状態を現在のパーティション構成に合わせる（削除するパーティションを閉じる）
+
+        待機中の接続はここで同期し、使用中の接続は返却時に同期されるため返却されるまで待つ。
+        """
+        if not PARTITIONED:
+            return
+        generation = partition_generation
+        with self._lock:
+            idle, self._idle = self._idle, []
+        synced = []
+        for conn, _ in idle:
+            try:
+                sync_partitions(conn)
+                synced.append((conn, generation))
+            except sqlite3.Error:
+                conn.close()
+        with self._lock:
+            self._idle.extend(synced)
+        deadline = time.monotonic() + timeout
+        while any(value != generation for value in list(self._generations.values())):
+            if time.monotonic() >= deadline:
+                logger.warning("使用中のDB接続が返却されないまま、パーティションの削除を続けます")
+                break
+            time.sleep(0.01)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+def db_schemas(conn):
+    """検索対象のスキーマ名（mainと、ATTACHされたパーティション）を返す"""
+    return [row[1] for row in conn.execute("PRAGMA database_list") if row[1] != "temp"]
+
+def union_all(conn, select_sql, params=()):
+    """各スキーマに同じSELECTを発行するUNION ALLのSQLとパラメータを作る
+
+    select_sql中の{schema}はスキーマ名に置き換える。
+    """
+    schemas = db_schemas(conn)
+    sql = " UNION ALL ".join("SELECT * FROM (%s)" % select_sql.replace("{schema}", schema) for schema in schemas)
+    return sql, list(params) * len(schemas)
+
+def _schema_for_email(conn, email_data):
+    """メールを書き込むスキーマ名を返す"""
+    if not PARTITIONED:
+        return "main"
+    schema = ensure_partition(conn, partition_for_time(email_data["time"]))
+    if schema is None:
+        # パーティションが多すぎてATTACHできない場合も、メールを失わないようmainに保存する
+        logger.error("パーティションをATTACHできないためmainに保存します: id=%s, time=%s", email_data["id"], email_data["time"])
+        return "main"
+    return schema
+
+# 全文検索インデックス（FTS5）の対象カラム
+FTS_COLUMNS = ["subject", "sender", "recipients", "client_app", "body", "attachment_names"]
+# FTS5が利用できない環境ではLIKE検索にフォールバックする
+FTS_ENABLED = False
+# trigramトークナイザでは3文字未満の語は検索できない
+FTS_MIN_TERM_LENGTH = 3
+
+# emailsの1行からFTSに登録する値を作るSQL式（トリガー内でnewまたはoldを参照）
+_FTS_VALUES_SQL = """
+    {row}.rowid, {row}.subject, {row}.sender,
+    (SELECT group_concat(value, ', ') FROM json_each(CASE WHEN json_valid({row}.recipients) THEN {row}.recipients ELSE '[]' END)),
+    {row}.client_app, {row}.body,
+    (SELECT group_concat(json_extract(value, '$.filename'), ' ') FROM json_each(CASE WHEN json_valid({row}.attachments) THEN {row}.attachments ELSE '[]' END))
+"""
+
+def init_fts_index(c):
+    """emailsテーブルのFTS5シャドウインデックスと同期用トリガーを作成する
+
+    INSERT/DELETE/UPDATEはトリガーで自動的に反映されるため、受信・削除・
+    クリーンアップのどの経路でもインデックスがemailsと一致する。
+    """
+    global FTS_ENABLED
+    columns = ", ".join(FTS_COLUMNS)
+    try:
+        try:
+            c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(%s, tokenize='trigram')" % columns)
+        except sqlite3.OperationalError:
+            # 古いSQLiteではtrigramがないため既定のトークナイザを使う
+            c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(%s)" % columns)
+    except sqlite3.OperationalError as e:
+        logger.warning("FTS5が利用できないため全文検索インデックスを無効化します: %s", str(e))
+        FTS_ENABLED = False
+        return
+
+    fts_columns = "rowid, " + columns
     c.execute("""
-        INSERT INTO emails (id, time, subject, sender, recipients, client_ip, client_app, body, html_body, attachments)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+        CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+            INSERT INTO emails_fts (%s) VALUES (%s);
+        END
+    """ % (fts_columns, _FTS_VALUES_SQL.format(row="new")))
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+            DELETE FROM emails_fts WHERE rowid = old.rowid;
+        END
+    """)
+    # 本文のリンク変換キャッシュなど検索対象外のカラムの更新ではインデックスを作り直さない
+    # SMTPワーカーが同時に起動しても失敗しないよう、作り直しは IF NOT EXISTS で行う
+    c.execute("DROP TRIGGER IF EXISTS emails_fts_update")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS emails_fts_update
+        AFTER UPDATE OF subject, sender, recipients, client_app, body, attachments ON emails BEGIN
+            DELETE FROM emails_fts WHERE rowid = old.rowid;
+            INSERT INTO emails_fts (%s) VALUES (%s);
+        END
+    """ % (fts_columns, _FTS_VALUES_SQL.format(row="new")))
+
+    # 既存データの取り込み（インデックス作成前のメールや件数がずれている場合）
+    c.execute("SELECT COUNT(*) FROM emails")
+    email_count = c.fetchone()[0]
+    c.execute("SELECT COUNT(*) FROM emails_fts")
+    if c.fetchone()[0] != email_count:
+        rebuild_fts_index(c)
+    FTS_ENABLED = True
+
+def rebuild_fts_index(c):
+    """FTSインデックスをemailsテーブルの内容から作り直す（rowidが変わるVACUUM後にも使用）"""
+    c.execute("DELETE FROM emails_fts")
+    c.execute("INSERT INTO emails_fts (rowid, %s) SELECT %s FROM emails emails_row"
+              % (", ".join(FTS_COLUMNS), _FTS_VALUES_SQL.format(row="emails_row")))
+    logger.info("全文検索インデックスを再構築しました")
+
+def _insert_email(c, email_data, schema="main"):
+    linked_body = email_data.get("linked_body")
+    c.execute("""
+        INSERT INTO %s.emails (id, time, subject, sender, recipients, client_ip, client_app, body, html_body, attachments,
+                            linked_body, linkify_version, raw_segment, raw_offset, raw_length, parsed)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """ % schema, (
         email_data["id"],
         email_data["time"],
         email_data["subject"],
@@ -194,119 +1530,1195 @@ def add_email_to_db(email_data):
         email_data["client_app"],
         email_data["body"],
         email_data.get("html_body", ""),
-        json.dumps(email_data.get("attachments", []))
+        json.dumps(email_data.get("attachments", [])),
+        linked_body,
+        LINKIFY_VERSION if linked_body is not None else None,
+        email_data.get("raw_segment"),
+        email_data.get("raw_offset"),
+        email_data.get("raw_length"),
+        1 if email_data.get("parsed", True) else 0
     ))
-    conn.commit()
-    conn.close()
+    addresses = {normalize_address(address) for address in email_data["to"]} - {""}
+    c.executemany("INSERT INTO %s.email_recipients (email_id, address, domain) VALUES (?, ?, ?)" % schema,
+                  [(email_data["id"], address, address.partition("@")[2]) for address in sorted(addresses)])
+    _acquire_attachments(c, email_data.get("attachments", []), schema)
 
-def load_emails_from_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, time, subject, sender, recipients, client_ip, client_app, body, html_body, attachments FROM emails ORDER BY time DESC")
-    rows = c.fetchall()
-    conn.close()
-    emails = []
-    for row in rows:
-        attachments = []
-        if row[9]:
+def add_email_to_db(email_data):
+    with db_pool.connection() as conn:
+        schema = _schema_for_email(conn, email_data)
+        c = conn.cursor()
+        with DB_INSERT_SECONDS.time():
+            _insert_email(c, email_data, schema)
+        with DB_COMMIT_SECONDS.time():
+            conn.commit()
+        DB_BATCH_SIZE.observe(1)
+
+class EmailWriter:
+    """受信メールをキューに溜め、専用スレッドでまとめてDBへ書き込むwrite-behindライター
+
+    WRITE_BATCH_SIZE件に達するかWRITE_BATCH_INTERVAL_MSが経過するたびに、
+    溜まった分を1トランザクションでコミットする（グループコミット）。
+    SMTPのイベントループはキューに積むだけなのでディスク待ちの影響を受けない。
+    """
+
+    _STOP = object()
+    # ライターの接続にパーティションの削除を反映させるための目印（メールとしては書き込まない）
+    _SYNC = object()
+
+    # ロック待ちタイムアウト時にバッチを再試行する回数
+    BUSY_RETRIES = 5
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, interval_ms=WRITE_BATCH_INTERVAL_MS):
+        self.batch_size = max(batch_size, 1)
+        self.interval = max(interval_ms, 0) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # バッチをコミットした後に呼ぶ関数（書き込んだメールのリストを渡す）
+        self.on_commit = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="email-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, email_data):
+        """メールを書き込みキューに追加する（すぐに戻る）"""
+        if self._thread is None:
+            self.start()
+        self._queue.put(email_data)
+
+    def pending(self):
+        """まだコミットされていないメールの概数（書き込み中のバッチを含む）"""
+        return self._queue.unfinished_tasks
+
+    def flush(self):
+        """キューに積まれたメールがすべてコミットされるまで待つ"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def sync(self):
+        """ライターの接続のATTACH状態を現在のパーティション構成に合わせるまで待つ"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(self._SYNC)
+            self._queue.join()
+
+    def close(self):
+        """残りのメールを書き込んでからライタースレッドを停止する"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+            logger.info("書き込みキューをフラッシュしました")
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+            remaining = deadline - time.monotonic()
             try:
-                attachments = json.loads(row[9])
-            except Exception as e:
-                attachments = []
-        # 直接使用数据库中的内容，不再进行URL转换
-        body = row[7] if row[7] else ""
-        html_body = row[8] if row[8] else ""
-        emails.append({
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, conn, batch):
+        c = conn.cursor()
+        # パーティションのATTACHはトランザクション外で行う必要があるため先に決める
+        targets = [(email_data, _schema_for_email(conn, email_data)) for email_data in batch]
+        for attempt in range(self.BUSY_RETRIES + 1):
+            try:
+                with conn:
+                    with DB_INSERT_SECONDS.time():
+                        for email_data, schema in targets:
+                            _insert_email(c, email_data, schema)
+                    with DB_COMMIT_SECONDS.time():
+                        conn.commit()
+                DB_BATCH_SIZE.observe(len(targets))
+                return
+            except sqlite3.Error as e:
+                if not is_db_busy_error(e) or attempt == self.BUSY_RETRIES:
+                    logger.error("バッチ書き込みに失敗したため個別に再試行します: %s", str(e))
+                    break
+                # 他の書き込み（削除・クリーンアップ）が終わるのを待って再試行する
+                logger.warning("DBがロックされているためバッチ書き込みを再試行します（%d回目）", attempt + 1)
+                time.sleep(0.1 * (attempt + 1))
+        # 1件の不正データでバッチ全体を失わないよう、1件ずつ書き直す
+        for email_data, schema in targets:
+            try:
+                with conn:
+                    _insert_email(c, email_data, schema)
+            except sqlite3.Error as e:
+                DB_WRITE_ERRORS.inc()
+                logger.error("メールの保存に失敗しました: id=%s, %s", email_data.get("id"), str(e))
+
+    def _run(self):
+        # ライター専用の接続を開いたまま使い続ける
+        conn = open_db_connection()
+        generation = partition_generation
+        try:
+            while True:
+                batch = self._next_batch()
+                stop = batch[-1] is self._STOP
+                emails = [item for item in batch if item is not self._STOP and item is not self._SYNC]
+                try:
+                    refresh_partition_generation()
+                    if PARTITIONED and generation != partition_generation:
+                        # 削除されたパーティションをDETACHする
+                        generation = partition_generation
+                        sync_partitions(conn)
+                    if emails:
+                        self._write_batch(conn, emails)
+                        if self.on_commit is not None:
+                            self.on_commit(emails)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+def _row_to_email(row):
+    attachments = []
+    if row[9]:
+        try:
+            attachments = json.loads(row[9])
+        except Exception as e:
+            attachments = []
+    # 直接使用数据库中的内容，不再进行URL转换
+    return {
+        "id": row[0],
+        "time": row[1],
+        "subject": row[2],
+        "sender": row[3],
+        "to": json.loads(row[4]) if row[4] else [],
+        "client_ip": row[5],
+        "client_app": row[6],
+        "body": row[7] if row[7] else "",
+        "html_body": row[8] if row[8] else "",
+        "attachments": attachments
+    }
+
+def parse_stored_email(schema, raw_segment, raw_offset, raw_length):
+    """保存した生データを解析する（添付ファイルはメールと同じパーティションに書き出す）"""
+    content = raw_store.read(raw_segment, raw_offset, raw_length)
+    return parse_email_content(content, schema_partition(schema))
+
+def _cache_parsed_email(c, schema, email_id, parsed):
+    """遅延解析の結果をDBに保存し、添付ファイルの参照カウントを増やす（先に保存済みなら何もせずFalseを返す）"""
+    c.execute("UPDATE %s.emails SET body=?, html_body=?, attachments=?, linked_body=?, linkify_version=?, parsed=1"
+              " WHERE id=? AND parsed=0" % schema,
+              (parsed["body"], parsed["html_body"], json.dumps(parsed["attachments"]), parsed["linked_body"],
+               LINKIFY_VERSION, email_id))
+    if not c.rowcount:
+        return False
+    _acquire_attachments(c, parsed["attachments"], schema)
+    return True
+
+def _apply_parsed(email, parsed):
+    email.update({
+        "body": parsed["body"],
+        "html_body": parsed["html_body"],
+        "attachments": parsed["attachments"],
+        "linked_body": parsed["linked_body"],
+    })
+
+def get_email_from_db(email_id):
+    """1通のメールを本文・HTML・添付ファイル情報を含めてDBから読み込む（未解析なら解析して保存する）"""
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        row = None
+        for schema in db_schemas(conn):
+            c.execute("SELECT id, time, subject, sender, recipients, client_ip, client_app, body, html_body, attachments,"
+                      " raw_segment, raw_offset, raw_length, parsed, linked_body, linkify_version"
+                      " FROM %s.emails WHERE id=?" % schema, (email_id,))
+            row = c.fetchone()
+            if row:
+                break
+        email = None
+        if row:
+            email = _row_to_email(row)
+            email["has_raw"] = row[10] is not None
+            # リンク変換のキャッシュが古い・未作成の場合はNone
+            email["linked_body"] = row[14] if row[15] == LINKIFY_VERSION else None
+            if not row[13] and row[10] is not None:
+                parsed = parse_stored_email(schema, row[10], row[11], row[12])
+                _apply_parsed(email, parsed)
+                if _cache_parsed_email(c, schema, email_id, parsed):
+                    conn.commit()
+                    # 一覧の本文・parsedが変わるため、一覧のETagを進める
+                    mailbox_version.touch()
+    return email
+
+def get_raw_message(email_id):
+    """保存した生データ（.eml）を返す。生データがないメールはNone"""
+    with db_pool.connection() as conn:
+        location = None
+        for schema in db_schemas(conn):
+            location = conn.execute("SELECT raw_segment, raw_offset, raw_length FROM %s.emails WHERE id=?" % schema,
+                                    (email_id,)).fetchone()
+            if location:
+                break
+    if not location or location[0] is None:
+        return None
+    return raw_store.read(*location)
+
+# 参照中のデータがこの割合を下回ったセグメントは詰め直す
+RAW_COMPACT_RATIO = 0.5
+# 最後の書き込みからこの秒数が経つまでは、セグメントを削除・詰め直しの対象にしない
+# （生データを追記してからDBの行をコミットするまでの間、参照がないように見えるため）
+RAW_SEGMENT_GRACE_SECONDS = 60
+
+def raw_segment_usage(conn):
+    """セグメントごとに、メールが参照している生データのバイト数を返す"""
+    sql, params = union_all(conn, "SELECT raw_segment, SUM(raw_length) AS used FROM {schema}.emails"
+                                  " WHERE raw_segment IS NOT NULL GROUP BY raw_segment")
+    return {row[0]: row[1] for row in conn.execute("SELECT raw_segment, SUM(used) FROM (%s) GROUP BY raw_segment" % sql,
+                                                   params)}
+
+def relocate_raw_segment(segment):
+    """segmentを参照しているメールの生データを書き込み中のセグメントへ写し、参照を付け替える
+
+    元のファイルは参照がなくなるため、読み込み中の呼び出し元があっても次回の整理で削除される。
+    """
+    with db_pool.connection() as conn:
+        sql, params = union_all(conn, "SELECT '{schema}' AS schema, id, raw_offset, raw_length FROM {schema}.emails"
+                                      " WHERE raw_segment = ?", (segment,))
+        rows = conn.execute(sql + " ORDER BY raw_offset", params).fetchall()
+        locations = raw_store.relocate(segment, [(row[2], row[3]) for row in rows], segment.rpartition("/")[0] or None)
+        for (schema, email_id, _, _), location in zip(rows, locations):
+            conn.execute("UPDATE %s.emails SET raw_segment=?, raw_offset=? WHERE id=?" % schema,
+                         (location["raw_segment"], location["raw_offset"], email_id))
+        conn.commit()
+    return len(rows)
+
+def compact_raw_segments():
+    """生データのセグメントを整理し、(削除したセグメント数, 詰め直したセグメント数)を返す
+
+    どのメールからも参照されていないセグメントは削除し、参照中のデータがRAW_COMPACT_RATIOを
+    下回るセグメントは詰め直す。書き込み中のセグメントも大半が削除済みなら切り替え、
+    猶予期間（RAW_SEGMENT_GRACE_SECONDS）の後の整理で同じように扱う。
+    """
+    with db_pool.connection() as conn:
+        live = raw_segment_usage(conn)
+    raw_store.rotate_sparse(live, RAW_COMPACT_RATIO)
+    removed = compacted = 0
+    for segment, size in raw_store.sealed_segments(RAW_SEGMENT_GRACE_SECONDS):
+        used = live.get(segment, 0)
+        if used == 0:
+            removed += raw_store.remove(segment)
+        elif used < size * RAW_COMPACT_RATIO:
+            try:
+                relocate_raw_segment(segment)
+                compacted += 1
+            except (OSError, sqlite3.Error) as e:
+                logger.error("生データのセグメントを詰め直せません: %s, %s", segment, str(e))
+    if removed or compacted:
+        logger.info("生データのセグメントを整理しました（削除%d個、詰め直し%d個）", removed, compacted)
+    return removed, compacted
+
+def count_emails(conn, where="", params=()):
+    """全スキーマを合わせたメール件数を返す（whereの{schema}はスキーマ名に置き換える）"""
+    sql, params = union_all(conn, "SELECT COUNT(*) AS n FROM {schema}.emails" + where, params)
+    return conn.execute("SELECT COALESCE(SUM(n), 0) FROM (%s)" % sql, params).fetchone()[0]
+
+def make_email_summary(email_data):
+    """受信したメールデータから一覧用の概要を作る"""
+    return {
+        "id": email_data["id"],
+        "time": email_data["time"],
+        "subject": email_data["subject"],
+        "sender": email_data["sender"],
+        "to": list(email_data["to"]),
+        "attachment_count": len(email_data.get("attachments", [])),
+    }
+
+def body_snippet(linked_body, limit):
+    """リンク変換済みの本文の先頭limit文字と、省略したかどうかを返す
+
+    途中で切ったタグやリンクが一覧の表示を崩さないよう、閉じていないタグ・リンクの手前で切る。
+    """
+    if len(linked_body) <= limit:
+        return linked_body, False
+    snippet = linked_body[:limit]
+    cut = snippet.rfind("<")
+    if cut > snippet.rfind(">"):
+        snippet = snippet[:cut]
+    cut = snippet.rfind("<a ")
+    if cut > snippet.rfind("</a>"):
+        snippet = snippet[:cut]
+    return snippet, True
+
+def make_email_event(email_data):
+    """受信したメールデータから一覧の1行分のイベントデータを作る（本文は先頭だけ）"""
+    body, truncated = body_snippet(email_data.get("linked_body") or "", EVENT_BODY_PREVIEW)
+    event = make_email_summary(email_data)
+    event.update({
+        "client_ip": email_data.get("client_ip"),
+        "client_app": email_data.get("client_app"),
+        "body": body,
+        "body_truncated": truncated,
+        "has_html": bool(email_data.get("html_body")),
+        "has_raw": email_data.get("raw_segment") is not None,
+        "parsed": email_data.get("parsed", True),
+        "attachments": [{"filename": att["filename"], "saved_name": att["saved_name"]}
+                        for att in email_data.get("attachments", []) if "saved_name" in att],
+    })
+    return event
+
+class MailboxCounter:
+    """全スキーマを合わせたメール件数をメモリ上に保持する
+
+    起動時と/refreshでだけDBを数え、受信・削除のたびに差分だけを反映する。
+    一覧APIのrecordsTotal（絞り込みなしの件数）はここから返し、リクエストごとにCOUNTしない。
+    """
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """DBの件数を数え直す"""
+        with db_pool.connection() as conn:
+            total = count_emails(conn)
+        with self._lock:
+            self.total = total
+
+    def add(self, count=1):
+        with self._lock:
+            self.total += count
+
+    def remove(self, count=1):
+        """削除された件数だけ減らす（DBから実際に削除した件数を渡す）"""
+        with self._lock:
+            self.total = max(self.total - count, 0)
+
+    def clear(self):
+        with self._lock:
+            self.total = 0
+
+class EmailDetailCache:
+    """メール詳細（本文・リンク変換済み本文・HTML・添付ファイル情報）のLRUキャッシュ
+
+    受信したメールの内容は後から変わらないため、削除された時だけ取り除けばよい。
+    本文・HTMLを丸ごと保持するため、件数はcapacity件までに抑える。
+    """
+
+    def __init__(self, capacity=DETAIL_CACHE_SIZE):
+        self.capacity = max(capacity, 0)
+        self._items = collections.OrderedDict()  # 古い順（末尾が最近使ったもの）
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, email_id):
+        with self._lock:
+            email = self._items.get(email_id)
+            if email is not None:
+                self._items.move_to_end(email_id)
+            return email
+
+    def put(self, email_id, email):
+        with self._lock:
+            self._items[email_id] = email
+            self._items.move_to_end(email_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def remove(self, email_id):
+        with self._lock:
+            self._items.pop(email_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+def load_email_detail(email_id):
+    """1通のメールの詳細をキャッシュ（なければDB）から返す。存在しなければNone"""
+    email = detail_cache.get(email_id)
+    if email is not None:
+        DETAIL_CACHE_REQUESTS.inc(labels=("hit",))
+        return email
+    DETAIL_CACHE_REQUESTS.inc(labels=("miss",))
+    email = get_email_from_db(email_id)
+    if email is None:
+        return None
+    if email.get("linked_body") is None:
+        email["linked_body"] = convert_urls_to_links(email["body"]) if email["body"] else ""
+    detail_cache.put(email_id, email)
+    return email
+
+# DataTablesの列インデックスとDBカラムの対応（検索・ソート用）
+EMAIL_LIST_COLUMNS = ["time", "subject", "sender", "recipients", "client_ip", "client_app"]
+
+def _like_pattern(value):
+    """LIKE検索用にワイルドカードをエスケープした部分一致パターンを作る"""
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "%" + escaped + "%"
+
+# 一覧の列インデックスとFTSカラムの対応（FTS対象外の列はLIKE検索）
+EMAIL_LIST_FTS_COLUMNS = {
+    1: ["subject"],
+    2: ["sender"],
+    3: ["recipients"],
+    5: ["client_app"],
+    6: ["body", "attachment_names"],
+}
+
+def _fts_phrase(value):
+    """検索語をFTS5のフレーズとしてクォートする"""
+    return '"' + value.replace('"', '""') + '"'
+
+def _use_fts(value):
+    return FTS_ENABLED and len(value) >= FTS_MIN_TERM_LENGTH
+
+def _build_email_filters(column_search, global_search):
+    """列ごとの検索語と全体検索語からWHERE句の条件とパラメータを組み立てる
+
+    FTS対象の列は1つのMATCH式にまとめ、FTSで扱えない列や短すぎる語はLIKEで検索する。
+    条件中の{schema}はunion_allでスキーマ名に置き換えられる。
+    """
+    conditions = []
+    params = []
+    match_terms = []
+    for index, value in column_search.items():
+        if not value:
+            continue
+        if index in EMAIL_LIST_FTS_COLUMNS and _use_fts(value):
+            match_terms.append("{%s} : %s" % (" ".join(EMAIL_LIST_FTS_COLUMNS[index]), _fts_phrase(value)))
+        elif index < len(EMAIL_LIST_COLUMNS):
+            conditions.append("%s LIKE ? ESCAPE '\\'" % EMAIL_LIST_COLUMNS[index])
+            params.append(_like_pattern(value))
+        elif index == len(EMAIL_LIST_COLUMNS):
+            # 本文/添付ファイル列
+            conditions.append("(body LIKE ? ESCAPE '\\' OR attachments LIKE ? ESCAPE '\\')")
+            params.extend([_like_pattern(value)] * 2)
+    if match_terms:
+        conditions.append("rowid IN (SELECT rowid FROM {schema}.emails_fts WHERE emails_fts MATCH ?)")
+        params.append(" AND ".join(match_terms))
+    if global_search:
+        if _use_fts(global_search):
+            conditions.append("(rowid IN (SELECT rowid FROM {schema}.emails_fts WHERE emails_fts MATCH ?)"
+                              " OR time LIKE ? ESCAPE '\\' OR client_ip LIKE ? ESCAPE '\\')")
+            params.append(_fts_phrase(global_search))
+            params.extend([_like_pattern(global_search)] * 2)
+        else:
+            columns = EMAIL_LIST_COLUMNS + ["body", "attachments"]
+            conditions.append("(" + " OR ".join("%s LIKE ? ESCAPE '\\'" % col for col in columns) + ")")
+            params.extend([_like_pattern(global_search)] * len(columns))
+    return conditions, params
+
+# スニペット中のハイライト位置を示す目印（HTMLエスケープ後に<mark>へ置換する）
+_HIGHLIGHT_OPEN = "\x02"
+_HIGHLIGHT_CLOSE = "\x03"
+
+def _highlight_to_html(text):
+    """FTSのハイライト結果をエスケープしたうえで<mark>タグ付きHTMLにする"""
+    if not text:
+        return ""
+    return (str(markupsafe.escape(text))
+            .replace(_HIGHLIGHT_OPEN, "<mark>")
+            .replace(_HIGHLIGHT_CLOSE, "</mark>"))
+
+def search_emails(query, limit=20, offset=0):
+    """全文検索を行い、関連度順にハイライト付きスニペットを返す"""
+    if not _use_fts(query):
+        return []
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        sql, params = union_all(conn, """
+            SELECT e.id, e.time, e.subject, e.sender, e.recipients, bm25(emails_fts) AS score,
+                   highlight(emails_fts, 0, ?, ?),
+                   highlight(emails_fts, 1, ?, ?),
+                   highlight(emails_fts, 2, ?, ?),
+                   snippet(emails_fts, 4, ?, ?, '…', 24),
+                   highlight(emails_fts, 5, ?, ?)
+            FROM {schema}.emails_fts JOIN {schema}.emails e ON e.rowid = emails_fts.rowid
+            WHERE emails_fts MATCH ?
+            ORDER BY score LIMIT ?
+        """, [_HIGHLIGHT_OPEN, _HIGHLIGHT_CLOSE] * 5 + [_fts_phrase(query), limit + offset])
+        c.execute(sql + " ORDER BY score, time DESC LIMIT ? OFFSET ?", params + [limit, offset])
+        rows = c.fetchall()
+    results = []
+    for row in rows:
+        results.append({
             "id": row[0],
             "time": row[1],
             "subject": row[2],
             "sender": row[3],
-            "to": json.loads(row[4]),
-            "client_ip": row[5],
-            "client_app": row[6],
-            "body": body,
-            "html_body": html_body,
-            "attachments": attachments
+            "to": json.loads(row[4]) if row[4] else [],
+            "score": row[5],
+            "highlights": {
+                "subject": _highlight_to_html(row[6]),
+                "sender": _highlight_to_html(row[7]),
+                "recipients": _highlight_to_html(row[8]),
+                "body": _highlight_to_html(row[9]),
+                "attachments": _highlight_to_html(row[10]),
+            }
         })
-    return emails
+    return results
+
+def query_emails_page(start=0, length=10, order_column=0, order_dir="desc",
+                      column_search=None, global_search="", cursor=None):
+    """一覧表示用に1ページ分のメール概要を取得する（HTML本文は読み込まず、has_htmlで有無を返す）
+
+    cursorに直前ページ最終行の(ソート値, id)が渡された場合はOFFSETを使わず
+    キーセットページングで続きを読み込むため、ページ位置に関係なくコストが一定になる。
+    """
+    sort_column = EMAIL_LIST_COLUMNS[order_column] if 0 <= order_column < len(EMAIL_LIST_COLUMNS) else "time"
+    descending = order_dir != "asc"
+    sort_expr = sort_column if sort_column == "time" else "COALESCE(%s, '')" % sort_column
+    direction = "DESC" if descending else "ASC"
+
+    conditions, params = _build_email_filters(column_search or {}, global_search)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        # 絞り込みなしの件数は受信・削除のたびに更新しているメモリ上の件数を使う
+        records_total = mailbox_counter.total
+        if conditions:
+            records_filtered = count_emails(conn, where, params)
+        else:
+            records_filtered = records_total
+
+        page_conditions = list(conditions)
+        page_params = list(params)
+        offset = start
+        if cursor is not None:
+            page_conditions.append("(%s, id) %s (?, ?)" % (sort_expr, "<" if descending else ">"))
+            page_params.extend(cursor)
+            offset = 0
+        page_where = " WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+        order_by = " ORDER BY %s %s, id %s" % (sort_expr, direction, direction)
+        # 各スキーマから先頭offset+length件ずつ取り出し、まとめて並べ替える
+        sql, union_params = union_all(conn,
+            "SELECT id, time, subject, sender, recipients, client_ip, client_app, body, length(html_body) > 0, attachments,"
+            " linked_body, linkify_version, '{schema}' AS part, raw_segment, raw_offset, raw_length, parsed"
+            " FROM {schema}.emails" + page_where + order_by + " LIMIT ?",
+            page_params + [offset + length])
+        c.execute(sql + order_by + " LIMIT ? OFFSET ?", union_params + [length, offset])
+        rows = c.fetchall()
+
+        emails = []
+        stale = []
+        next_cursor = None
+        for row in rows:
+            email = _row_to_email(row)
+            email["has_raw"] = row[13] is not None
+            email["parsed"] = bool(row[16])
+            if not row[16]:
+                # 遅延解析モードで受信したメールはヘッダーだけを返す（本文は開いた時にload_email_detailで解析する）
+                email["linked_body"] = ""
+            elif row[11] == LINKIFY_VERSION and row[10] is not None:
+                email["linked_body"] = row[10]
+            else:
+                # 未変換または変換規則が変わったメールはここで変換し、結果をキャッシュする
+                email["linked_body"] = convert_urls_to_links(email["body"]) if email["body"] else ""
+                stale.append((row[12], email["linked_body"], email["id"]))
+            # 一覧にはHTML本文を含めず、有無だけを返す（本文はload_email_detailで読み込む）
+            email["has_html"] = bool(email.pop("html_body"))
+            emails.append(email)
+            sort_value = row[1 + EMAIL_LIST_COLUMNS.index(sort_column)]
+            next_cursor = [sort_value if sort_value is not None else "", row[0]]
+        if stale:
+            try:
+                for schema, linked_body, email_id in stale:
+                    c.execute("UPDATE %s.emails SET linked_body=?, linkify_version=? WHERE id=?" % schema,
+                              (linked_body, LINKIFY_VERSION, email_id))
+                conn.commit()
+                mailbox_version.touch()
+            except sqlite3.Error as e:
+                logger.warning("リンク変換結果のキャッシュに失敗しました: %s", str(e))
+    return {
+        "records_total": records_total,
+        "records_filtered": records_filtered,
+        "emails": emails,
+        "next_cursor": next_cursor,
+    }
+
+def _recipient_condition(address):
+    """正規化した受信者アドレス（「@ドメイン」ならドメイン全体）でemailsを絞り込む条件とパラメータを返す"""
+    if address.startswith("@"):
+        return "id IN (SELECT email_id FROM {schema}.email_recipients WHERE domain = ?)", address[1:]
+    return "id IN (SELECT email_id FROM {schema}.email_recipients WHERE address = ?)", address
+
+def query_mailbox(address, length=50, cursor=None):
+    """受信者アドレス（「@ドメイン」の場合はドメイン全体）宛てのメール概要を新しい順に取得する
+
+    email_recipientsの索引で対象のメールを絞り込むため、recipientsのJSONを全件デコード
+    することはない。cursorに直前ページ最終行の(time, id)を渡すと続きを返す。
+    """
+    address = normalize_address(address)
+    match, value = _recipient_condition(address)
+    conditions = [match]
+    params = [value]
+    if cursor is not None:
+        conditions.append("(time, id) < (?, ?)")
+        params.extend(cursor)
+    with db_pool.connection() as conn:
+        total = count_emails(conn, " WHERE " + match, [value])
+        order_by = " ORDER BY time DESC, id DESC"
+        sql, union_params = union_all(conn,
+            "SELECT id, time, subject, sender, recipients, client_ip, client_app, attachments, raw_segment IS NOT NULL"
+            " FROM {schema}.emails WHERE " + " AND ".join(conditions) + order_by + " LIMIT ?",
+            params + [length])
+        rows = conn.execute(sql + order_by + " LIMIT ?", union_params + [length]).fetchall()
+    emails = [{
+        "id": row[0],
+        "time": row[1],
+        "subject": row[2],
+        "sender": row[3],
+        "to": json.loads(row[4]) if row[4] else [],
+        "client_ip": row[5],
+        "client_app": row[6],
+        "attachments": _load_attachments_json(row[7]),
+        "has_raw": bool(row[8]),
+    } for row in rows]
+    return {
+        "address": address,
+        "total": total,
+        "emails": emails,
+        "next_cursor": [rows[-1][1], rows[-1][0]] if len(rows) == length else None,
+    }
 
 def delete_email_from_db(email_id):
     # 先获取该邮件的附件信息
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT attachments FROM emails WHERE id=?", (email_id,))
-    row = c.fetchone()
-    
-    if row and row[0]:
-        try:
-            attachments = json.loads(row[0])
-            # 删除对应的附件文件
-            for attachment in attachments:
-                if 'saved_name' in attachment:
-                    file_path = os.path.join('attachments', attachment['saved_name'])
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info("附件文件已删除: %s", file_path)
-        except Exception as e:
-            logger.error("删除附件文件时出错: %s", str(e))
-    
-    # 删除邮件记录
-    c.execute("DELETE FROM emails WHERE id=?", (email_id,))
-    conn.commit()
-    conn.close()
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        deleted = False
+        unreferenced = []
+        for schema in db_schemas(conn):
+            c.execute("SELECT attachments FROM %s.emails WHERE id=?" % schema, (email_id,))
+            row = c.fetchone()
+            if row is None:
+                continue
+            unreferenced = _release_attachments(c, _load_attachments_json(row[0]), schema)
+            # 删除邮件记录
+            c.execute("DELETE FROM %s.emails WHERE id=?" % schema, (email_id,))
+            deleted = c.rowcount > 0
+            break
+        conn.commit()
+    # 参照がなくなった添付ファイルだけを削除
+    remove_attachment_files(unreferenced)
+    return deleted
 
 def clear_emails_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM emails")
-    conn.commit()
-    conn.close()
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM main.emails")
+        c.execute("DELETE FROM main.attachment_blobs")
+        conn.commit()
+    # パーティションはファイルごと削除する
+    for name in list_partitions():
+        drop_partition(name)
+    if RAW_STORE:
+        compact_raw_segments()
+    # ハッシュ名のストアに残った添付ファイルはバックグラウンドで削除する
+    attachment_reaper.request_sweep()
+
+def bulk_delete_emails(ids=None, sender=None, recipient=None, subject=None, since=None, until=None):
+    """条件（すべてAND）に合うメールを1つのトランザクションで削除し、削除したメールIDのリストを返す
+
+    idsはメールIDのリスト、sender・subjectは部分一致、recipientは受信者アドレス（「@ドメイン」も可）、
+    since・untilは受信時刻の範囲。添付ファイルの参照カウントは内容ごとにまとめて減らし、
+    ファイルの削除はattachment_reaperに任せるため、件数が多くてもすぐに戻る。
+    """
+    conditions = []
+    params = []
+    if ids is not None:
+        conditions.append("id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(ids)))
+    if sender:
+        conditions.append("sender LIKE ? ESCAPE '\\'")
+        params.append(_like_pattern(sender))
+    if recipient:
+        match, value = _recipient_condition(normalize_address(recipient))
+        conditions.append(match)
+        params.append(value)
+    if subject:
+        conditions.append("subject LIKE ? ESCAPE '\\'")
+        params.append(_like_pattern(subject))
+    if since:
+        conditions.append("time >= ?")
+        params.append(since)
+    if until:
+        conditions.append("time < ?")
+        params.append(until)
+    if not conditions:
+        raise ValueError("削除条件が指定されていません")
+    where = " WHERE " + " AND ".join(conditions)
+
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        deleted = []
+        unreferenced = []
+        with conn:
+            # 対象の選択から削除までを1つの書き込みトランザクションで行い、同時に行われる削除と競合させない
+            c.execute("BEGIN IMMEDIATE")
+            for schema in db_schemas(conn):
+                rows = c.execute("SELECT id, attachments FROM %s.emails%s" % (schema, where.replace("{schema}", schema)),
+                                 params).fetchall()
+                if not rows:
+                    continue
+                releases = collections.Counter()
+                saved_names = {}
+                for _, attachments_json in rows:
+                    for attachment in _load_attachments_json(attachments_json):
+                        if 'saved_name' not in attachment:
+                            continue
+                        digest = attachment.get("sha256")
+                        if digest:
+                            releases[digest] += 1
+                            saved_names[digest] = attachment['saved_name']
+                        else:
+                            # 旧形式（UUID_ファイル名）の添付ファイルはメールごとに固有
+                            unreferenced.append(attachment['saved_name'])
+                hashes = json.dumps(list(releases))
+                c.executemany("UPDATE %s.attachment_blobs SET refcount = refcount - ? WHERE hash=?" % schema,
+                              [(count, digest) for digest, count in releases.items()])
+                c.execute("SELECT hash FROM %s.attachment_blobs WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(?))"
+                          % schema, (hashes,))
+                unreferenced.extend(saved_names[row[0]] for row in c.fetchall())
+                c.execute("DELETE FROM %s.attachment_blobs WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(?))"
+                          % schema, (hashes,))
+                c.execute("DELETE FROM %s.emails WHERE id IN (SELECT value FROM json_each(?))" % schema,
+                          (json.dumps([row[0] for row in rows]),))
+                deleted.extend(row[0] for row in rows)
+    remove_attachment_files(unreferenced)
+    if deleted and RAW_STORE:
+        compact_raw_segments()
+    logger.info("条件に合うメールを一括削除しました（%d件）", len(deleted))
+    return deleted
 
 def cleanup_emails_db():
+    started = time.perf_counter()
     # 閾値時間より古いメールを削除
     threshold = (datetime.datetime.now() - datetime.timedelta(days=RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
     
-    # 先获取将被删除的邮件中的附件信息
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT attachments FROM emails WHERE time < ?", (threshold,))
-    rows = c.fetchall()
+    # 先获取将被删除的邮件中的附件信息，并减少引用计数（単一DBファイル／パーティション化以前のデータ）
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, attachments FROM main.emails WHERE time < ?", (threshold,))
+        rows = c.fetchall()
+        removed_ids = [row[0] for row in rows]
+        unreferenced = []
+        for row in rows:
+            unreferenced.extend(_release_attachments(c, _load_attachments_json(row[1])))
     
-    # 删除附件文件
-    for row in rows:
-        if row[0]:
-            try:
-                attachments = json.loads(row[0])
-                for attachment in attachments:
-                    if 'saved_name' in attachment:
-                        file_path = os.path.join('attachments', attachment['saved_name'])
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info("过期附件文件已删除: %s", file_path)
-            except Exception as e:
-                logger.error("删除过期附件文件时出错: %s", str(e))
-    
-    # 删除邮件记录
-    c.execute("DELETE FROM emails WHERE time < ?", (threshold,))
-    conn.commit()
-    conn.close()
+        # 删除邮件记录
+        c.execute("DELETE FROM main.emails WHERE time < ?", (threshold,))
+        removed = c.rowcount
+        conn.commit()
+    remove_attachment_files(unreferenced)
+
+    # 期間全体が閾値より古いパーティションはDBファイルと添付ファイルディレクトリごと削除
+    retry_partition_drops()
+    removed_before = threshold
+    threshold_date = threshold[:10].replace("-", "")
+    for name in list_partitions():
+        end = (datetime.datetime.strptime(name, "%Y%m%d") + datetime.timedelta(days=PARTITION_DAYS)).strftime("%Y%m%d")
+        if end > threshold_date:
+            # 閾値をまたぐパーティションのメールは残るため、削除済みの範囲はその先頭まで
+            removed_before = min(removed_before, "%s-%s-%s 00:00:00" % (name[:4], name[4:6], name[6:]))
+            continue
+        part_conn = sqlite3.connect(partition_path(name))
+        partition_ids = [row[0] for row in part_conn.execute("SELECT id FROM emails")]
+        part_conn.close()
+        removed += len(partition_ids)
+        removed_ids.extend(partition_ids)
+        drop_partition(name)
     
-    # メモリデータを更新
-    global received_emails
-    received_emails = load_emails_from_db()
-    logger.info("%s より古いメールを削除しました", threshold)
+    # どのメールからも参照されなくなった生データのセグメントを削除し、大半が削除済みのものは詰め直す
+    if RAW_STORE:
+        compact_raw_segments()
+
+    # メモリ上の件数から削除分だけを差し引く
+    mailbox_counter.remove(removed)
+    if removed:
+        detail_cache.clear()
+        # 受信待ちが削除済みのメールを返さないよう、直近の受信記録からも取り除く
+        message_waiters.forget_many(removed_ids)
+        mailbox_version.touch()
+        event_broker.publish("cleanup", {"before": removed_before, "removed": removed})
+    logger.info("%s より古いメールを削除しました（%d件）", threshold, removed)
+    CLEANUP_SECONDS.observe(time.perf_counter() - started)
+    CLEANUP_REMOVED.inc(removed)
+    return removed
 
 def run_cleanup():
     # 1時間ごとにクリーンアップタスクを実行
     while True:
         time.sleep(3600)
         cleanup_emails_db()
+        attachment_reaper.request_sweep()
+
+# ----------------------------------------------------------------
+# 容量制限（上限を超えたら古いメールから少しずつ削除し、空いたページをファイルから返す）
+# ----------------------------------------------------------------
+QUOTA_LIMITS = (("db_bytes", QUOTA_MAX_DB_BYTES), ("attachment_bytes", QUOTA_MAX_ATTACHMENT_BYTES),
+                ("raw_bytes", QUOTA_MAX_RAW_BYTES), ("emails", QUOTA_MAX_EMAILS))
+
+def storage_usage(conn):
+    """容量制限の対象となる使用量を返す
+
+    DBは全スキーマの使用中のページ（空きページを除く）、添付ファイルは参照カウント表に
+    登録された内容ごとのサイズの合計、生データはメールが参照している圧縮後のサイズの合計で
+    数える（ディレクトリを走査しない）。削除したメールの生データが占めていた領域は
+    compact_raw_segmentsがセグメントを整理した時点でファイルから取り除かれる。
+    """
+    db_bytes = 0
+    attachment_bytes = 0
+    raw_bytes = 0
+    for schema in db_schemas(conn):
+        page_count = conn.execute("PRAGMA %s.page_count" % schema).fetchone()[0]
+        freelist_count = conn.execute("PRAGMA %s.freelist_count" % schema).fetchone()[0]
+        page_size = conn.execute("PRAGMA %s.page_size" % schema).fetchone()[0]
+        db_bytes += (page_count - freelist_count) * page_size
+        attachment_bytes += conn.execute("SELECT COALESCE(SUM(size), 0) FROM %s.attachment_blobs" % schema).fetchone()[0]
+        raw_bytes += conn.execute("SELECT COALESCE(SUM(raw_length), 0) FROM %s.emails" % schema).fetchone()[0]
+    usage = {"db_bytes": db_bytes, "attachment_bytes": attachment_bytes, "raw_bytes": raw_bytes,
+             "emails": count_emails(conn)}
+    for resource, value in usage.items():
+        STORAGE_USAGE.set(value, (resource,))
+    return usage
+
+def exceeded_quotas(usage):
+    """上限を超えている項目名のリストを返す"""
+    return [resource for resource, limit in QUOTA_LIMITS if limit > 0 and usage[resource] > limit]
+
+def eviction_batch_size(usage, exceeded):
+    """次に削除する件数を返す
+
+    件数の上限だけを超えている場合は超過分だけを削除する。容量の上限を超えている場合は
+    削除後のサイズを前もって見積もれないため、EVICT_BATCH_SIZE件ずつ削除して毎回測り直す。
+    """
+    if any(resource != "emails" for resource in exceeded):
+        return EVICT_BATCH_SIZE
+    return min(EVICT_BATCH_SIZE, usage["emails"] - dict(QUOTA_LIMITS)["emails"])
+
+def evict_oldest_emails(conn, limit=EVICT_BATCH_SIZE):
+    """最も古いメールをlimit件まで削除し、(削除したメールの(id, 受信時刻)のリスト, 参照がなくなった添付ファイル)を返す
+
+    1回の呼び出しを1トランザクションに収め、書き込みロックを短時間で手放す。
+    """
+    sql, params = union_all(conn, "SELECT '{schema}' AS schema, id, time, attachments FROM {schema}.emails"
+                                  " ORDER BY time, id LIMIT ?", (limit,))
+    rows = conn.execute("SELECT * FROM (%s) ORDER BY time, id LIMIT ?" % sql, params + [limit]).fetchall()
+    c = conn.cursor()
+    unreferenced = []
+    for schema, email_id, _, attachments_json in rows:
+        unreferenced.extend(_release_attachments(c, _load_attachments_json(attachments_json), schema))
+        c.execute("DELETE FROM %s.emails WHERE id=?" % schema, (email_id,))
+    conn.commit()
+    return [(row[1], row[2]) for row in rows], unreferenced
+
+def enforce_quotas():
+    """上限を下回るまで古いメールを少しずつ削除し、削除した件数を返す（バッチごとに使用量を測り直す）"""
+    removed = 0
+    newest = None
+    while True:
+        with db_pool.connection() as conn:
+            usage = storage_usage(conn)
+            exceeded = exceeded_quotas(usage)
+            evicted, unreferenced = [], []
+            if exceeded:
+                evicted, unreferenced = evict_oldest_emails(conn, eviction_batch_size(usage, exceeded))
+        if not evicted:
+            break
+        remove_attachment_files(unreferenced)
+        mailbox_counter.remove(len(evicted))
+        for email_id, _ in evicted:
+            detail_cache.remove(email_id)
+        message_waiters.forget_many([email_id for email_id, _ in evicted])
+        removed += len(evicted)
+        newest = evicted[-1][1]
+        QUOTA_EVICTED.inc(len(evicted))
+        # バッチの合間に受信メールの書き込みを先に通す
+        time.sleep(0.01)
+    if removed:
+        mailbox_version.touch()
+        event_broker.publish("cleanup", {"before": newest, "removed": removed})
+        logger.info("容量の上限を超えたため、%s までの古いメールを削除しました（%d件）", newest, removed)
+    return removed
+
+def incremental_vacuum():
+    """各スキーマの空きページをVACUUM_STEP_PAGESずつファイルから返し、返したページ数を返す
+
+    1回のincremental_vacuumは短い書き込みで終わるため、受信メールの書き込みを長く止めない。
+    """
+    if DB_AUTO_VACUUM != "incremental":
+        return 0
+    freed = 0
+    with db_pool.connection() as conn:
+        for schema in db_schemas(conn):
+            if conn.execute("PRAGMA %s.auto_vacuum" % schema).fetchone()[0] != 2:
+                continue
+            schema_freed = 0
+            while True:
+                before = conn.execute("PRAGMA %s.freelist_count" % schema).fetchone()[0]
+                if before == 0:
+                    break
+                # executeでは1ページ分しか実行されないため、executescriptで最後まで実行する
+                conn.executescript("PRAGMA %s.incremental_vacuum(%d)" % (schema, VACUUM_STEP_PAGES))
+                step = before - conn.execute("PRAGMA %s.freelist_count" % schema).fetchone()[0]
+                if step <= 0:
+                    break
+                schema_freed += step
+                time.sleep(0.01)
+            if schema_freed and DB_JOURNAL_MODE == "wal":
+                # WALモードではチェックポイントの時点でファイルが切り詰められる
+                conn.execute("PRAGMA %s.wal_checkpoint(PASSIVE)" % schema).fetchall()
+            freed += schema_freed
+    if freed:
+        DB_VACUUM_PAGES.inc(freed)
+        logger.info("空きページを%dページ解放しました", freed)
+    return freed
+
+def run_storage_maintenance():
+    # QUOTA_CHECK_SECONDSごとに容量制限の確認、空きページの解放、生データのセグメントの整理を行う
+    while True:
+        time.sleep(QUOTA_CHECK_SECONDS)
+        try:
+            if any(limit > 0 for _, limit in QUOTA_LIMITS):
+                enforce_quotas()
+            incremental_vacuum()
+            if RAW_STORE:
+                compact_raw_segments()
+        except sqlite3.Error as e:
+            logger.error("容量制限の処理中にエラーが発生しました: %s", str(e))
+
+# ----------------------------------------------------------------
+# イベント配信（Server-Sent Events）
+# ----------------------------------------------------------------
+class EventBroker:
+    """受信・削除・クリーンアップの差分を購読中のWeb画面へ配信する
+
+    直近のEVENT_BUFFER_SIZE件をリングバッファに残し、再接続したクライアントには
+    Last-Event-ID以降の分を送り直す。クライアントごとのキューは上限付きで、
+    溢れた（またはバッファから消えた分を要求された）クライアントには未送信分を
+    捨てて"reset"を送り、一覧を読み直させる。
+    """
+
+    def __init__(self, buffer_size=EVENT_BUFFER_SIZE, client_queue_size=EVENT_CLIENT_QUEUE_SIZE):
+        # イベントIDは「起動ごとのエポック-連番」。再起動前のIDで再接続された場合はresetになる
+        self.epoch = uuid.uuid4().hex[:8]
+        self.client_queue_size = max(client_queue_size, 1)
+        self._seq = 0
+        self._events = collections.deque(maxlen=max(buffer_size, 0))  # (連番, 送信用テキスト)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self._seq += 1
+            text = self._format(self._seq, event_type, data)
+            self._events.append((self._seq, text))
+            for subscriber in self._subscribers:
+                self._offer(subscriber, text)
+
+    def subscribe(self, last_event_id=None):
+        """購読を開始し、last_event_id以降の未受信イベントを詰めたキューを返す"""
+        subscriber = queue.Queue(maxsize=self.client_queue_size)
+        with self._lock:
+            if last_event_id:
+                after = self._parse_event_id(last_event_id)
+                oldest = self._events[0][0] if self._events else self._seq + 1
+                if after is None or after > self._seq or after < oldest - 1:
+                    self._offer(subscriber, self._format(self._seq, "reset", {}))
+                else:
+                    for seq, text in self._events:
+                        if seq > after:
+                            self._offer(subscriber, text)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def stream(self, subscriber):
+        """text/event-streamとして送るテキストを順に返す（接続が切れたら購読を解除する）"""
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    yield subscriber.get(timeout=EVENT_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # 切断の検出とプロキシのタイムアウト防止を兼ねたコメント行
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def _offer(self, subscriber, text):
+        try:
+            subscriber.put_nowait(text)
+        except queue.Full:
+            # 遅いクライアントの未送信分は捨て、一覧の読み直しを指示する
+            while True:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    break
+            subscriber.put_nowait(self._format(self._seq, "reset", {}))
+
+    def _format(self, seq, event_type, data):
+        return "id: %s-%d\nevent: %s\ndata: %s\n\n" % (
+            self.epoch, seq, event_type, json.dumps(data, ensure_ascii=False))
+
+    def _parse_event_id(self, event_id):
+        epoch, _, seq = event_id.strip().rpartition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+# ----------------------------------------------------------------
+# 受信待ち合わせ（自動テスト向けの/api/wait）
+# ----------------------------------------------------------------
+class MessageWaiters:
+    """条件に合うメールの受信を待つ呼び出し元を、受信時に直接起こす
+
+    handle_DATAからnotifyで通知されたメールを待機中の条件と照合するため、
+    待機中にDBをポーリングしない。待ち始める前に届いていたメールにも応えられるよう、
+    直近のWAIT_RECENT_SIZE通を保持しておき、sinceが指定されていればそこから探す。
+    """
+
+    def __init__(self, recent_size=WAIT_RECENT_SIZE, max_waiters=WAIT_MAX_WAITERS):
+        self.max_waiters = max(max_waiters, 0)
+        self._recent = collections.deque(maxlen=max(recent_size, 0))  # 古い順
+        self._waiters = []  # (条件, threading.Event, 結果を受け取るリスト)
+        self._lock = threading.Lock()
+
+    def notify(self, email_data):
+        with self._lock:
+            self._recent.append(email_data)
+            waiting = []
+            for criteria, event, result in self._waiters:
+                if self._matches(email_data, criteria):
+                    result.append(email_data)
+                    event.set()
+                else:
+                    waiting.append((criteria, event, result))
+            self._waiters = waiting
+
+    def forget(self, email_id=None):
+        """削除されたメール（email_idがNoneの場合はすべて）を待ち合わせの対象から外す"""
+        with self._lock:
+            if email_id is None:
+                self._recent.clear()
+            else:
+                self._recent = collections.deque(
+                    (item for item in self._recent if item["id"] != email_id), maxlen=self._recent.maxlen)
+
+    def forget_many(self, email_ids):
+        """まとめて削除されたメールを待ち合わせの対象から外す"""
+        email_ids = set(email_ids)
+        with self._lock:
+            self._recent = collections.deque(
+                (item for item in self._recent if item["id"] not in email_ids), maxlen=self._recent.maxlen)
+
+    def wait(self, to=None, subject=None, since=None, timeout=30):
+        """条件に合うメールを返す。timeout秒以内に届かなければNone
+
+        待機数が上限に達している場合はOverflowErrorを送出する。
+        """
+        criteria = {
+            "to": to.lower() if to else None,
+            "subject": subject.lower() if subject else None,
+            "since": since,
+        }
+        event = threading.Event()
+        result = []
+        with self._lock:
+            if since is not None:
+                for email_data in self._recent:
+                    if self._matches(email_data, criteria):
+                        return email_data
+            if len(self._waiters) >= self.max_waiters:
+                raise OverflowError("too many waiters")
+            self._waiters.append((criteria, event, result))
+        if event.wait(timeout):
+            return result[0]
+        with self._lock:
+            self._waiters = [item for item in self._waiters if item[1] is not event]
+        # タイムアウトと受信が重なった場合は受信を優先する
+        return result[0] if result else None
+
+    def waiting_count(self):
+        with self._lock:
+            return len(self._waiters)
+
+    def _matches(self, email_data, criteria):
+        if criteria["since"] is not None and email_data["time"] < criteria["since"]:
+            return False
+        if criteria["to"] and criteria["to"] not in [rcpt.lower() for rcpt in email_data["to"]]:
+            return False
+        if criteria["subject"] and criteria["subject"] not in (email_data["subject"] or "").lower():
+            return False
+        return True
+
+# ----------------------------------------------------------------
+# メールボックスの変更カウンター（一覧・APIの条件付きGET用）
+# ----------------------------------------------------------------
+class MailboxVersion:
+    """メールボックスの内容が変わるたびに進むカウンター
+
+    受信・削除・全削除・クリーンアップ・再読み込みと、遅延解析・リンク変換の結果を
+    DBへ書き戻した時にtouchし、その値をETag、
+    時刻をLast-Modifiedとして返す。ETagには起動時刻を含めるため、再起動後に
+    同じ番号が別の内容を指すことはない。write-behindでは受信通知の時点と
+    コミット後の両方で進め、未コミットの一覧に新しいETagが付いたままにならないようにする。
+    """
+
+    def __init__(self):
+        self._epoch = "%x" % int(time.time() * 1000)
+        self._version = 0
+        self._modified = datetime.datetime.now(datetime.timezone.utc)
+        self._lock = threading.Lock()
+
+    def touch(self):
+        with self._lock:
+            self._version += 1
+            self._modified = datetime.datetime.now(datetime.timezone.utc)
+
+    def current(self):
+        """(ETag, Last-Modified)を返す"""
+        with self._lock:
+            return "%s-%d" % (self._epoch, self._version), self._modified
 
 # ----------------------------------------------------------------
 # グローバル変数とWebサービス
 # ----------------------------------------------------------------
-init_db()
-received_emails = load_emails_from_db()
+db_pool = ConnectionPool()
+mailbox_counter = MailboxCounter()
+detail_cache = EmailDetailCache()
+email_writer = EmailWriter()
+attachment_reaper = AttachmentReaper()
+event_broker = EventBroker()
+message_waiters = MessageWaiters()
+mailbox_version = MailboxVersion()
+email_writer.on_commit = lambda emails: mailbox_version.touch()
+metrics.gauge("mailbox_messages", "Messages in the mailbox", func=lambda: mailbox_counter.total)
+metrics.gauge("write_queue_pending", "Messages waiting in the write-behind queue", func=lambda: email_writer.pending())
+metrics.gauge("attachment_reaper_pending", "Unlink and sweep jobs waiting for the reaper", func=lambda: attachment_reaper.pending())
+metrics.gauge("sse_clients", "Connected /api/events clients", func=lambda: event_broker.subscriber_count())
+metrics.gauge("wait_requests", "Requests blocked in /api/wait", func=lambda: message_waiters.waiting_count())
+
+def init_server():
+    """親プロセスの起動処理（ログファイルを開き、DBを初期化してメールの件数を読み込む）
+
+    SMTPワーカープロセスもこのモジュールを読み込むため、読み込み時には行わない。
+    """
+    setup_logging()
+    log_settings()
+    init_db()
+    mailbox_counter.load()
 
 app = Flask(__name__, static_url_path='/static', static_folder='static')
 
@@ -342,6 +2754,7 @@ HTML_TEMPLATE = """
       <div class="mb-3">
         <a href="{{ url_for('refresh_emails') }}" class="btn btn-info">手動更新</a>
         <a href="{{ url_for('clear_emails') }}" class="btn btn-warning" onclick="return confirm('すべてのメールを削除してもよろしいですか？');">すべてのメールを削除</a>
+        <button id="newMailButton" type="button" class="btn btn-success" style="display: none;" onclick="reloadEmails()">新着 <span id="newMailCount">0</span>件</button>
       </div>
       <div class="table-container">
         <table id="emailTable" class="table table-striped table-bordered">
@@ -363,40 +2776,11 @@ HTML_TEMPLATE = """
               <th><input type="text" class="form-control form-control-sm" placeholder="受信者でフィルター" /></th>
               <th><input type="text" class="form-control form-control-sm" placeholder="クライアントIPでフィルター" /></th>
               <th><input type="text" class="form-control form-control-sm" placeholder="メールクライアントでフィルター" /></th>
-              <th><input type="text" class="form-control form-control-sm" placeholder="本文/添付ファイルでフィルター" /></th>
-              <th></th>
-            </tr>
-          </thead>
-          <tbody>
-            {% for email in emails %}
-            <tr>
-              <td>{{ email.time }}</td>
-              <td>{{ email.subject }}</td>
-              <td>{{ email.sender }}</td>
-              <td>{{ email.to|join(', ') }}</td>
-              <td>{{ email.client_ip }}</td>
-              <td>{{ email.client_app }}</td>
-              <td>
-                <div>
-                  <pre>{{ email.body|safe }}</pre>
-                  {% if email.html_body %}
-                    <button class="btn btn-sm btn-primary" onclick="openPreview('{{ email.id }}')">HTMLプレビュー</button>
-                    <div id="preview-{{ email.id }}" style="display:none;">{{ email.html_body|safe }}</div>
-                  {% endif %}
-                  {% if email.attachments and email.attachments|length > 0 %}
-                    <div class="attachment-links mt-2">
-                      {% for att in email.attachments %}
-                        <a href="{{ url_for('download_attachment', filename=att['saved_name']) }}" class="btn btn-sm btn-secondary" download>{{ att['filename'] }}</a>
-                      {% endfor %}
-                    </div>
-                  {% endif %}
-                </div>
-              </td>
-              <td>
-                <a href="{{ url_for('delete_email', email_id=email.id) }}" class="btn btn-danger btn-sm" onclick="return confirm('このメールを削除してもよろしいですか？');">削除</a>
-              </td>
+              <th><input type="text" class="form-control form-control-sm" placeholder="本文/添付ファイルでフィルター" /></th>
+              <th></th>
             </tr>
-            {% endfor %}
+          </thead>
+          <tbody>
           </tbody>
         </table>
       </div>
@@ -411,7 +2795,10 @@ HTML_TEMPLATE = """
           <h5 class="modal-title" id="htmlPreviewModalLabel">HTMLメールプレビュー</h5>
           <button type="button" class="btn-close" data-bs-dismiss="modal" aria-label="閉じる"></button>
         </div>
-        <div class="modal-body" id="htmlPreviewContent">
+        <div class="modal-body">
+          <!-- HTML本文は別のURLから読み込み、スクリプト・同一オリジンへのアクセスを許可しない -->
+          <iframe id="htmlPreviewFrame" class="html-preview-frame" sandbox="allow-popups allow-popups-to-escape-sandbox"
+                  referrerpolicy="no-referrer" title="HTMLメールプレビュー"></iframe>
         </div>
       </div>
     </div>
@@ -430,9 +2817,148 @@ HTML_TEMPLATE = """
   <!-- DataTables mark.js integration -->
   <script src="https://cdn.datatables.net/plug-ins/1.10.25/features/mark.js/datatables.mark.js"></script>
   <script>
+    var emailTable = null;
+    var pageCursor = null;
+    var newMailCount = 0;
+    var deleteUrlBase = "{{ url_for('delete_email', email_id='__ID__') }}";
+    var downloadUrlBase = "{{ url_for('download_attachment', filename='__FILE__') }}";
+    var emlUrlBase = "{{ url_for('download_eml', email_id='__ID__') }}";
+    var detailUrlBase = "{{ url_for('api_email_detail', email_id='__ID__') }}";
+    var htmlUrlBase = "{{ url_for('email_html', email_id='__ID__') }}";
+    var mailboxUrlBase = "{{ url_for('mailbox_view', address='__ADDRESS__') }}";
+
+    function escapeHtml(value) {
+      return String(value == null ? '' : value)
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;')
+        .replace(/'/g, '&#39;');
+    }
+
+    function renderText(data) {
+      return escapeHtml(data);
+    }
+
+    function renderRecipients(recipients) {
+      // 受信者ごとのメール一覧へのリンクにする
+      return $.map(recipients || [], function(address) {
+        return '<a href="' + escapeHtml(mailboxUrlBase.replace('__ADDRESS__', encodeURIComponent(address))) + '">' +
+          escapeHtml(address) + '</a>';
+      }).join(', ');
+    }
+
+    function attachmentUrl(att) {
+      // イベントで届いた添付ファイルはURLを持たないため保存名から組み立てる
+      return att.url || downloadUrlBase.replace('__FILE__', att.saved_name) + '?name=' + encodeURIComponent(att.filename);
+    }
+
+    function renderBody(email) {
+      if (email.parsed === false) {
+        // 遅延解析モードで届いたメールは、開いた時に詳細APIで解析する
+        return '<div><button class="btn btn-sm btn-outline-secondary" onclick="loadParsedBody(\\'' + escapeHtml(email.id) + '\\', this)">本文を表示</button></div>';
+      }
+      var html = '<div><pre>' + email.body + (email.body_truncated ? '…' : '') + '</pre>';
+      if (email.body_truncated) {
+        html += '<button class="btn btn-sm btn-outline-secondary" onclick="loadFullBody(\\'' + escapeHtml(email.id) + '\\', this)">全文を表示</button> ';
+      }
+      if (email.has_html) {
+        html += '<button class="btn btn-sm btn-primary" onclick="openPreview(\\'' + escapeHtml(email.id) + '\\')">HTMLプレビュー</button>';
+      }
+      if (email.attachments && email.attachments.length > 0) {
+        html += '<div class="attachment-links mt-2">';
+        $.each(email.attachments, function(_, att) {
+          html += '<a href="' + escapeHtml(attachmentUrl(att)) + '" class="btn btn-sm btn-secondary" download>' + escapeHtml(att.filename) + '</a>';
+        });
+        html += '</div>';
+      }
+      return html + '</div>';
+    }
+
+    function renderActions(emailId, email) {
+      var url = deleteUrlBase.replace('__ID__', encodeURIComponent(emailId));
+      var html = '<a href="' + escapeHtml(url) + '" class="btn btn-danger btn-sm" onclick="return confirm(\\'このメールを削除してもよろしいですか？\\');">削除</a>';
+      if (email && email.has_raw) {
+        html += ' <a href="' + escapeHtml(emlUrlBase.replace('__ID__', encodeURIComponent(emailId))) + '" class="btn btn-outline-secondary btn-sm" download>.eml</a>';
+      }
+      return html;
+    }
+
+    function reloadEmails() {
+      emailTable.ajax.reload(null, false);
+    }
+
+    function showNewMail() {
+      newMailCount += 1;
+      $('#newMailCount').text(newMailCount);
+      $('#newMailButton').show();
+    }
+
+    // 先頭ページを受信順（新しい順）・絞り込みなしで表示している場合だけ、新着行を直接差し込める
+    function isLiveView() {
+      var order = emailTable.order();
+      if (emailTable.page() !== 0 || emailTable.search() || order.length !== 1 || order[0][0] !== 0 || order[0][1] !== 'desc') {
+        return false;
+      }
+      var filtered = false;
+      emailTable.columns().every(function() {
+        if (this.search()) {
+          filtered = true;
+        }
+      });
+      return !filtered;
+    }
+
+    function prependEmailRow(email) {
+      if (document.getElementById(email.id)) {
+        return;
+      }
+      var cells = [
+        renderText(email.time), renderText(email.subject), renderText(email.sender),
+        renderRecipients(email.to), renderText(email.client_ip), renderText(email.client_app),
+        renderBody(email), renderActions(email.id, email)
+      ];
+      var row = $('<tr>').attr('id', email.id);
+      $.each(cells, function(_, html) {
+        row.append($('<td>').html(html));
+      });
+      var tbody = $('#emailTable tbody');
+      tbody.find('td.dataTables_empty').closest('tr').remove();
+      tbody.prepend(row);
+      tbody.children('tr').slice(emailTable.page.len()).remove();
+      // 先頭に行が増えたため、次のページはカーソルではなく位置で取得する
+      pageCursor = null;
+    }
+
+    function listenEmailEvents() {
+      if (!window.EventSource) {
+        return;
+      }
+      // 切断時はブラウザが最後のイベントID（Last-Event-ID）を付けて自動で再接続する
+      var source = new EventSource("{{ url_for('api_events') }}");
+      source.addEventListener('new', function(e) {
+        var email = JSON.parse(e.data);
+        if (isLiveView()) {
+          prependEmailRow(email);
+        } else {
+          showNewMail();
+        }
+      });
+      source.addEventListener('delete', function(e) {
+        var row = document.getElementById(JSON.parse(e.data).id);
+        if (row && $(row).closest('#emailTable').length) {
+          $(row).remove();
+        }
+      });
+      // 全削除・クリーンアップ・一括削除・取りこぼし（reset）の場合は現在のページを読み直す
+      $.each(['clear', 'cleanup', 'bulk_delete', 'reset'], function(_, type) {
+        source.addEventListener(type, reloadEmails);
+      });
+    }
+
     $(document).ready(function() {
       // DataTablesの日本語化
-      var table = $('#emailTable').DataTable({
+      var table = emailTable = $('#emailTable').DataTable({
         language: {
           url: '//cdn.datatables.net/plug-ins/1.13.4/i18n/ja.json',
           search: "検索:",
@@ -448,6 +2974,35 @@ HTML_TEMPLATE = """
             last: "最終"
           }
         },
+        processing: true,
+        serverSide: true,
+        ajax: {
+          url: "{{ url_for('api_emails') }}",
+          data: function(d) {
+            // 直前ページの続きを要求する場合はキーセットのカーソルを付与
+            if (pageCursor && pageCursor.start === d.start) {
+              d.cursor = JSON.stringify(pageCursor.value);
+              d.cursor_key = pageCursor.key;
+            }
+          },
+          dataSrc: function(json) {
+            pageCursor = json.cursor;
+            newMailCount = 0;
+            $('#newMailButton').hide();
+            return json.data;
+          }
+        },
+        rowId: 'id',
+        columns: [
+          { data: 'time', render: renderText },
+          { data: 'subject', render: renderText },
+          { data: 'sender', render: renderText },
+          { data: 'to', render: function(data) { return renderRecipients(data); } },
+          { data: 'client_ip', render: renderText },
+          { data: 'client_app', render: renderText },
+          { data: 'body', orderable: false, render: function(data, type, email) { return renderBody(email); } },
+          { data: 'id', orderable: false, render: function(data, type, email) { return renderActions(data, email); } }
+        ],
         order: [[0, 'desc']],
         pageLength: 10,
         lengthMenu: [[10, 25, 50, 100], [10, 25, 50, 100]],
@@ -497,74 +3052,907 @@ HTML_TEMPLATE = """
       $('.dataTables_filter input').on('keyup', function() {
         // DataTables的mark插件会自动处理全局搜索高亮
       });
+
+      listenEmailEvents();
     });
 
+    function loadFullBody(emailId, button) {
+      // 一覧には本文の先頭だけが含まれるため、全文は詳細APIから読み込む
+      $(button).prop('disabled', true);
+      $.getJSON(detailUrlBase.replace('__ID__', encodeURIComponent(emailId)), function(email) {
+        $(button).siblings('pre').html(email.linked_body);
+        $(button).remove();
+      }).fail(function() {
+        $(button).prop('disabled', false);
+      });
+    }
+
+    function loadParsedBody(emailId, button) {
+      // 詳細APIが生データを解析して保存するため、次に一覧を読み込んだ時は本文も含まれる
+      $(button).prop('disabled', true);
+      $.getJSON(detailUrlBase.replace('__ID__', encodeURIComponent(emailId)), function(email) {
+        $(button).parent().replaceWith(renderBody($.extend(email, {body: email.linked_body, body_truncated: false})));
+      }).fail(function() {
+        $(button).prop('disabled', false);
+      });
+    }
+
     function openPreview(emailId) {
-      var previewDiv = document.getElementById('preview-' + emailId);
-      if (previewDiv) {
-        var htmlContent = previewDiv.innerHTML;
-        document.getElementById('htmlPreviewContent').innerHTML = htmlContent;
-        var modal = new bootstrap.Modal(document.getElementById('htmlPreviewModal'));
-        modal.show();
-      }
+      var modalElement = document.getElementById('htmlPreviewModal');
+      document.getElementById('htmlPreviewFrame').src = htmlUrlBase.replace('__ID__', encodeURIComponent(emailId));
+      bootstrap.Modal.getOrCreateInstance(modalElement).show();
     }
+
+    $('#htmlPreviewModal').on('hidden.bs.modal', function() {
+      document.getElementById('htmlPreviewFrame').src = 'about:blank';
+    });
   </script>
 </body>
 </html>
 """
 
+# 受信者ごとのメール一覧（/mailbox/<address>）
+MAILBOX_TEMPLATE = """
+<!doctype html>
+<html lang="ja">
+<head>
+  <meta charset="utf-8">
+  <title>{{ page.address }} - メールテストサービス</title>
+  <link href="https://fonts.googleapis.com/css2?family=Roboto&display=swap" rel="stylesheet">
+  <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css">
+  <link rel="stylesheet" href="{{ url_for('static', filename='css/style.css') }}">
+</head>
+<body>
+  <div class="container">
+    <div class="content-wrapper">
+      <div class="header-container">
+        <h1>{{ page.address }} 宛てのメール（{{ page.total }}件）</h1>
+      </div>
+      <div class="mb-3">
+        <a href="{{ url_for('index') }}" class="btn btn-secondary">一覧に戻る</a>
+        <a href="{{ url_for('api_mailbox', address=page.address) }}" class="btn btn-outline-secondary">JSON</a>
+      </div>
+      <div class="table-container">
+        <table class="table table-striped table-bordered">
+          <thead class="table-dark">
+            <tr>
+              <th>時間</th>
+              <th>件名</th>
+              <th>送信者</th>
+              <th>受信者</th>
+              <th>添付ファイル</th>
+              <th>操作</th>
+            </tr>
+          </thead>
+          <tbody>
+            {% for email in emails %}
+            <tr id="{{ email.id }}">
+              <td>{{ email.time }}</td>
+              <td>{{ email.subject }}</td>
+              <td>{{ email.sender }}</td>
+              <td>{{ email.to | join(', ') }}</td>
+              <td class="attachment-links">
+                {% for att in email.attachments %}<a href="{{ att.url }}">{{ att.filename }}</a>{% endfor %}
+              </td>
+              <td>{% if email.eml_url %}<a href="{{ email.eml_url }}" class="btn btn-outline-secondary btn-sm" download>.eml</a>{% endif %}</td>
+            </tr>
+            {% else %}
+            <tr><td colspan="6">メールはありません</td></tr>
+            {% endfor %}
+          </tbody>
+        </table>
+        {% if next_url %}<a href="{{ next_url }}" class="btn btn-outline-primary">次へ</a>{% endif %}
+      </div>
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+@app.errorhandler(sqlite3.OperationalError)
+def handle_db_error(e):
+    # ロック待ちがタイムアウトした場合は一時的な過負荷として503を返し、再試行を促す
+    if is_db_busy_error(e):
+        logger.warning("DBがロックされているためリクエストを処理できません: %s %s", request.method, request.path)
+        return jsonify({"error": "database is busy"}), 503, {"Retry-After": "1"}
+    logger.error("DBエラー: %s", str(e))
+    return jsonify({"error": "database error"}), 500
+
+if METRICS_ENABLED:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        # ルート単位で集計する（URLそのままだとメールIDごとに系列が増えるため）
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        if "request_started" in g:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, (endpoint,))
+        HTTP_REQUESTS_TOTAL.inc(labels=(endpoint, str(response.status_code)))
+        return response
+
+    # 新規：Prometheus形式のメトリクス
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# gzip圧縮の対象にするContent-Type（text/*以外）
+GZIP_MIMETYPES = {"application/json", "application/javascript", "image/svg+xml"}
+
+if HTTP_GZIP_MIN_SIZE > 0:
+    @app.after_request
+    def compress_response(response):
+        # ファイル送信やイベントストリームなど、逐次送るレスポンスはそのまま返す
+        if response.direct_passthrough or response.is_streamed or response.status_code != 200 \
+                or "Content-Encoding" in response.headers \
+                or not (response.mimetype.startswith("text/") or response.mimetype in GZIP_MIMETYPES):
+            return response
+        response.vary.add("Accept-Encoding")
+        if request.accept_encodings["gzip"] <= 0 or response.content_length is None \
+                or response.content_length < HTTP_GZIP_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(response.get_data(), HTTP_GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+        return response
+
+def mailbox_conditional(view):
+    """メールボックスの変更カウンターでETag・Last-Modifiedを付け、変更がなければ304を返す
+
+    応答がURLとメールボックスの内容だけで決まるビューに使う。ビューを呼ぶ前に
+    判定するため、変更がなければDBへの問い合わせもテンプレートの描画も行わない。
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag, last_modified = mailbox_version.current()
+        if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = app.make_response(view(*args, **kwargs))
+        else:
+            response = Response(status=304)
+        if response.status_code in (200, 304):
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            # キャッシュは使ってよいが、毎回サーバーに変更の有無を確認させる
+            response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+def web_display_host():
+    """画面・ログに表示するWebサーバーのホスト名"""
+    return "localhost" if WEB_HOST == "0.0.0.0" else WEB_HOST
+
 @app.route("/")
+@mailbox_conditional
 def index():
-    web_host = "localhost" if SMTP_SERVER == "0.0.0.0" else SMTP_SERVER
-    # 在显示时进行URL转换
-    processed_emails = []
-    for email in received_emails:
-        processed_email = email.copy()
-        processed_email['body'] = convert_urls_to_links(email['body']) if email['body'] else ""
-        processed_emails.append(processed_email)
-    
-    return render_template_string(HTML_TEMPLATE, 
-        emails=processed_emails,
+    # 一覧の行は/api/emailsからページ単位で取得する
+    return render_template_string(HTML_TEMPLATE,
         smtp_server=SMTP_SERVER,
         smtp_port=SMTP_PORT,
-        web_server=web_host,
-        web_port=5000
+        web_server=web_display_host(),
+        web_port=WEB_PORT
     )
 
+def _parse_datatables_args(args):
+    """DataTablesのserverSideリクエストパラメータを解析する"""
+    column_search = {}
+    for index in range(len(EMAIL_LIST_COLUMNS) + 1):
+        value = args.get("columns[%d][search][value]" % index, "").strip()
+        if value:
+            column_search[index] = value
+    return {
+        "start": max(args.get("start", 0, type=int), 0),
+        "length": min(max(args.get("length", 10, type=int), 1), 500),
+        "order_column": args.get("order[0][column]", 0, type=int),
+        "order_dir": "asc" if args.get("order[0][dir]") == "asc" else "desc",
+        "column_search": column_search,
+        "global_search": args.get("search[value]", "").strip(),
+    }
+
+def _cursor_key(params):
+    """カーソルが同じソート・検索条件で発行されたものか判定するためのキー"""
+    return json.dumps([params["order_column"], params["order_dir"],
+                       sorted(params["column_search"].items()), params["global_search"]],
+                      ensure_ascii=False)
+
+# 新規：一覧取得API（DataTables serverSideプロトコル）
+@app.route("/api/emails")
+@mailbox_conditional
+def api_emails():
+    params = _parse_datatables_args(request.args)
+    cursor_key = _cursor_key(params)
+    cursor = None
+    if params["start"] > 0 and request.args.get("cursor_key") == cursor_key:
+        try:
+            cursor = json.loads(request.args.get("cursor", ""))
+        except ValueError:
+            cursor = None
+    page = query_emails_page(cursor=cursor, **params)
+
+    data = []
+    for email in page["emails"]:
+        # 受信時に変換・キャッシュ済みのリンク付き本文の先頭だけを返す（全文は/api/emails/<id>）
+        email["body"], email["body_truncated"] = body_snippet(email.pop("linked_body"), LIST_BODY_PREVIEW)
+        email["attachments"] = [
+            {"filename": att["filename"],
+             "url": url_for("download_attachment", filename=att["saved_name"], name=att["filename"])}
+            for att in email["attachments"] if "saved_name" in att
+        ]
+        data.append(email)
+
+    response_cursor = None
+    if page["next_cursor"] is not None:
+        response_cursor = {
+            "start": params["start"] + len(data),
+            "value": page["next_cursor"],
+            "key": cursor_key,
+        }
+    return jsonify({
+        "draw": request.args.get("draw", 0, type=int),
+        "recordsTotal": page["records_total"],
+        "recordsFiltered": page["records_filtered"],
+        "data": data,
+        "cursor": response_cursor,
+    })
+
 @app.route("/delete/<email_id>")
 def delete_email(email_id):
-    delete_email_from_db(email_id)
-    global received_emails
-    received_emails = load_emails_from_db()
+    if delete_email_from_db(email_id):
+        mailbox_counter.remove()
+        detail_cache.remove(email_id)
+        mailbox_version.touch()
+        message_waiters.forget(email_id)
+        event_broker.publish("delete", {"id": email_id})
     return redirect(url_for('index'))
 
 @app.route("/clear")
 def clear_emails():
     clear_emails_db()
-    global received_emails
-    received_emails.clear()
+    mailbox_counter.clear()
+    detail_cache.clear()
+    mailbox_version.touch()
+    message_waiters.forget()
+    event_broker.publish("clear", {})
     return redirect(url_for('index'))
 
+# 新規：条件に合うメールの一括削除（JSONで ids・sender・to・subject・since・until を指定）
+@app.route("/api/emails/delete", methods=["POST"])
+def api_bulk_delete():
+    criteria = request.get_json(silent=True)
+    if not isinstance(criteria, dict):
+        return jsonify({"error": "削除条件をJSONオブジェクトで指定してください"}), 400
+    ids = criteria.get("ids")
+    if ids is not None and (not isinstance(ids, list) or not all(isinstance(value, str) for value in ids)):
+        return jsonify({"error": "idsはメールIDの配列で指定してください"}), 400
+    since_arg = str(criteria.get("since") or "").strip()
+    until_arg = str(criteria.get("until") or "").strip()
+    since = _parse_since(since_arg)
+    until = _parse_since(until_arg)
+    if (since_arg and since is None) or (until_arg and until is None):
+        return jsonify({"error": "since・untilはUNIX時刻（秒）またはYYYY-MM-DD HH:MM:SS形式で指定してください"}), 400
+    try:
+        deleted = bulk_delete_emails(ids=ids,
+                                     sender=str(criteria.get("sender") or "").strip() or None,
+                                     recipient=str(criteria.get("to") or "").strip() or None,
+                                     subject=str(criteria.get("subject") or "").strip() or None,
+                                     since=since, until=until)
+    except ValueError:
+        return jsonify({"error": "削除条件を1つ以上指定してください（すべて削除する場合は/clear）"}), 400
+    if deleted:
+        mailbox_counter.remove(len(deleted))
+        for email_id in deleted:
+            detail_cache.remove(email_id)
+        message_waiters.forget_many(deleted)
+        mailbox_version.touch()
+        event_broker.publish("bulk_delete", {"removed": len(deleted)})
+    return jsonify({"removed": len(deleted)})
+
 # 新規：手動更新ルート
 @app.route("/refresh")
 def refresh_emails():
-    global received_emails
-    received_emails = load_emails_from_db()
+    mailbox_counter.load()
+    # 他のプロセス（mboxの取り込みなど）が書き込んだメールも一覧に反映させる
+    mailbox_version.touch()
     return redirect(url_for('index'))
 
+# 新規：1通のメールの詳細（全文・リンク変換済み本文・添付ファイル情報）
+@app.route("/api/emails/<email_id>")
+def api_email_detail(email_id):
+    email = load_email_detail(email_id)
+    if email is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({
+        "id": email["id"],
+        "time": email["time"],
+        "subject": email["subject"],
+        "sender": email["sender"],
+        "to": email["to"],
+        "client_ip": email["client_ip"],
+        "client_app": email["client_app"],
+        "body": email["body"],
+        "linked_body": email["linked_body"],
+        "has_html": bool(email["html_body"]),
+        "html_url": url_for("email_html", email_id=email["id"]) if email["html_body"] else None,
+        "eml_url": url_for("download_eml", email_id=email["id"]) if email.get("has_raw") else None,
+        "attachments": [
+            {"filename": att["filename"], "size": att.get("size"), "content_type": att.get("content_type"),
+             "url": url_for("download_attachment", filename=att["saved_name"], name=att["filename"])}
+            for att in email["attachments"] if "saved_name" in att
+        ],
+    })
+
+# 新規：HTMLメールのプレビュー（一覧画面ではsandbox属性付きのiframeに読み込む）
+@app.route("/emails/<email_id>/html")
+def email_html(email_id):
+    email = load_email_detail(email_id)
+    if email is None or not email["html_body"]:
+        return jsonify({"error": "not found"}), 404
+    response = Response(email["html_body"], mimetype="text/html")
+    # 直接開かれた場合もiframeと同じ制限（スクリプト・フォーム送信の禁止、別オリジン扱い）をかける
+    response.headers["Content-Security-Policy"] = "sandbox allow-popups allow-popups-to-escape-sandbox"
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    response.headers["Referrer-Policy"] = "no-referrer"
+    return response
+
+# 新規：新着・削除をWeb画面へ通知するイベントストリーム
+@app.route("/api/events")
+def api_events():
+    # EventSourceは再接続時にLast-Event-IDヘッダーで最後に受け取ったIDを送ってくる
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    subscriber = event_broker.subscribe(last_event_id)
+    return Response(event_broker.stream(subscriber), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# 新規：受信したままの生データ（.eml）のダウンロード
+@app.route("/eml/<email_id>")
+def download_eml(email_id):
+    content = get_raw_message(email_id)
+    if content is None:
+        return jsonify({"error": "not found"}), 404
+    response = Response(content, mimetype="message/rfc822",
+                        headers={"Content-Disposition": 'attachment; filename="%s.eml"' % email_id})
+    # 生データはメールIDごとに変わらないため、長期間キャッシュさせる（Rangeによる部分取得にも対応）
+    response.set_etag(email_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = DOWNLOAD_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(content))
+
 # 新規：添付ファイルダウンロードルート
-@app.route("/download/<filename>")
+@app.route("/download/<path:filename>")
 def download_attachment(filename):
-    return send_from_directory("attachments", filename, as_attachment=True)
+    # ハッシュ名で保存されたファイルは元のファイル名（nameパラメータ）でダウンロードさせる
+    download_name = os.path.basename(request.args.get("name", "")) or None
+    # 添付ファイルは内容のハッシュ値で保存しているため、同じURLの内容は変わらない。
+    # ハッシュ値をETagにして長期間キャッシュさせる（Rangeによる部分取得・再開はsend_fileが処理する）
+    response = send_from_directory(os.path.abspath(ATTACHMENT_DIR), filename, as_attachment=True,
+                                   download_name=download_name, etag=os.path.basename(filename),
+                                   max_age=DOWNLOAD_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+# 新規：全文検索API（関連度順、ハイライト付きスニペット）
+@app.route("/api/search")
+@mailbox_conditional
+def api_search():
+    query = request.args.get("q", "").strip()
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    if not _use_fts(query):
+        return jsonify({"query": query, "results": [],
+                        "error": "%d文字以上のキーワードを指定してください" % FTS_MIN_TERM_LENGTH}), 400
+    return jsonify({"query": query, "results": search_emails(query, limit, offset)})
+
+def _parse_since(value):
+    """sinceパラメータ（UNIX時刻の秒、または「YYYY-MM-DD HH:MM:SS」形式）を受信時刻と比較できる形にする"""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromtimestamp(float(value)).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value.replace("T", " ")).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+# 新規：条件に合うメールが届くまで待って返すAPI（CIの自動テスト向け）
+@app.route("/api/wait")
+def api_wait():
+    since_arg = request.args.get("since", "").strip()
+    since = _parse_since(since_arg)
+    if since_arg and since is None:
+        return jsonify({"error": "sinceはUNIX時刻（秒）またはYYYY-MM-DD HH:MM:SS形式で指定してください"}), 400
+    timeout = min(max(request.args.get("timeout", 30, type=float), 0), WAIT_MAX_TIMEOUT)
+    try:
+        email_data = message_waiters.wait(
+            to=request.args.get("to", "").strip() or None,
+            subject=request.args.get("subject", "").strip() or None,
+            since=since,
+            timeout=timeout,
+        )
+    except OverflowError:
+        return jsonify({"error": "待機中のリクエストが多すぎます"}), 503, {"Retry-After": "1"}
+    if email_data is None:
+        # 時間内に届かなかったことはエラーではないため、本文なしの204で返す（クライアントは再度待てばよい）
+        return "", 204
+    if not email_data.get("parsed", True):
+        # 遅延解析モードでは本文を持っていないため、DB（未書き込みなら生データ）から解析する
+        stored = get_email_from_db(email_data["id"])
+        email_data = dict(email_data)
+        if stored is not None:
+            _apply_parsed(email_data, dict(stored, linked_body=""))
+        else:
+            schema = partition_schema(partition_for_time(email_data["time"])) if PARTITIONED else "main"
+            _apply_parsed(email_data, parse_stored_email(
+                schema, email_data["raw_segment"], email_data["raw_offset"], email_data["raw_length"]))
+    return jsonify({
+        "id": email_data["id"],
+        "time": email_data["time"],
+        "subject": email_data["subject"],
+        "sender": email_data["sender"],
+        "to": email_data["to"],
+        "client_ip": email_data["client_ip"],
+        "client_app": email_data["client_app"],
+        "body": email_data["body"],
+        "html_body": email_data["html_body"],
+        "attachments": [
+            {"filename": att["filename"], "size": att.get("size"), "content_type": att.get("content_type"),
+             "url": url_for("download_attachment", filename=att["saved_name"], name=att["filename"])}
+            for att in email_data["attachments"] if "saved_name" in att
+        ],
+    })
+
+def _parse_mailbox_args(args):
+    """受信者ごとの一覧のページングパラメータ（件数とカーソル）を解析する"""
+    cursor = None
+    try:
+        value = json.loads(args.get("cursor", ""))
+        if isinstance(value, list) and len(value) == 2:
+            cursor = value
+    except ValueError:
+        pass
+    return {"length": min(max(args.get("length", 50, type=int), 1), 500), "cursor": cursor}
+
+def _mailbox_email_json(email):
+    email = dict(email)
+    email["attachments"] = [
+        {"filename": att["filename"],
+         "url": url_for("download_attachment", filename=att["saved_name"], name=att["filename"])}
+        for att in email["attachments"] if "saved_name" in att
+    ]
+    # 生データを保存していないメール（RAW_STORE=0や保存機能の導入前）は.emlをダウンロードできない
+    email["eml_url"] = url_for("download_eml", email_id=email["id"]) if email.pop("has_raw") else None
+    return email
+
+# 新規：受信者アドレスごとのメール一覧（「@example.com」ならドメイン全体）
+@app.route("/mailbox/<address>")
+@mailbox_conditional
+def mailbox_view(address):
+    page = query_mailbox(address, **_parse_mailbox_args(request.args))
+    next_url = None
+    if page["next_cursor"] is not None:
+        next_url = url_for("mailbox_view", address=address, cursor=json.dumps(page["next_cursor"]))
+    return render_template_string(MAILBOX_TEMPLATE, page=page,
+                                  emails=[_mailbox_email_json(email) for email in page["emails"]], next_url=next_url)
+
+@app.route("/api/mailbox/<address>")
+@mailbox_conditional
+def api_mailbox(address):
+    page = query_mailbox(address, **_parse_mailbox_args(request.args))
+    return jsonify({
+        "address": page["address"],
+        "total": page["total"],
+        "emails": [_mailbox_email_json(email) for email in page["emails"]],
+        "cursor": page["next_cursor"],
+    })
+
+# 新規：メールの一括エクスポート（mbox、または.emlファイルのzip）
+@app.route("/api/export")
+def api_export():
+    export_format = request.args.get("format", "mbox").lower()
+    if export_format not in ("mbox", "zip"):
+        return jsonify({"error": "formatはmboxまたはzipを指定してください"}), 400
+    since_arg = request.args.get("since", "").strip()
+    until_arg = request.args.get("until", "").strip()
+    since = _parse_since(since_arg)
+    until = _parse_since(until_arg)
+    if (since_arg and since is None) or (until_arg and until is None):
+        return jsonify({"error": "since・untilはUNIX時刻（秒）またはYYYY-MM-DD HH:MM:SS形式で指定してください"}), 400
+    emails = iter_export_emails(since, until,
+                                sender=request.args.get("sender", "").strip() or None,
+                                recipient=request.args.get("to", "").strip() or None)
+    filename = "emails-%s.%s" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), export_format)
+    if export_format == "zip":
+        body, mimetype = iter_export_zip(emails), "application/zip"
+    else:
+        body, mimetype = iter_export_mbox(emails), "application/mbox"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": 'attachment; filename="%s"' % filename})
 
 def run_flask():
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    """WEB_SERVERで選んだWSGIサーバーでWebアプリを起動する（どのサーバーでもルートは同じ）
+
+    メール件数・イベント配信・受信待ちはこのプロセスのメモリ上にあるため、Webは
+    1プロセス内のスレッドで処理する。SMTPの受信をGILから切り離す場合はSMTP_WORKERSを使う。
+    """
+    if WEB_SERVER == "waitress":
+        # 接続の送受信はwaitressのI/Oスレッドが行うため、遅いクライアントがワーカースレッドを占有しない
+        # （/api/eventsと/api/waitは接続中ワーカースレッドを1つ使うため、WEB_THREADSは同時接続数より多くする）
+        waitress.serve(app, host=WEB_HOST, port=WEB_PORT, threads=WEB_THREADS,
+                       connection_limit=WEB_CONNECTION_LIMIT)
+        return
+    make_server(WEB_HOST, WEB_PORT, app, threaded=True).serve_forever()
 
 # ----------------------------------------------------------------
 # SMTPサーバー処理（メール解析時にテキスト、HTML、添付ファイルを同時に抽出）
 # ----------------------------------------------------------------
+# 解析器へ渡す・添付ファイルを書き出す際の分割サイズ
+PARSE_CHUNK_SIZE = 64 * 1024
+
+def _iter_decoded_payload(part, chunk_size=PARSE_CHUNK_SIZE):
+    """パートの転送エンコーディングを少しずつデコードしてバイト列を順に返す"""
+    payload = part.get_payload()
+    encoding = str(part.get("Content-Transfer-Encoding", "7bit")).strip().lower()
+    if encoding == "base64":
+        pending = ""
+        for start in range(0, len(payload), chunk_size):
+            pending += "".join(payload[start:start + chunk_size].split())
+            usable = len(pending) - len(pending) % 4
+            if usable:
+                yield binascii.a2b_base64(pending[:usable])
+                pending = pending[usable:]
+        if pending:
+            yield binascii.a2b_base64(pending + "=" * (-len(pending) % 4))
+    elif encoding == "quoted-printable":
+        # ソフト改行を分断しないよう行単位で区切る
+        start = 0
+        while start < len(payload):
+            end = payload.find("\n", start + chunk_size)
+            end = len(payload) if end == -1 else end + 1
+            yield binascii.a2b_qp(payload[start:end].encode("ascii", "surrogateescape"))
+            start = end
+    else:
+        # 7bit/8bit/binaryはバイト列解析時のsurrogateescapeを元に戻す
+        for start in range(0, len(payload), chunk_size):
+            yield payload[start:start + chunk_size].encode("ascii", "surrogateescape")
+
+def _store_attachment_part(part, prefix=None):
+    """添付ファイルのパートをストアに書き出し、(ハッシュ値, サイズ, 相対パス)を返す"""
+    payload = part.get_payload()
+    if isinstance(payload, str) and len(payload) > ATTACHMENT_SPILL_THRESHOLD:
+        try:
+            result = store_attachment_chunks(_iter_decoded_payload(part), prefix)
+            # 書き出し済みの内容をメモリ上の解析結果から解放する
+            part.set_payload("")
+            return result
+        except binascii.Error as e:
+            logger.warning("添付ファイルの分割デコードに失敗したため一括でデコードします: %s", str(e))
+    return store_attachment_blob(part.get_payload(decode=True) or b"", prefix)
+
+def parse_email_content(content, attachment_prefix=None):
+    """メールの生データ（バイト列）を解析し、件名・本文・HTML・添付ファイルを抽出する
+
+    バイト列のまま分割して解析器へ渡すため、8bit/バイナリのパートも壊れない。
+    添付ファイルはATTACHMENT_DIRにハッシュ名で書き出し、ATTACHMENT_SPILL_THRESHOLDを超える
+    ものは分割してデコードする。attachment_prefixは添付ファイルの保存先のサブディレクトリ
+    （パーティション名）。ワーカースレッド／プロセスで実行できるよう、引数と戻り値は
+    pickle可能な値のみとする。
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8', errors='surrogateescape')
+    parser = BytesFeedParser(policy=policy.default)
+    view = memoryview(content)
+    for start in range(0, len(view), PARSE_CHUNK_SIZE):
+        parser.feed(view[start:start + PARSE_CHUNK_SIZE].tobytes())
+    parsed_msg = parser.close()
+    subject = parsed_msg.get('Subject', '')
+    user_agent = parsed_msg.get("User-Agent", "")
+    x_mailer = parsed_msg.get("X-Mailer", "")
+    client_app = user_agent if user_agent else x_mailer
+
+    plain_body = ""
+    html_body = ""
+    attachments = []
+
+    if parsed_msg.is_multipart():
+        for part in parsed_msg.walk():
+            if part.get_content_maintype() == "multipart":
+                continue
+            content_disposition = part.get("Content-Disposition", "")
+            if content_disposition and "attachment" in content_disposition.lower():
+                filename = part.get_filename()
+                if not filename:
+                    filename = "attachment"
+                digest, size, saved_name = _store_attachment_part(part, attachment_prefix)
+                attachments.append({
+                    "filename": filename,
+                    "saved_name": saved_name,
+                    "sha256": digest,
+                    "size": size,
+                    "content_type": part.get_content_type(),
+                })
+            elif part.get_content_type() == "text/plain" and not plain_body:
+                plain_body = clean_content(part.get_content())
+            elif part.get_content_type() == "text/html" and not html_body:
+                html_body = part.get_content()
+    else:
+        if parsed_msg.get_content_type() == "text/html":
+            html_body = parsed_msg.get_content()
+        else:
+            plain_body = clean_content(parsed_msg.get_content())
+
+    return {
+        "subject": str(subject),
+        "client_app": str(client_app),
+        "body": plain_body,
+        "linked_body": convert_urls_to_links(plain_body) if plain_body else "",
+        "html_body": html_body,
+        "attachments": attachments,
+    }
+
+def parse_email_headers(content):
+    """ヘッダーだけを解析して一覧用の件名・メールクライアントを取り出す（遅延解析モード用）"""
+    if isinstance(content, str):
+        content = content.encode('utf-8', errors='surrogateescape')
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(content)
+    user_agent = headers.get("User-Agent", "")
+    return {
+        "subject": str(headers.get('Subject', '')),
+        "client_app": str(user_agent if user_agent else headers.get("X-Mailer", "")),
+        "body": "",
+        "linked_body": "",
+        "html_body": "",
+        "attachments": [],
+        "parsed": False,
+    }
+
+def process_email_content(content, attachment_prefix=None):
+    """受信時の解析処理（ワーカーで実行）
+
+    遅延解析モードではヘッダーだけを、それ以外は本文・添付ファイルまで解析する。
+    生データを保存する場合は圧縮したものを"raw"に入れて返す（書き込みは呼び出し元で行う）。
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8', errors='surrogateescape')
+    result = parse_email_headers(content) if LAZY_PARSE else parse_email_content(content, attachment_prefix)
+    if RAW_STORE:
+        result["raw"] = compress_raw(content)
+    return result
+
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
+
+def get_parse_executor():
+    """解析用のワーカープールを取得する（初回呼び出し時に作成）"""
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            if PARSE_MODE == "process":
+                _parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+            else:
+                _parse_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=PARSE_WORKERS, thread_name_prefix="mail-parser")
+            logger.info("メール解析ワーカープールを起動しました：モード=%s, ワーカー数=%d", PARSE_MODE, PARSE_WORKERS)
+        return _parse_executor
+
+def shutdown_parse_executor():
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is not None:
+            _parse_executor.shutdown(wait=True)
+            _parse_executor = None
+
+class RateLimiter:
+    """キー（送信元IP）ごとのトークンバケット。1分あたりrate件、最大burst件まで連続で許可する"""
+
+    # 保持するバケット数がこれを超えたら、満タンに戻ったもの（しばらく送ってこないIP）を捨てる
+    MAX_KEYS = 10000
+
+    def __init__(self, rate=SMTP_RATE_LIMIT, burst=SMTP_RATE_BURST):
+        self.rate = rate / 60.0
+        self.burst = max(burst, 1)
+        self._buckets = {}  # キー -> (残りトークン, 最終更新時刻)
+
+    def allow(self, key):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self.MAX_KEYS:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        self._buckets = {key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+                         if tokens + (now - updated) * self.rate < self.burst}
+
+class InstrumentedSMTP(SMTP):
+    """接続数の計測と上限を受け持つSMTPセッション
+
+    同時接続数がSMTP_MAX_CONNECTIONSに達している場合や、受信の滞留がINGEST_HIGH_WATERを
+    超えている場合は、セッションを始めずに421を返して切断する（送信側は後で再送する）。
+    """
+
+    # このプロセスで処理中のセッション数（イベントループのスレッドからのみ更新する）
+    active = 0
+
+    def connection_made(self, transport):
+        SMTP_SESSIONS_TOTAL.inc()
+        reason = None
+        if SMTP_MAX_CONNECTIONS and InstrumentedSMTP.active >= SMTP_MAX_CONNECTIONS:
+            reason = "connections"
+        elif self.event_handler.backlog() >= INGEST_HIGH_WATER:
+            reason = "backlog"
+        self._refused = reason is not None
+        if self._refused:
+            SMTP_DEFERRED_TOTAL.inc(labels=(reason,))
+            transport.write(b"421 4.3.2 Service busy, try again later\r\n")
+            transport.close()
+            return
+        InstrumentedSMTP.active += 1
+        SMTP_ACTIVE_SESSIONS.inc()
+        super().connection_made(transport)
+
+    def connection_lost(self, error):
+        if self._refused:
+            return
+        InstrumentedSMTP.active -= 1
+        SMTP_ACTIVE_SESSIONS.dec()
+        super().connection_lost(error)
+
+class SMTPController(Controller):
+    """InstrumentedSMTPを使うController"""
+
+    def __init__(self, handler, *args, **kwargs):
+        # DATAの最大サイズ（EHLOのSIZE拡張で通知され、超えるメールは552で拒否される）
+        kwargs.setdefault("data_size_limit", SMTP_MAX_MESSAGE_SIZE)
+        super().__init__(handler, *args, **kwargs)
+
+    def factory(self):
+        return InstrumentedSMTP(self.handler, **self.SMTP_kwargs)
+
+class ReusePortSMTPServer:
+    """SO_REUSEPORTで待ち受けるSMTPサーバー（SMTPワーカープロセス用）
+
+    aiosmtpdのControllerには待ち受けソケットを指定する方法がないため、SO_REUSEPORTを
+    設定したソケットを作り、専用スレッドのイベントループでloop.create_server(sock=...)に渡す。
+    Controllerの起動確認（自分宛ての試験接続）は他のワーカーに振り分けられることがあるため、
+    待ち受ける前にfactoryを一度呼び出してセッションを作れることを確認する。
+    """
+
+    def __init__(self, handler, hostname, port, ready_timeout=5.0):
+        self.handler = handler
+        self.hostname = hostname
+        self.port = port
+        self.ready_timeout = ready_timeout
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = None
+
+    def factory(self):
+        return InstrumentedSMTP(self.handler, data_size_limit=SMTP_MAX_MESSAGE_SIZE, enable_SMTPUTF8=True,
+                                loop=self.loop)
+
+    def start(self):
+        self.factory()
+        family = socket.AF_INET6 if ":" in self.hostname else socket.AF_INET
+        sock = socket.create_server((self.hostname, self.port), family=family, reuse_port=True)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="smtp-loop", daemon=True)
+        self._thread.start()
+        try:
+            self._server = asyncio.run_coroutine_threadsafe(
+                self.loop.create_server(self.factory, sock=sock), self.loop).result(self.ready_timeout)
+        except BaseException:
+            sock.close()
+            self.stop()
+            raise
+
+    def _shutdown(self):
+        if self._server is not None:
+            self._server.close()
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        self.loop.stop()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self._shutdown)
+        self._thread.join()
+        self.loop.close()
+        self._server = None
+
+def body_for_log(body):
+    """ログに出力する本文を返す（LOG_BODY_MAX_CHARSで切り詰め、LOG_BODY_SAMPLE_RATEの割合だけ出力する）
+
+    出力しない場合はNone。
+    """
+    if not body or LOG_BODY_MAX_CHARS == 0 or random.random() >= LOG_BODY_SAMPLE_RATE:
+        return None
+    if 0 < LOG_BODY_MAX_CHARS < len(body):
+        return "%s…（%d文字中%d文字を表示）" % (body[:LOG_BODY_MAX_CHARS], len(body), LOG_BODY_MAX_CHARS)
+    return body
+
+def log_access(record):
+    """アクセスログにJSONを1行出力する"""
+    if ACCESS_LOG:
+        access_logger.info(json.dumps(record, ensure_ascii=False))
+
+def build_email_data(received_at, sender, recipients, client_ip, parsed, raw_location=None):
+    """解析結果とエンベロープ情報から保存用のメールデータを作る（SMTP受信とmboxの取り込みで共通）"""
+    email_data = {
+        "id": str(uuid.uuid4()),
+        "time": received_at,
+        "subject": parsed["subject"],
+        "sender": sender,
+        "to": recipients,
+        "client_ip": client_ip,
+        "client_app": parsed["client_app"],
+        "body": parsed["body"],
+        "linked_body": parsed["linked_body"],
+        "html_body": parsed["html_body"],
+        "attachments": parsed["attachments"],
+        "parsed": parsed.get("parsed", True),
+    }
+    email_data.update(raw_location or {})
+    return email_data
+
+def notify_email_received(email_data):
+    """受信したメールを件数・イベント配信・受信待ちへ反映する"""
+    mailbox_counter.add()
+    mailbox_version.touch()
+    event_broker.publish("new", make_email_event(email_data))
+    message_waiters.notify(email_data)
+
 class CustomHandler:
+    def __init__(self, on_received=notify_email_received):
+        # 同時に解析するメール数の上限（イベントループ上で初回使用時に作成）
+        self._parse_slots = None
+        # 保存したメールの通知先（ワーカープロセスでは親プロセスへのキュー）
+        self.on_received = on_received
+        # 解析・保存中のメール数と、送信元IPごとの受信数の制限
+        self.inflight = 0
+        self.rate_limiter = RateLimiter()
+
+    def backlog(self):
+        """受信の滞留数（解析中＋書き込み待ちのメール数）"""
+        backlog = self.inflight + (email_writer.pending() if WRITE_BEHIND else 0)
+        SMTP_INGEST_BACKLOG.set(backlog)
+        return backlog
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        # 受信を始める前に滞留と送信元の受信数を確認し、超えていれば一時エラーで再送を促す
+        if self.backlog() >= INGEST_HIGH_WATER:
+            SMTP_DEFERRED_TOTAL.inc(labels=("backlog",))
+            return '452 4.3.1 Insufficient system resources, try again later'
+        if not self.rate_limiter.allow(session.peer[0]):
+            SMTP_DEFERRED_TOTAL.inc(labels=("rate_limit",))
+            return '450 4.7.1 Too many messages from this client, try again later'
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return '250 OK'
+
+    async def _parse(self, content, attachment_prefix=None):
+        if PARSE_MODE == "inline":
+            return process_email_content(content, attachment_prefix)
+        if self._parse_slots is None:
+            self._parse_slots = asyncio.Semaphore(PARSE_WORKERS)
+        async with self._parse_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_parse_executor(), process_email_content, content, attachment_prefix)
+
     async def handle_DATA(self, server, session, envelope):
+        self.inflight += 1
+        try:
+            return await self._handle_data(session, envelope)
+        finally:
+            self.inflight -= 1
+
+    async def _handle_data(self, session, envelope):
+        started = time.perf_counter()
+        size = len(envelope.original_content or envelope.content or b"")
+        SMTP_RECEIVED_BYTES.inc(size)
         logger.info("メールを受信：")
         logger.info("  送信者: %s", envelope.mail_from)
         logger.info("  受信者: %s", envelope.rcpt_tos)
@@ -573,86 +3961,495 @@ class CustomHandler:
         client_ip, client_port = session.peer
         logger.info("  クライアント接続 IP: %s, ポート: %s", client_ip, client_port)
 
-        # メール内容を解析
-        raw_message = envelope.content.decode('utf-8', errors='replace')
-        parsed_msg = Parser(policy=policy.default).parsestr(raw_message)
-        subject = parsed_msg.get('Subject', '')
-        user_agent = parsed_msg.get("User-Agent", "")
-        x_mailer = parsed_msg.get("X-Mailer", "")
-        client_app = user_agent if user_agent else x_mailer
-
-        plain_body = ""
-        html_body = ""
-        attachments = []
-        attach_dir = "attachments"
-        if not os.path.exists(attach_dir):
-            os.makedirs(attach_dir)
-
-        if parsed_msg.is_multipart():
-            for part in parsed_msg.walk():
-                if part.get_content_maintype() == "multipart":
-                    continue
-                content_disposition = part.get("Content-Disposition", "")
-                if content_disposition and "attachment" in content_disposition.lower():
-                    filename = part.get_filename()
-                    if not filename:
-                        filename = "attachment"
-                    saved_name = str(uuid.uuid4()) + "_" + filename
-                    file_path = os.path.join(attach_dir, saved_name)
-                    with open(file_path, "wb") as f:
-                        f.write(part.get_payload(decode=True))
-                    attachments.append({"filename": filename, "saved_name": saved_name})
-                elif part.get_content_type() == "text/plain" and not plain_body:
-                    plain_body = clean_content(part.get_content())
-                elif part.get_content_type() == "text/html" and not html_body:
-                    html_body = part.get_content()
-        else:
-            if parsed_msg.get_content_type() == "text/html":
-                html_body = parsed_msg.get_content()
-            else:
-                plain_body = clean_content(parsed_msg.get_content())
+        # 受信時刻（パーティションモードでは添付ファイル・生データの保存先もこれで決まる）
+        received_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        partition = partition_for_time(received_at)
+
+        # メール内容を解析（MIME解析・添付ファイルの書き出し・生データの圧縮はワーカープールで実行）
+        access = {"time": received_at, "id": None, "client_ip": client_ip, "sender": envelope.mail_from,
+                  "recipients": len(envelope.rcpt_tos), "size": size}
+        try:
+            parse_started = time.perf_counter()
+            parsed = await self._parse(envelope.content, partition)
+            parse_seconds = time.perf_counter() - parse_started
+            SMTP_PARSE_SECONDS.observe(parse_seconds)
+            store_started = time.perf_counter()
+            raw_location = {}
+            if "raw" in parsed:
+                raw = parsed.pop("raw")
+                # セグメントへの追記はディスクI/Oのため、イベントループを止めないようスレッドで行う
+                loop = asyncio.get_running_loop()
+                raw_location = await loop.run_in_executor(None, raw_store.append, raw, partition)
+                SMTP_RAW_STORED_BYTES.inc(len(raw))
+        except Exception as e:
+            SMTP_MESSAGES_TOTAL.inc(labels=("parse_error",))
+            logger.error("メールの解析に失敗しました: %s", str(e))
+            access["result"] = "parse_error"
+            log_access(access)
+            return '451 Requested action aborted: error in processing'
+        subject = parsed["subject"]
+        client_app = parsed["client_app"]
+        plain_body = parsed["body"]
+        attachments = parsed["attachments"]
 
         logger.info("  解析後の件名: %s", subject)
         logger.info("  解析されたメールクライアント: %s", client_app if client_app else "なし")
-        logger.info("  解析後の本文:\n%s", plain_body)
+        # 本文は大きくなりうるため、設定に応じて切り詰め・間引いて出力する（詳細はアクセスログで追える）
+        logged_body = body_for_log(plain_body)
+        if logged_body is not None:
+            logger.info("  解析後の本文:\n%s", logged_body)
 
         # メールデータ辞書を構築（時間は比較用にISO形式で保存）
-        email_data = {
-            "id": str(uuid.uuid4()),
-            "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "subject": subject,
-            "sender": envelope.mail_from,
-            "to": envelope.rcpt_tos,
-            "client_ip": client_ip,
-            "client_app": client_app,
-            "body": plain_body,
-            "html_body": html_body,
-            "attachments": attachments
-        }
-        # データベースに永続化し、メモリにも追加
-        add_email_to_db(email_data)
-        received_emails.append(email_data)
+        email_data = build_email_data(received_at, envelope.mail_from, envelope.rcpt_tos, client_ip, parsed, raw_location)
+        # データベースに永続化し（write-behindキュー経由）、一覧・Web画面へ通知
+        if WRITE_BEHIND:
+            email_writer.submit(email_data)
+        else:
+            add_email_to_db(email_data)
+        store_seconds = time.perf_counter() - store_started
+        self.on_received(email_data)
+        SMTP_ATTACHMENT_BYTES.inc(sum(att.get("size", 0) for att in attachments))
+        SMTP_MESSAGES_TOTAL.inc(labels=("accepted",))
+        SMTP_HANDLE_SECONDS.observe(time.perf_counter() - started)
+        access.update({
+            "id": email_data["id"],
+            "attachments": len(attachments),
+            "parse_ms": round(parse_seconds * 1000, 2),
+            "store_ms": round(store_seconds * 1000, 2),
+            "result": "accepted",
+        })
+        log_access(access)
         return '250 Message accepted for delivery'
 
-if __name__ == '__main__':
-    # SMTPサーバーを起動
-    handler_instance = CustomHandler()
-    controller = Controller(handler_instance, hostname=SMTP_SERVER, port=SMTP_PORT)
+# ----------------------------------------------------------------
+# エクスポート・インポート（mbox、.emlファイルのzip）
+# ----------------------------------------------------------------
+# エクスポート時に1回のクエリで読み込む件数（メモリ上に置くのはこの件数分だけ）
+EXPORT_BATCH_SIZE = 200
+# mboxrd形式で本文中の「From 」行をエスケープ・復元するためのパターン
+_MBOX_FROM_RE = re.compile(rb'^(>*From )', re.MULTILINE)
+_MBOX_QUOTED_FROM_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+def _export_schemas(conn, since=None, until=None):
+    """エクスポート対象のスキーマを古い順に返す（期間が範囲外のパーティションは除く）"""
+    schemas = []
+    for schema in db_schemas(conn):
+        name = schema_partition(schema)
+        if name is not None:
+            start = datetime.datetime.strptime(name, "%Y%m%d")
+            end = start + datetime.timedelta(days=PARTITION_DAYS)
+            if (since and end.strftime("%Y-%m-%d %H:%M:%S") <= since) or \
+                    (until and start.strftime("%Y-%m-%d %H:%M:%S") >= until):
+                continue
+        schemas.append(schema)
+    return sorted(schemas, key=lambda schema: (schema != "main", schema))
+
+def iter_export_emails(since=None, until=None, sender=None, recipient=None, batch_size=EXPORT_BATCH_SIZE):
+    """条件に合うメールを受信時刻の古い順に返すジェネレーター
+
+    (time, id)のキーセットでbatch_size件ずつ読み込み、その都度接続をプールへ返すため、
+    全体の件数に関係なくメモリ使用量は一定で、長い読み込みトランザクションでWALの
+    チェックポイントを止めることもない。senderは部分一致、recipientは/mailboxと同じく
+    正規化したアドレス（「@ドメイン」ならドメイン全体）の完全一致でemail_recipientsの索引から絞り込む。
+    """
+    conditions = []
+    params = []
+    if since:
+        conditions.append("time >= ?")
+        params.append(since)
+    if until:
+        conditions.append("time < ?")
+        params.append(until)
+    if sender:
+        conditions.append("sender LIKE ? ESCAPE '\\'")
+        params.append(_like_pattern(sender))
+    if recipient:
+        match, value = _recipient_condition(normalize_address(recipient))
+        conditions.append(match)
+        params.append(value)
+    with db_pool.connection() as conn:
+        schemas = _export_schemas(conn, since, until)
+    for schema in schemas:
+        last = None
+        while True:
+            batch_conditions = list(conditions)
+            batch_params = list(params)
+            if last is not None:
+                batch_conditions.append("(time, id) > (?, ?)")
+                batch_params.extend(last)
+            where = (" WHERE " + " AND ".join(batch_conditions)).format(schema=schema) if batch_conditions else ""
+            with db_pool.connection() as conn:
+                rows = []
+                # エクスポート中にクリーンアップで削除されたパーティションは読み飛ばす
+                if schema in db_schemas(conn):
+                    rows = conn.execute(
+                        "SELECT id, time, subject, sender, recipients, client_ip, client_app, body, html_body, attachments,"
+                        " raw_segment, raw_offset, raw_length FROM %s.emails%s ORDER BY time, id LIMIT ?" % (schema, where),
+                        batch_params + [batch_size]).fetchall()
+            for row in rows:
+                email = _row_to_email(row)
+                email["raw_location"] = tuple(row[10:13]) if row[10] is not None else None
+                yield email
+            if len(rows) < batch_size:
+                break
+            last = (rows[-1][1], rows[-1][0])
+
+def build_eml(email):
+    """DBに保存した件名・本文・添付ファイルからメールを組み立てる（生データを保存していないメール用）"""
+    msg = EmailMessage()
+    if email["sender"]:
+        msg["From"] = email["sender"]
+    if email["to"]:
+        msg["To"] = ", ".join(email["to"])
+    msg["Subject"] = email["subject"] or ""
+    msg["Date"] = format_datetime(datetime.datetime.strptime(email["time"], "%Y-%m-%d %H:%M:%S").astimezone())
+    if email["client_app"]:
+        msg["X-Mailer"] = email["client_app"]
+    msg.set_content(email["body"] or "")
+    if email["html_body"]:
+        msg.add_alternative(email["html_body"], subtype="html")
+    for att in email["attachments"]:
+        if "saved_name" not in att:
+            continue
+        try:
+            with open(os.path.join(ATTACHMENT_DIR, att["saved_name"]), "rb") as f:
+                data = f.read()
+        except OSError as e:
+            logger.warning("エクスポートする添付ファイルを読み込めません: %s, %s", att["saved_name"], str(e))
+            continue
+        maintype, _, subtype = (att.get("content_type") or "application/octet-stream").partition("/")
+        msg.add_attachment(data, maintype=maintype, subtype=subtype or "octet-stream", filename=att["filename"])
+    return msg.as_bytes(policy=policy.SMTP)
+
+def export_message_bytes(email):
+    """エクスポートする1通の内容（保存した生データ、なければDBの内容から組み立てたもの）"""
+    if email["raw_location"] is not None:
+        try:
+            return raw_store.read(*email["raw_location"])
+        except (OSError, ValueError, zlib.error, lzma.LZMAError) as e:
+            logger.warning("生データを読み込めないため保存内容から組み立てます: id=%s, %s", email["id"], str(e))
+    return build_eml(email)
+
+def mbox_entry(email, content):
+    """1通をmbox（mboxrd形式）の1エントリにする"""
+    received = datetime.datetime.strptime(email["time"], "%Y-%m-%d %H:%M:%S")
+    sender = "".join((email["sender"] or "").split()) or "MAILER-DAEMON"
+    from_line = "From %s %s\n" % (sender, time.asctime(received.timetuple()))
+    body = _MBOX_FROM_RE.sub(rb">\1", content.replace(b"\r\n", b"\n"))
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    return from_line.encode("utf-8", errors="replace") + body + b"\n"
+
+def iter_export_mbox(emails):
+    for email in emails:
+        yield mbox_entry(email, export_message_bytes(email))
+
+class _ZipStream:
+    """ZipFileの書き込み先。書き込まれたバイト列を溜めておき、drainで取り出す（シーク不可のストリーム）"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_export_zip(emails):
+    """1通ずつ.emlファイルとして追加したzipを、追加するたびに少しずつ返す"""
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for email in emails:
+            received = datetime.datetime.strptime(email["time"], "%Y-%m-%d %H:%M:%S")
+            info = zipfile.ZipInfo("%s_%s.eml" % (received.strftime("%Y%m%d-%H%M%S"), email["id"]),
+                                   date_time=received.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, export_message_bytes(email))
+            yield stream.drain()
+    yield stream.drain()
+
+def _iter_mbox_messages(path):
+    """mboxファイルから(「From 」行の送信者, 生データ)を1通ずつ返す（mboxrd形式のエスケープは元に戻す）"""
+    box = mailbox.mbox(path, create=False)
+    try:
+        for key in box.iterkeys():
+            message_file = box.get_file(key, from_=True)
+            try:
+                from_line = message_file.readline()
+                content = message_file.read()
+            finally:
+                message_file.close()
+            fields = from_line.split()
+            yield (fields[1].decode("utf-8", errors="replace") if len(fields) > 1 else ""), \
+                _MBOX_QUOTED_FROM_RE.sub(rb"\1", content)
+    finally:
+        box.close()
+
+def _imported_envelope(from_sender, content, use_import_time=False):
+    """取り込むメールの送信者・受信者・受信時刻をmboxの「From 」行とヘッダーから決める"""
+    headers = BytesHeaderParser(policy=policy.compat32).parsebytes(content)
+    sender = from_sender
+    if not sender or sender == "MAILER-DAEMON":
+        sender = parseaddr(str(headers.get("From", "")))[1]
+    recipients = [address for _, address in
+                  getaddresses([str(value) for value in headers.get_all("To", []) + headers.get_all("Cc", [])])
+                  if address]
+    received = None
+    if not use_import_time and headers.get("Date"):
+        try:
+            received = parsedate_to_datetime(str(headers["Date"]))
+            if received.tzinfo is not None:
+                received = received.astimezone().replace(tzinfo=None)
+        except (TypeError, ValueError):
+            received = None
+    received = received or datetime.datetime.now()
+    return sender, recipients, received.strftime("%Y-%m-%d %H:%M:%S")
+
+def import_mbox(path, use_import_time=False):
+    """mboxファイルのメールを、SMTP受信と同じ解析処理と一括書き込み（write-behind）で取り込む
+
+    解析はワーカープールで並行して行う。解析中の件数と書き込み待ちの件数
+    （INGEST_HIGH_WATER）を制限するため、大きなファイルでもメモリ使用量は一定に保たれる。
+    取り込んだ件数を返す。
+    """
+    executor = get_parse_executor()
+    inflight = collections.deque()
+    counts = {"imported": 0, "failed": 0, "rejected": 0}
+    # ATTACHできる数を超えるパーティションは作らない（古い日付のメールが多い場合は--nowを使う）
+    partitions = set(list_partitions())
+
+    def store(envelope, future):
+        sender, recipients, received_at = envelope
+        try:
+            parsed = future.result()
+            raw_location = {}
+            if "raw" in parsed:
+                raw_location = raw_store.append(parsed.pop("raw"), partition_for_time(received_at))
+        except Exception as e:
+            counts["failed"] += 1
+            logger.error("メールの取り込みに失敗しました: %s", str(e))
+            return
+        email_data = build_email_data(received_at, sender, recipients, "mbox", parsed, raw_location)
+        if WRITE_BEHIND:
+            while email_writer.pending() >= INGEST_HIGH_WATER:
+                time.sleep(0.01)
+            email_writer.submit(email_data)
+        else:
+            add_email_to_db(email_data)
+        counts["imported"] += 1
+        if counts["imported"] % 1000 == 0:
+            logger.info("取り込み中: %s（%d件）", path, counts["imported"])
+
+    for from_sender, content in _iter_mbox_messages(path):
+        envelope = _imported_envelope(from_sender, content, use_import_time)
+        if not partition_has_room(partition_for_time(envelope[2]), partitions):
+            counts["rejected"] += 1
+            logger.warning("パーティションが%d個を超えるため取り込みません（受信時刻 %s）。--nowを指定するか"
+                           "PARTITION_DAYSを増やしてください", SQLITE_MAX_ATTACHED, envelope[2])
+            continue
+        inflight.append((envelope, executor.submit(process_email_content, content, partition_for_time(envelope[2]))))
+        while len(inflight) >= PARSE_WORKERS * 2:
+            store(*inflight.popleft())
+    while inflight:
+        store(*inflight.popleft())
+    email_writer.flush()
+    logger.info("mboxファイルを取り込みました: %s（%d件、失敗%d件、パーティションの上限で除外%d件）",
+                path, counts["imported"], counts["failed"], counts["rejected"])
+    return counts["imported"]
+
+def run_import_command(argv):
+    """`python start.py import <mboxファイル>...`の処理"""
+    parser = argparse.ArgumentParser(prog="start.py import", description="mboxファイルのメールをDBに取り込みます")
+    parser.add_argument("paths", nargs="+", metavar="MBOX", help="取り込むmboxファイル")
+    parser.add_argument("--now", action="store_true", help="Dateヘッダーではなく取り込んだ時刻を受信時刻にする")
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        if not os.path.isfile(path):
+            parser.error("ファイルが見つかりません: %s" % path)
+    total = 0
+    try:
+        for path in args.paths:
+            total += import_mbox(path, args.now)
+    finally:
+        shutdown_parse_executor()
+        email_writer.close()
+        raw_store.close()
+        db_pool.close_all()
+    logger.info("取り込みが完了しました（合計%d件）", total)
+    return 0
+
+def run_vacuum_command(argv):
+    """`python start.py vacuum`の処理（既存のDBファイルをauto_vacuum=INCREMENTALで作り直す）"""
+    parser = argparse.ArgumentParser(prog="start.py vacuum",
+                                     description="既存のDBファイルをauto_vacuum=INCREMENTALで作り直します"
+                                                 "（サーバーを停止してから実行してください）")
+    parser.parse_args(argv)
+    if DB_AUTO_VACUUM != "incremental":
+        parser.error("DB_AUTO_VACUUM=incrementalの場合だけ実行できます")
+    rebuilt = 0
+    for path in [DB_FILE] + [partition_path(name) for name in list_partitions()]:
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            rebuilt += apply_auto_vacuum(conn, rebuild=True)
+        finally:
+            conn.close()
+    logger.info("auto_vacuum=INCREMENTALへの変換が完了しました（%d個のファイルを作り直しました）", rebuilt)
+    return 0
+
+# ----------------------------------------------------------------
+# 複数プロセスでのSMTP受信（SMTP_WORKERS >= 2）
+# ----------------------------------------------------------------
+def run_smtp_worker(worker_id, received_queue, worker_log_queue):
+    """SMTPワーカープロセスの本体
+
+    SO_REUSEPORTで親と同じポートを待ち受け、解析と保存（共有するWALモードのDBへの
+    write-behind書き込み）をこのプロセス内で行う。保存したメールは親プロセスへ送り、
+    親の一覧・イベント配信・受信待ちに反映させる。ログも親プロセスへ送って書き込ませ、
+    メトリクスは1秒ごとに親プロセスへ送って親の/metricsに合算させる。
+    DBの初期化は起動前に親プロセスが済ませている。
+    """
+    global SMTP_MAX_CONNECTIONS, INGEST_HIGH_WATER
+    setup_logging(worker_log_queue)
+    # 接続数・滞留数・IPごとの受信数の上限は、全ワーカーの合計が設定値になるようワーカー数で割る
+    # （同じ送信元からの接続もカーネルがワーカーへ振り分けるため、受信数はおおよその値になる）
+    SMTP_MAX_CONNECTIONS = per_worker_limit(SMTP_MAX_CONNECTIONS)
+    INGEST_HIGH_WATER = per_worker_limit(INGEST_HIGH_WATER)
+    # 終了は親プロセスからのterminate()（SIGTERM）に一本化し、書き込み待ちのメールをフラッシュしてから終了する
+    # （端末のCtrl+CはプロセスグループごとSIGINTを送るため無視する）
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    handler = CustomHandler(on_received=lambda email_data: received_queue.put(("email", email_data)))
+    handler.rate_limiter = RateLimiter(per_worker_limit(SMTP_RATE_LIMIT), per_worker_limit(SMTP_RATE_BURST))
+    if WRITE_BEHIND:
+        # 親プロセスへはDBにコミットした後で通知する（親の一覧のETagが未コミットの内容を指さないように）
+        def forward_committed(emails):
+            for email_data in emails:
+                received_queue.put(("email", email_data))
+        handler.on_received = lambda email_data: None
+        email_writer.on_commit = forward_committed
+    controller = ReusePortSMTPServer(handler, SMTP_SERVER, SMTP_PORT)
     controller.start()
-    logger.info("SMTPサーバーを起動しました。待ち受けアドレス：%s:%s", SMTP_SERVER, SMTP_PORT)
+    logger.info("SMTPワーカー%dを起動しました（pid=%d, 最大接続数=%d, IPごとの受信数=%s）", worker_id, os.getpid(),
+                SMTP_MAX_CONNECTIONS, "%d通/分" % per_worker_limit(SMTP_RATE_LIMIT) if SMTP_RATE_LIMIT else "無制限")
+    parent = multiprocessing.parent_process()
+    try:
+        # 親プロセスが異常終了した場合もポートを占有し続けないよう終了する
+        while parent is None or parent.is_alive():
+            if METRICS_ENABLED:
+                received_queue.put(("metrics", worker_id, metrics.snapshot()))
+            time.sleep(1)
+    finally:
+        controller.stop()
+        shutdown_parse_executor()
+        email_writer.close()
+        raw_store.close()
+        db_pool.close_all()
+        if METRICS_ENABLED:
+            received_queue.put(("metrics", worker_id, metrics.snapshot()))
+        logger.info("SMTPワーカー%dを終了しました", worker_id)
+
+def per_worker_limit(limit):
+    """SMTP_WORKERSで割ったワーカー1つあたりの上限（0以下は無制限のまま）"""
+    if limit <= 0:
+        return limit
+    return max(-(-limit // SMTP_WORKERS), 1)
+
+def run_received_listener(received_queue):
+    """ワーカープロセスから届いた受信通知とメトリクスを親プロセスへ反映する"""
+    while True:
+        item = received_queue.get()
+        if item is None:
+            break
+        if item[0] == "metrics":
+            metrics.set_remote("worker-%d" % item[1], item[2])
+        else:
+            notify_email_received(item[1])
+
+def start_smtp_workers(count):
+    # ワーカーはforkではなくspawnで起動する（親のスレッドやロックの状態を引き継がないため）
+    context = multiprocessing.get_context("spawn")
+    received_queue = context.Queue()
+    worker_log_queue = context.Queue()
+    log_listener = forward_worker_logs(worker_log_queue)
+    workers = []
+    for worker_id in range(count):
+        worker = context.Process(target=run_smtp_worker, args=(worker_id, received_queue, worker_log_queue),
+                                 name="smtp-worker-%d" % worker_id)
+        worker.start()
+        workers.append(worker)
+    listener = threading.Thread(target=run_received_listener, args=(received_queue,), daemon=True)
+    listener.start()
+    return workers, received_queue, log_listener
+
+def stop_smtp_workers(workers, received_queue, log_listener, timeout=30):
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    for worker in workers:
+        worker.join(timeout)
+    received_queue.put(None)
+    # ワーカーが終了時に出したログを書き出してから止める
+    log_listener.stop()
+
+if __name__ == '__main__':
+    # 既存のDBファイルのauto_vacuumの変換（起動時には行わない1回だけの移行処理）
+    if len(sys.argv) > 1 and sys.argv[1] == "vacuum":
+        setup_logging()
+        sys.exit(run_vacuum_command(sys.argv[2:]))
+    init_server()
+    # mboxファイルの一括取り込み（サーバーは起動しない）
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        sys.exit(run_import_command(sys.argv[2:]))
+
+    # SIGTERMでもCtrl+Cと同じ手順（書き込み待ちのフラッシュ、ワーカーの停止）で終了する
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # SMTPサーバーを起動（SMTP_WORKERS >= 2の場合はワーカープロセスで受信する）
+    controller = None
+    workers = []
+    if SMTP_WORKERS > 1:
+        workers, received_queue, worker_log_listener = start_smtp_workers(SMTP_WORKERS)
+        logger.info("SMTPワーカーを%d個起動しました。待ち受けアドレス：%s:%s", SMTP_WORKERS, SMTP_SERVER, SMTP_PORT)
+    else:
+        handler_instance = CustomHandler()
+        controller = SMTPController(handler_instance, hostname=SMTP_SERVER, port=SMTP_PORT)
+        controller.start()
+        logger.info("SMTPサーバーを起動しました。待ち受けアドレス：%s:%s", SMTP_SERVER, SMTP_PORT)
     
     # Flask Webサービススレッドを起動
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
-    logger.info("Webサービスを起動しました。アクセスアドレス: http://localhost:5000")
+    logger.info("Webサービスを起動しました。アクセスアドレス: http://%s:%d", web_display_host(), WEB_PORT)
     
     # 定時クリーンアップスレッドを起動
     cleanup_thread = threading.Thread(target=run_cleanup, daemon=True)
     cleanup_thread.start()
+    # 前回の終了時に削除しきれなかった添付ファイルを探す
+    attachment_reaper.request_sweep()
+    # 容量制限・空きページ解放スレッドを起動
+    storage_thread = threading.Thread(target=run_storage_maintenance, daemon=True)
+    storage_thread.start()
     
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         logger.info("中断を検出しました。サーバーを終了中...")
-        controller.stop()
+        if controller is not None:
+            controller.stop()
+        if workers:
+            stop_smtp_workers(workers, received_queue, worker_log_listener)
+        shutdown_parse_executor()
+        # 書き込み待ちのメールを失わないようフラッシュしてから終了
+        email_writer.close()
+        raw_store.close()
+        db_pool.close_all()
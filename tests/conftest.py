@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# start.init_serverはDB・ログ・添付ファイルのディレクトリを作るため、先に一時ディレクトリへ向ける
+_workdir = tempfile.mkdtemp(prefix="bobvsm-test-")
+os.environ.setdefault("DB_FILE", os.path.join(_workdir, "emails.db"))
+os.environ.setdefault("LOG_DIR", os.path.join(_workdir, "logs"))
+os.environ.setdefault("ATTACHMENT_DIR", os.path.join(_workdir, "attachments"))
+os.environ.setdefault("RAW_DIR", os.path.join(_workdir, "raw"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import start  # noqa: E402
+
+start.init_server()
+
+
+@pytest.fixture
+def client():
+    return start.app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def empty_mailbox():
+    """各テストを空のメールボックスから始める"""
+    start.email_writer.flush()
+    start.clear_emails_db()
+    start.mailbox_counter.clear()
+    start.detail_cache.clear()
+    start.message_waiters.forget()
+    start.mailbox_version.touch()
+    yield
+    start.email_writer.flush()
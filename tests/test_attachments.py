@@ -0,0 +1,67 @@
+import os
+
+import start
+
+
+def add_email(email_id, attachments):
+    start.add_email_to_db({
+        "id": email_id,
+        "time": "2026-01-01 00:00:00",
+        "subject": "attachment test",
+        "sender": "sender@example.com",
+        "to": ["qa@example.com"],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "hello",
+        "html_body": "",
+        "attachments": attachments,
+        "linked_body": "hello",
+    })
+
+
+def store_attachment(data):
+    digest, size, saved_name = start.store_attachment_blob(data)
+    return {"filename": "a.bin", "saved_name": saved_name, "sha256": digest, "size": size}
+
+
+def refcount(digest):
+    with start.db_pool.connection() as conn:
+        row = conn.execute("SELECT refcount FROM attachment_blobs WHERE hash=?", (digest,)).fetchone()
+    return row[0] if row else None
+
+
+def test_identical_content_is_stored_once():
+    first = store_attachment(b"same content")
+    second = store_attachment(b"same content")
+    assert first["saved_name"] == second["saved_name"]
+    blob_dir = os.path.dirname(os.path.join(start.ATTACHMENT_DIR, first["saved_name"]))
+    assert os.listdir(blob_dir) == [first["sha256"]]
+
+
+def test_file_is_removed_when_the_last_reference_goes(monkeypatch):
+    monkeypatch.setattr(start, "BLOB_GRACE_SECONDS", 0)
+    attachment = store_attachment(b"shared attachment")
+    path = os.path.join(start.ATTACHMENT_DIR, attachment["saved_name"])
+    add_email("shared-1", [dict(attachment)])
+    add_email("shared-2", [dict(attachment)])
+    assert refcount(attachment["sha256"]) == 2
+
+    assert start.delete_email_from_db("shared-1")
+    start.attachment_reaper.flush()
+    assert refcount(attachment["sha256"]) == 1
+    assert os.path.exists(path)
+
+    assert start.delete_email_from_db("shared-2")
+    start.attachment_reaper.flush()
+    assert refcount(attachment["sha256"]) is None
+    assert not os.path.exists(path)
+
+
+def test_sweep_keeps_referenced_files_and_removes_orphans(monkeypatch):
+    monkeypatch.setattr(start, "BLOB_GRACE_SECONDS", 0)
+    kept = store_attachment(b"referenced")
+    orphan = store_attachment(b"never saved")
+    add_email("referenced", [kept])
+    assert start.attachment_reaper.sweep() >= 1
+    assert os.path.exists(os.path.join(start.ATTACHMENT_DIR, kept["saved_name"]))
+    assert not os.path.exists(os.path.join(start.ATTACHMENT_DIR, orphan["saved_name"]))
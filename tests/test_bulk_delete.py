@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+import start
+
+
+def add_email(email_id, time, sender="sender@example.com", to=("qa@example.com",), subject="bulk", attachments=()):
+    start.add_email_to_db({
+        "id": email_id,
+        "time": time,
+        "subject": subject,
+        "sender": sender,
+        "to": list(to),
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "hello",
+        "html_body": "",
+        "attachments": list(attachments),
+        "linked_body": "hello",
+    })
+
+
+def stored_ids():
+    with start.db_pool.connection() as conn:
+        return sorted(row[0] for row in conn.execute("SELECT id FROM emails"))
+
+
+def test_criteria_are_combined_with_and():
+    add_email("a", "2026-01-01 00:00:00", to=["alice@example.org"], subject="invoice 1")
+    add_email("b", "2026-01-02 00:00:00", to=["bob@example.org"], subject="invoice 2")
+    add_email("c", "2026-01-03 00:00:00", to=["carol@example.net"], subject="invoice 3")
+    add_email("d", "2026-01-04 00:00:00", to=["dave@example.org"], subject="report")
+
+    deleted = start.bulk_delete_emails(recipient="@example.org", subject="invoice", since="2026-01-02 00:00:00")
+    assert deleted == ["b"]
+    assert stored_ids() == ["a", "c", "d"]
+
+    assert sorted(start.bulk_delete_emails(ids=["a", "d", "missing"])) == ["a", "d"]
+    assert stored_ids() == ["c"]
+
+
+def test_no_criteria_is_rejected():
+    add_email("kept", "2026-01-01 00:00:00")
+    with pytest.raises(ValueError):
+        start.bulk_delete_emails()
+    assert stored_ids() == ["kept"]
+
+
+def test_shared_attachment_is_released_once_per_email(monkeypatch):
+    monkeypatch.setattr(start, "BLOB_GRACE_SECONDS", 0)
+    digest, size, saved_name = start.store_attachment_blob(b"bulk attachment")
+    attachment = {"filename": "a.bin", "saved_name": saved_name, "sha256": digest, "size": size}
+    for index in range(3):
+        add_email("att-%d" % index, "2026-01-01 00:00:0%d" % index, attachments=[dict(attachment)])
+
+    start.bulk_delete_emails(ids=["att-0", "att-1"])
+    start.attachment_reaper.flush()
+    with start.db_pool.connection() as conn:
+        assert conn.execute("SELECT refcount FROM attachment_blobs WHERE hash=?", (digest,)).fetchone()[0] == 1
+    assert os.path.exists(os.path.join(start.ATTACHMENT_DIR, saved_name))
+
+    start.bulk_delete_emails(ids=["att-2"])
+    start.attachment_reaper.flush()
+    assert not os.path.exists(os.path.join(start.ATTACHMENT_DIR, saved_name))
+
+
+def test_api_updates_counter_and_etag(client):
+    for index in range(3):
+        add_email("api-%d" % index, "2026-01-01 00:00:0%d" % index,
+                  sender="noise@example.com" if index else "sender@example.com")
+    start.mailbox_counter.load()
+    etag = client.get("/api/emails").headers["ETag"]
+
+    response = client.post("/api/emails/delete", json={"sender": "noise@"})
+    assert response.status_code == 200
+    assert response.get_json() == {"removed": 2}
+    assert stored_ids() == ["api-0"]
+    assert start.mailbox_counter.total == 1
+    assert client.get("/api/emails").headers["ETag"] != etag
+
+
+def test_api_rejects_bad_criteria(client):
+    assert client.post("/api/emails/delete", json={}).status_code == 400
+    assert client.post("/api/emails/delete", json={"ids": "api-0"}).status_code == 400
+    assert client.post("/api/emails/delete", json={"since": "yesterday"}).status_code == 400
@@ -0,0 +1,56 @@
+import mailbox
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+import start
+
+
+def write_mbox(path, messages):
+    box = mailbox.mbox(str(path))
+    for sender, to, subject in messages:
+        msg = EmailMessage()
+        msg["From"] = sender
+        msg["To"] = to
+        msg["Subject"] = subject
+        msg["Date"] = format_datetime(start.datetime.datetime.now().astimezone())
+        msg.set_content("From the start of this line, mbox quoting must round-trip.\n")
+        box.add(msg)
+    box.flush()
+    box.close()
+
+
+def stored_subjects():
+    with start.db_pool.connection() as conn:
+        return sorted(row[0] for row in conn.execute("SELECT subject FROM emails"))
+
+
+def test_export_and_import_round_trip(client, tmp_path):
+    source = tmp_path / "source.mbox"
+    write_mbox(source, [("a@example.com", "qa@example.com", "first"), ("b@example.com", "dev@example.com", "second")])
+    assert start.import_mbox(str(source)) == 2
+
+    response = client.get("/api/export")
+    assert response.status_code == 200
+    exported = tmp_path / "exported.mbox"
+    exported.write_bytes(response.data)
+
+    start.clear_emails_db()
+    assert start.import_mbox(str(exported)) == 2
+    assert stored_subjects() == ["first", "second"]
+    detail = start.get_email_from_db(start.query_mailbox("qa@example.com")["emails"][0]["id"])
+    assert detail["body"].startswith("From the start of this line")
+
+
+def test_export_filters_by_exact_recipient(client, tmp_path):
+    source = tmp_path / "source.mbox"
+    write_mbox(source, [("a@example.com", "QA@Example.com", "exact"),
+                        ("a@example.com", "notqa@example.com", "substring"),
+                        ("a@example.com", "dev@other.example", "other domain")])
+    start.import_mbox(str(source))
+
+    exported = tmp_path / "qa.mbox"
+    exported.write_bytes(client.get("/api/export?to=qa@example.com").data)
+    assert [msg["Subject"] for msg in mailbox.mbox(str(exported))] == ["exact"]
+
+    exported.write_bytes(client.get("/api/export?to=@example.com").data)
+    assert sorted(msg["Subject"] for msg in mailbox.mbox(str(exported))) == ["exact", "substring"]
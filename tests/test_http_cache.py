@@ -0,0 +1,93 @@
+import start
+
+RAW = b"From: sender@example.com\r\nTo: qa@example.com\r\nSubject: cache test\r\n\r\nSee https://example.com/ for details.\r\n"
+
+
+def make_email(email_id, **fields):
+    email_data = {
+        "id": email_id,
+        "time": "2026-01-01 00:00:00",
+        "subject": "cache test",
+        "sender": "sender@example.com",
+        "to": ["qa@example.com"],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "See https://example.com/ for details.",
+        "html_body": "",
+        "attachments": [],
+        "linked_body": None,
+    }
+    email_data.update(fields)
+    return email_data
+
+
+def list_etag(client):
+    response = client.get("/api/emails?draw=1")
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+
+def test_email_list_not_modified_until_mailbox_changes(client):
+    start.add_email_to_db(make_email("cached", linked_body="See"))
+    start.mailbox_version.touch()
+    etag = list_etag(client)
+    assert client.get("/api/emails?draw=1", headers={"If-None-Match": etag}).status_code == 304
+    client.get("/delete/cached")
+    assert client.get("/api/emails?draw=1", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_email_list_etag_changes_when_linkify_cache_is_saved(client):
+    start.add_email_to_db(make_email("stale-linkify"))
+    start.mailbox_version.touch()
+    etag = list_etag(client)
+    # 一覧の表示でリンク変換の結果をDBへ書き戻したため、同じETagでは304にならない
+    assert client.get("/api/emails?draw=1", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_email_list_etag_changes_when_lazy_parse_is_saved(client):
+    raw_location = start.raw_store.append(start.compress_raw(RAW))
+    start.add_email_to_db(make_email("lazy", body="", linked_body="", parsed=False, **raw_location))
+    start.mailbox_version.touch()
+    etag = list_etag(client)
+    assert client.get("/api/emails?draw=1").get_json()["data"][0]["parsed"] is False
+
+    assert client.get("/api/emails/lazy").status_code == 200
+    response = client.get("/api/emails?draw=1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()["data"][0]["parsed"] is True
+
+
+def test_eml_download_supports_range_and_etag(client):
+    raw_location = start.raw_store.append(start.compress_raw(RAW))
+    start.add_email_to_db(make_email("ranged", linked_body="", **raw_location))
+
+    response = client.get("/eml/ranged")
+    assert response.status_code == 200
+    assert response.data == RAW
+    assert response.headers["Accept-Ranges"] == "bytes"
+    etag = response.headers["ETag"]
+    assert client.get("/eml/ranged", headers={"If-None-Match": etag}).status_code == 304
+
+    partial = client.get("/eml/ranged", headers={"Range": "bytes=6-22"})
+    assert partial.status_code == 206
+    assert partial.data == RAW[6:23]
+    assert partial.headers["Content-Range"] == "bytes 6-22/%d" % len(RAW)
+
+
+def test_attachment_download_supports_range_and_etag(client):
+    data = bytes(range(256)) * 4
+    digest, size, saved_name = start.store_attachment_blob(data)
+
+    response = client.get("/download/%s?name=report.bin" % saved_name)
+    assert response.status_code == 200
+    assert response.data == data
+    assert "report.bin" in response.headers["Content-Disposition"]
+    etag = response.headers["ETag"]
+    assert digest in etag
+    assert client.get("/download/%s" % saved_name, headers={"If-None-Match": etag}).status_code == 304
+
+    partial = client.get("/download/%s" % saved_name, headers={"Range": "bytes=1000-"})
+    assert partial.status_code == 206
+    assert partial.data == data[1000:]
+    response.close()
+    partial.close()
@@ -0,0 +1,34 @@
+import start
+
+
+def make_email(email_id, raw_location=None):
+    email_data = {
+        "id": email_id,
+        "time": "2026-01-01 00:00:00",
+        "subject": "mailbox test",
+        "sender": "sender@example.com",
+        "to": ["qa@example.com"],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "hello",
+        "html_body": "",
+        "attachments": [],
+        "linked_body": "hello",
+    }
+    email_data.update(raw_location or {})
+    return email_data
+
+
+def test_eml_url_only_for_messages_with_raw_data(client):
+    raw_location = start.raw_store.append(start.compress_raw(b"Subject: mailbox test\r\n\r\nhello\r\n"))
+    start.add_email_to_db(make_email("with-raw", raw_location))
+    start.add_email_to_db(make_email("without-raw"))
+
+    emails = {email["id"]: email for email in client.get("/api/mailbox/qa@example.com").get_json()["emails"]}
+    assert emails["with-raw"]["eml_url"] == "/eml/with-raw"
+    assert emails["without-raw"]["eml_url"] is None
+    assert client.get(emails["with-raw"]["eml_url"]).status_code == 200
+
+    page = client.get("/mailbox/qa@example.com").get_data(as_text=True)
+    assert 'href="/eml/with-raw"' in page
+    assert 'href="/eml/without-raw"' not in page
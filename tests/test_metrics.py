@@ -0,0 +1,22 @@
+import start
+
+
+def test_worker_metrics_are_added_to_parent_output():
+    registry = start.MetricsRegistry()
+    messages = registry.counter("messages_total", "Messages", ("result",))
+    seconds = registry.histogram("handle_seconds", "Handle time", buckets=(0.1, 1.0))
+    messages.inc(labels=("accepted",))
+    seconds.observe(0.05)
+
+    worker = start.MetricsRegistry()
+    worker.counter("messages_total", "Messages", ("result",)).inc(2, labels=("accepted",))
+    worker.histogram("handle_seconds", "Handle time", buckets=(0.1, 1.0)).observe(0.5)
+    registry.set_remote("worker-0", worker.snapshot())
+    # 同じワーカーから届いた値は置き換える（二重に数えない）
+    registry.set_remote("worker-0", worker.snapshot())
+
+    output = registry.render()
+    assert 'messages_total{result="accepted"} 3' in output
+    assert 'handle_seconds_bucket{le="0.1"} 1' in output
+    assert 'handle_seconds_bucket{le="1.0"} 2' in output
+    assert "handle_seconds_count 2" in output
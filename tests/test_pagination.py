@@ -0,0 +1,89 @@
+import json
+import urllib.parse
+
+import start
+
+
+def store_emails(count):
+    for index in range(count):
+        start.add_email_to_db({
+            "id": "page-%02d" % index,
+            # 2通ずつ同じ受信時刻にして、(time, id)の順序で同順位を区別できることを確かめる
+            "time": "2026-01-01 00:00:%02d" % (index // 2),
+            "subject": "subject %02d" % (count - index),
+            "sender": "sender@example.com",
+            "to": ["qa@example.com"],
+            "client_ip": "127.0.0.1",
+            "client_app": "",
+            "body": "hello",
+            "html_body": "",
+            "attachments": [],
+            "linked_body": "hello",
+        })
+    start.mailbox_counter.load()
+
+
+def get_page(client, **args):
+    response = client.get("/api/emails?" + urllib.parse.urlencode(dict({"draw": 1}, **args)))
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def ids(page):
+    return [email["id"] for email in page["data"]]
+
+
+def next_page_args(page, **args):
+    cursor = page["cursor"]
+    return dict(args, start=cursor["start"], cursor=json.dumps(cursor["value"]), cursor_key=cursor["key"])
+
+
+def test_first_page_is_newest_first_with_totals(client):
+    store_emails(25)
+    page = get_page(client, start=0, length=10)
+    assert page["recordsTotal"] == 25
+    assert page["recordsFiltered"] == 25
+    assert ids(page) == ["page-%02d" % index for index in range(24, 14, -1)]
+    assert page["cursor"]["start"] == 10
+
+
+def test_keyset_cursor_matches_offset_paging(client):
+    store_emails(25)
+    page = get_page(client, start=0, length=10)
+    seen = ids(page)
+    while page["cursor"] is not None:
+        offset_page = get_page(client, start=page["cursor"]["start"], length=10)
+        page = get_page(client, **next_page_args(page, length=10))
+        assert ids(page) == ids(offset_page)
+        seen.extend(ids(page))
+    assert seen == ["page-%02d" % index for index in range(24, -1, -1)]
+
+
+def test_cursor_walks_other_sort_orders(client):
+    store_emails(25)
+    order = {"order[0][column]": 1, "order[0][dir]": "asc"}
+    page = get_page(client, start=0, length=7, **order)
+    seen = ids(page)
+    while page["cursor"] is not None:
+        page = get_page(client, **next_page_args(page, length=7, **order))
+        seen.extend(ids(page))
+    assert seen == ["page-%02d" % index for index in range(24, -1, -1)]
+
+
+def test_cursor_from_other_conditions_is_ignored(client):
+    store_emails(25)
+    first = get_page(client, start=0, length=10)
+    # 並び順を変えた要求に前のカーソルを渡しても、offsetで正しいページを返す
+    args = next_page_args(first, length=10, **{"order[0][column]": 1, "order[0][dir]": "asc"})
+    page = get_page(client, **args)
+    assert ids(page) == ids(get_page(client, start=10, length=10, **{"order[0][column]": 1, "order[0][dir]": "asc"}))
+
+
+def test_filtered_count_and_pages(client):
+    store_emails(25)
+    page = get_page(client, start=0, length=10, **{"columns[1][search][value]": "subject 1"})
+    assert page["recordsTotal"] == 25
+    assert page["recordsFiltered"] == 10
+    assert len(ids(page)) == 10
+    rest = get_page(client, **next_page_args(page, length=10, **{"columns[1][search][value]": "subject 1"}))
+    assert rest["data"] == []
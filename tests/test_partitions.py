@@ -0,0 +1,74 @@
+import mailbox
+import os
+
+import pytest
+
+import start
+
+
+@pytest.fixture
+def partitioned(monkeypatch, tmp_path):
+    monkeypatch.setattr(start, "PARTITIONED", True)
+    monkeypatch.setattr(start, "PARTITION_DIR", str(tmp_path / "partitions"))
+    yield
+    start.clear_emails_db()
+
+
+def make_email(email_id, time_text):
+    return {
+        "id": email_id,
+        "time": time_text,
+        "subject": "partition test",
+        "sender": "sender@example.com",
+        "to": ["qa@example.com"],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "hello",
+        "html_body": "",
+        "attachments": [],
+        "linked_body": "hello",
+    }
+
+
+def attached_schemas():
+    with start.db_pool.connection() as conn:
+        return set(start.db_schemas(conn))
+
+
+def test_emails_are_stored_in_their_period_partition(partitioned, client):
+    start.add_email_to_db(make_email("day-1", "2026-01-01 10:00:00"))
+    start.add_email_to_db(make_email("day-2", "2026-01-02 10:00:00"))
+    start.mailbox_counter.load()
+
+    assert start.list_partitions() == ["20260102", "20260101"]
+    assert {"p20260101", "p20260102"} <= attached_schemas()
+    page = client.get("/api/emails").get_json()
+    assert page["recordsTotal"] == 2
+    assert [row["id"] for row in page["data"]] == ["day-2", "day-1"]
+
+
+def test_drop_partition_detaches_before_removing_files(partitioned):
+    start.add_email_to_db(make_email("day-1", "2026-01-01 10:00:00"))
+    start.add_email_to_db(make_email("day-2", "2026-01-02 10:00:00"))
+    assert "p20260101" in attached_schemas()
+
+    start.drop_partition("20260101")
+
+    assert not os.path.exists(start.partition_path("20260101"))
+    assert start.list_partitions() == ["20260102"]
+    for conn, _ in start.db_pool._idle:
+        assert "p20260101" not in start.db_schemas(conn)
+    assert start.get_email_from_db("day-2") is not None
+
+
+def test_import_rejects_mail_beyond_the_attach_limit(partitioned, tmp_path):
+    path = str(tmp_path / "old.mbox")
+    box = mailbox.mbox(path)
+    for day in range(1, start.SQLITE_MAX_ATTACHED + 3):
+        box.add(("From: a@example.com\nTo: qa@example.com\nSubject: day %d\n"
+                 "Date: Thu, %02d Jan 2026 10:00:00 +0000\n\nhello\n" % (day, day)).encode())
+    box.close()
+
+    assert start.import_mbox(path) == start.SQLITE_MAX_ATTACHED
+    assert len(start.list_partitions()) == start.SQLITE_MAX_ATTACHED
+    assert len(attached_schemas()) == start.SQLITE_MAX_ATTACHED + 1
@@ -0,0 +1,132 @@
+import os
+import sqlite3
+
+import start
+
+
+def store_emails(count, attachment_size=0):
+    for index in range(count):
+        attachments = []
+        if attachment_size:
+            digest, size, saved_name = start.store_attachment_blob(b"%d" % index * attachment_size)
+            attachments.append({"filename": "a.bin", "saved_name": saved_name, "sha256": digest, "size": size})
+        start.add_email_to_db({
+            "id": "quota-%d" % index,
+            "time": "2026-01-01 00:00:%02d" % index,
+            "subject": "quota %d" % index,
+            "sender": "sender@example.com",
+            "to": ["qa@example.com"],
+            "client_ip": "127.0.0.1",
+            "client_app": "",
+            "body": "hello",
+            "html_body": "",
+            "attachments": attachments,
+            "linked_body": "hello",
+        })
+    start.mailbox_counter.load()
+
+
+def stored_ids():
+    with start.db_pool.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM emails ORDER BY time")]
+
+
+def set_email_quota(monkeypatch, limit):
+    monkeypatch.setattr(start, "QUOTA_LIMITS", (("db_bytes", 0), ("attachment_bytes", 0), ("emails", limit)))
+
+
+def test_email_quota_evicts_only_the_excess(monkeypatch):
+    set_email_quota(monkeypatch, 3)
+    store_emails(5)
+    assert start.enforce_quotas() == 2
+    assert stored_ids() == ["quota-2", "quota-3", "quota-4"]
+    assert start.mailbox_counter.total == 3
+
+
+def test_email_quota_excess_spans_several_batches(monkeypatch):
+    set_email_quota(monkeypatch, 4)
+    monkeypatch.setattr(start, "EVICT_BATCH_SIZE", 2)
+    store_emails(9)
+    assert start.enforce_quotas() == 5
+    assert stored_ids() == ["quota-5", "quota-6", "quota-7", "quota-8"]
+
+
+def test_email_quota_within_limit_evicts_nothing(monkeypatch):
+    set_email_quota(monkeypatch, 5)
+    store_emails(5)
+    assert start.enforce_quotas() == 0
+    assert len(stored_ids()) == 5
+
+
+def test_size_quota_stops_once_under_the_cap(monkeypatch):
+    monkeypatch.setattr(start, "QUOTA_LIMITS", (("db_bytes", 0), ("attachment_bytes", 2500), ("emails", 0)))
+    monkeypatch.setattr(start, "EVICT_BATCH_SIZE", 1)
+    store_emails(5, attachment_size=1000)
+    assert start.enforce_quotas() == 3
+    assert stored_ids() == ["quota-3", "quota-4"]
+
+
+def store_raw_emails(count, raw_size):
+    for index in range(count):
+        content = b"Subject: raw %d\r\n\r\n" % index + os.urandom(raw_size)
+        raw_location = start.raw_store.append(start.compress_raw(content))
+        email_data = {
+            "id": "raw-%d" % index,
+            "time": "2026-01-01 00:00:%02d" % index,
+            "subject": "raw %d" % index,
+            "sender": "sender@example.com",
+            "to": ["qa@example.com"],
+            "client_ip": "127.0.0.1",
+            "client_app": "",
+            "body": "",
+            "html_body": "",
+            "attachments": [],
+            "linked_body": "",
+        }
+        email_data.update(raw_location)
+        start.add_email_to_db(email_data)
+    start.mailbox_counter.load()
+
+
+def test_raw_quota_evicts_oldest_messages(monkeypatch):
+    monkeypatch.setattr(start, "QUOTA_LIMITS", (("db_bytes", 0), ("attachment_bytes", 0), ("raw_bytes", 2500),
+                                                ("emails", 0)))
+    monkeypatch.setattr(start, "EVICT_BATCH_SIZE", 1)
+    store_raw_emails(5, 1000)
+    assert start.enforce_quotas() == 3
+    assert stored_ids() == ["raw-3", "raw-4"]
+
+
+def test_compaction_reclaims_space_of_deleted_messages(monkeypatch):
+    monkeypatch.setattr(start, "RAW_SEGMENT_GRACE_SECONDS", 0)
+    store_raw_emails(4, 1000)
+    with start.db_pool.connection() as conn:
+        segment = conn.execute("SELECT raw_segment FROM emails WHERE id='raw-3'").fetchone()[0]
+    expected = start.get_raw_message("raw-3")
+    for index in range(3):
+        start.delete_email_from_db("raw-%d" % index)
+
+    # 書き込み中のセグメントの大半が削除済みなので切り替え、残った1通を新しいセグメントへ写す
+    assert start.compact_raw_segments()[1] == 1
+    with start.db_pool.connection() as conn:
+        assert conn.execute("SELECT raw_segment FROM emails WHERE id='raw-3'").fetchone()[0] != segment
+    assert start.get_raw_message("raw-3") == expected
+    # 参照がなくなった元のセグメントは次の整理で削除される
+    assert start.compact_raw_segments()[0] >= 1
+    assert not os.path.exists(os.path.join(start.RAW_DIR, segment))
+
+
+def test_existing_database_is_only_rebuilt_on_request(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "old.db"))
+    conn.execute("CREATE TABLE emails (id TEXT PRIMARY KEY, body TEXT)")
+    conn.execute("INSERT INTO emails VALUES ('old', 'hello')")
+    conn.commit()
+
+    # 起動時（rebuild=False）は時間のかかるVACUUMを行わない
+    assert start.apply_auto_vacuum(conn) is False
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    assert start.apply_auto_vacuum(conn, rebuild=True) is True
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert conn.execute("SELECT body FROM emails").fetchall() == [("hello",)]
+    conn.close()
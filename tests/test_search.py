@@ -0,0 +1,66 @@
+import pytest
+
+import start
+
+pytestmark = pytest.mark.skipif(not start.FTS_ENABLED, reason="SQLiteのFTS5（trigram）が使えない環境")
+
+
+def store_email(email_id, subject, body, attachments=()):
+    start.add_email_to_db({
+        "id": email_id,
+        "time": "2026-01-01 00:00:00",
+        "subject": subject,
+        "sender": "sender@example.com",
+        "to": ["qa@example.com"],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": body,
+        "html_body": "",
+        "attachments": [{"filename": name, "saved_name": "x", "sha256": "x", "size": 1} for name in attachments],
+        "linked_body": body,
+    })
+    start.mailbox_counter.load()
+
+
+def search(client, query):
+    response = client.get("/api/search?q=" + query)
+    assert response.status_code == 200
+    return response.get_json()["results"]
+
+
+def test_search_matches_body_subject_and_attachment_names(client):
+    store_email("body", "hello", "認証コードは 482913 です")
+    store_email("subject", "Invoice <2026>", "see attached")
+    store_email("attachment", "report", "weekly", attachments=["quarterly-report.pdf"])
+
+    results = search(client, "482913")
+    assert [result["id"] for result in results] == ["body"]
+    assert "<mark>482913</mark>" in results[0]["highlights"]["body"]
+
+    results = search(client, "Invoice")
+    assert [result["id"] for result in results] == ["subject"]
+    # ハイライト以外の部分はHTMLエスケープされる
+    assert results[0]["highlights"]["subject"] == "<mark>Invoice</mark> &lt;2026&gt;"
+
+    assert [result["id"] for result in search(client, "quarterly")] == ["attachment"]
+
+
+def test_short_query_is_rejected(client):
+    assert client.get("/api/search?q=ab").status_code == 400
+
+
+def test_deleted_email_is_removed_from_the_index(client):
+    store_email("gone", "temporary", "unique-token-xyz")
+    assert [result["id"] for result in search(client, "unique-token")] == ["gone"]
+    start.delete_email_from_db("gone")
+    assert search(client, "unique-token") == []
+
+
+def test_list_search_uses_the_index(client):
+    store_email("match", "Order shipped", "tracking number 1Z999")
+    store_email("other", "Newsletter", "nothing to see")
+
+    response = client.get("/api/emails?draw=1&search[value]=1Z999")
+    assert [email["id"] for email in response.get_json()["data"]] == ["match"]
+    response = client.get("/api/emails?draw=1&columns[1][search][value]=shipped")
+    assert [email["id"] for email in response.get_json()["data"]] == ["match"]
@@ -0,0 +1,52 @@
+import threading
+
+import start
+
+
+def make_email(email_id, to, subject):
+    return {
+        "id": email_id,
+        "time": "2026-01-01 00:00:00",
+        "subject": subject,
+        "sender": "sender@example.com",
+        "to": [to],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "hello",
+        "html_body": "",
+        "attachments": [],
+        "linked_body": "hello",
+    }
+
+
+def test_wait_returns_matching_email(client):
+    email_data = make_email("wait-1", "qa@example.com", "Your code 1234")
+    start.add_email_to_db(email_data)
+    timer = threading.Timer(0.2, start.notify_email_received, args=(email_data,))
+    timer.start()
+    response = client.get("/api/wait?to=QA@example.com&subject=code&timeout=5")
+    timer.join()
+    assert response.status_code == 200
+    assert response.get_json()["id"] == "wait-1"
+
+
+def test_wait_timeout_returns_no_content(client):
+    response = client.get("/api/wait?to=nobody@example.com&timeout=0.1")
+    assert response.status_code == 204
+    assert response.data == b""
+    assert start.message_waiters.waiting_count() == 0
+
+
+def test_wait_rejects_invalid_since(client):
+    assert client.get("/api/wait?since=garbage").status_code == 400
+
+
+def test_wait_ignores_email_removed_by_cleanup(client):
+    email_data = make_email("wait-old", "qa@example.com", "Your code 5678")
+    email_data["time"] = "2000-01-01 00:00:00"
+    start.add_email_to_db(email_data)
+    start.email_writer.flush()
+    start.notify_email_received(email_data)
+    assert start.cleanup_emails_db() == 1
+    response = client.get("/api/wait?to=qa@example.com&since=1999-12-31 00:00:00&timeout=0.1")
+    assert response.status_code == 204
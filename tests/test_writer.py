@@ -0,0 +1,56 @@
+import start
+
+
+def make_email(email_id):
+    return {
+        "id": email_id,
+        "time": "2026-01-01 00:00:00",
+        "subject": "writer test",
+        "sender": "sender@example.com",
+        "to": ["qa@example.com"],
+        "client_ip": "127.0.0.1",
+        "client_app": "",
+        "body": "hello",
+        "html_body": "",
+        "attachments": [],
+        "linked_body": "hello",
+    }
+
+
+def stored_ids():
+    with start.db_pool.connection() as conn:
+        return sorted(row[0] for row in conn.execute("SELECT id FROM emails"))
+
+
+def test_flush_waits_for_batched_commits():
+    writer = start.EmailWriter(batch_size=3, interval_ms=200)
+    batches = []
+    writer.on_commit = lambda emails: batches.append([email["id"] for email in emails])
+    try:
+        for index in range(7):
+            writer.submit(make_email("writer-%d" % index))
+        writer.flush()
+        assert writer.pending() == 0
+        assert stored_ids() == ["writer-%d" % index for index in range(7)]
+        assert [len(batch) for batch in batches] == [3, 3, 1]
+    finally:
+        writer.close()
+
+
+def test_failed_row_does_not_drop_the_rest_of_the_batch():
+    writer = start.EmailWriter(batch_size=10, interval_ms=200)
+    try:
+        writer.submit(make_email("ok-1"))
+        writer.submit(make_email("ok-1"))  # 主キーの重複でバッチのコミットが失敗する
+        writer.submit(make_email("ok-2"))
+        writer.flush()
+        assert stored_ids() == ["ok-1", "ok-2"]
+    finally:
+        writer.close()
+
+
+def test_close_writes_queued_emails():
+    writer = start.EmailWriter(batch_size=100, interval_ms=5000)
+    writer.submit(make_email("queued"))
+    writer.close()
+    assert stored_ids() == ["queued"]